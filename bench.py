@@ -0,0 +1,832 @@
+"""
+Замеры производительности анализатора.
+
+Запуск: python bench.py [имя_замера ...] [--size МБ]
+Без аргументов выполняются все замеры.
+"""
+import multiprocessing
+import os
+import random
+import re
+import tempfile
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from typing import Callable, Dict, List, Optional
+
+from main import (IDENTIFIER, MODEL_GRAMMAR, SEMICOLON, STREAM_CHUNK_SIZE, TOKEN_NAMES, Assign, Binary,
+                  Grammar, LexicalAnalyzer, Let, LineIndex, Name, Number, Program, SyntaxAnalyzer, SyntaxDocument,
+                  TokenCache, TokenDocument, iter_nodes, lexer_tables_path, load_lexer_tables, token_code,
+                  token_view)
+
+SAMPLE_PROGRAM = """{
+    let x = 10;
+    let y = 2.5e3;
+    let $z = 30;
+    /* comment */
+    if x < y then {
+        output x;
+    } else {
+        input y;
+    }
+    do { x = x + 1; } while x < 100
+}
+"""
+
+
+def make_source(size_mb: float, chunk: str = SAMPLE_PROGRAM) -> str:
+    """
+    Строит исходный текст заданного размера повторением образца
+    """
+    repeat = max(1, int(size_mb * 1024 * 1024) // len(chunk))
+    return chunk * repeat
+
+
+def timed(func: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def legacy_tokenize(lexer: LexicalAnalyzer, program: str):
+    """
+    Прежняя реализация: второй проход по каждому непробельному символу
+    """
+    tokens = []
+    errors = []
+    for match in re.finditer(lexer.token_regex, program):
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind in ("WHITESPACE", "NEWLINE", "COMMENT", "MISMATCH"):
+            continue
+        elif kind == "NUMBER":
+            value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+        tokens.append((TOKEN_NAMES[token_code(kind, value)], value))
+
+    specification = [spec for spec in lexer.token_specification if spec[0] != "MISMATCH"]
+    for match in re.finditer(r'[^\s]', program):
+        if not any(re.match(spec[1], match.group(0)) for spec in specification):
+            errors.append(f"Неизвестный символ: {match.group(0)}")
+    return tokens, errors
+
+
+def bench_single_pass(size_mb: float):
+    """
+    Однопроходный поиск неизвестных символов против второго прохода
+    """
+    program = make_source(size_mb)
+    lexer = LexicalAnalyzer()
+    (old_tokens, old_errors), old_time = timed(legacy_tokenize, lexer, program)
+    (new_tokens, new_errors), new_time = timed(lexer.tokenize, program)
+    assert old_tokens == token_view(new_tokens)
+    print(f"  два прохода:  {old_time:8.3f} с")
+    print(f"  один проход:  {new_time:8.3f} с  (x{old_time / new_time:.1f})")
+    # Прежний проход проверял символы по одному и ошибался на '.' внутри чисел и на тексте комментариев
+    print(f"  ошибок: {len(old_errors)} -> {len(new_errors)}")
+
+
+FUZZ_ALPHABET = list("abcdefhxyzABFH01789.eE+-<>=*/(){};,_$ \t\r\n") + ["ф", "٣", "\u00a0"]
+FUZZ_WORDS = ["let", "if", "then", "else", "for", "do", "while", "loop", "input", "output",
+              "or", "and", "not", "/*", "*/", "1Fh", "101b", "each", "1.5e+3"]
+
+
+def fuzz_sources(count: int, seed: int = 0):
+    """
+    Случайные короткие тексты для сравнения движков между собой
+    """
+    rng = random.Random(seed)
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(0, 40)):
+            if rng.random() < 0.7:
+                parts.append(rng.choice(FUZZ_ALPHABET))
+            else:
+                parts.append(rng.choice(FUZZ_WORDS) + rng.choice(" x1"))
+        yield "".join(parts)
+
+
+def check_engines(engine: str, count: int = 20000):
+    """
+    Дифференциальная проверка: вывод движка должен побайтно совпадать с regex
+    """
+    reference = LexicalAnalyzer()
+    lexer = LexicalAnalyzer(engine)
+    for source in fuzz_sources(count):
+        expected = repr(reference.tokenize(source))
+        actual = repr(lexer.tokenize(source))
+        if expected != actual:
+            raise AssertionError(f"{engine}: расхождение на {source!r}:\n{expected}\n{actual}")
+
+
+def bench_dfa(size_mb: float):
+    """
+    Пропускная способность движков regex и dfa в токенах в секунду
+    """
+    check_engines("dfa")
+    program = make_source(size_mb)
+    results = {}
+    for engine in ("regex", "dfa"):
+        lexer = LexicalAnalyzer(engine)
+        (tokens, _), elapsed = timed(lexer.tokenize, program)
+        results[engine] = tokens
+        print(f"  {engine:6} {elapsed:8.3f} с  {len(tokens) / elapsed / 1e6:6.2f} млн токенов/с")
+    assert repr(results["regex"]) == repr(results["dfa"])
+
+
+def check_stream(count: int = 20000):
+    """
+    Потоковый анализ при случайной нарезке на фрагменты совпадает с tokenize
+    """
+    reference = LexicalAnalyzer()
+    rng = random.Random(1)
+    for source in fuzz_sources(count, seed=1):
+        cuts = sorted(rng.randint(0, len(source)) for _ in range(rng.randint(0, 5)))
+        chunks = [source[start:end] for start, end in zip([0] + cuts, cuts + [len(source)])]
+        errors = []
+        tokens = list(reference.tokenize_stream(chunks, errors))
+        if repr(reference.tokenize(source)) != repr((tokens, errors)):
+            raise AssertionError(f"stream: расхождение на {chunks!r}")
+
+
+def bench_stream(size_mb: float):
+    """
+    Пиковая память: tokenize над строкой против tokenize_stream над фрагментами
+    """
+    check_stream()
+    lexer = LexicalAnalyzer()
+    repeat = max(1, int(size_mb * 1024 * 1024) // len(SAMPLE_PROGRAM))
+
+    tracemalloc.start()
+    tokens, _ = lexer.tokenize(SAMPLE_PROGRAM * repeat)
+    count = len(tokens)
+    del tokens
+    _, whole_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    streamed = sum(1 for _ in lexer.tokenize_stream(SAMPLE_PROGRAM for _ in range(repeat)))
+    _, stream_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert streamed == count
+    print(f"  tokenize:         пик {whole_peak / 2 ** 20:8.1f} МБ")
+    print(f"  tokenize_stream:  пик {stream_peak / 2 ** 20:8.1f} МБ")
+
+    # Незакрытый комментарий в начале: окно не должно держать весь остаток текста
+    errors = []
+    sample = SAMPLE_PROGRAM.replace("/* comment */", "")
+    tracemalloc.start()
+    streamed = sum(1 for _ in lexer.tokenize_stream(chain(["{ /* "], (sample for _ in range(repeat))), errors))
+    _, unclosed_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert streamed == 1 and errors == ["Незакрытый комментарий (строка 1, столбец 3)"]
+    assert unclosed_peak < 2 * stream_peak + STREAM_CHUNK_SIZE
+    print(f"  незакрытый /*:    пик {unclosed_peak / 2 ** 20:8.1f} МБ")
+
+    # Длинный и незакрытый комментарии: фрагмент продолжает токен, а не сканирует его заново
+    comment = "x" * int(size_mb * 1024 * 1024 / 2)
+    for label, text in (("комментарий", f"{{ /*{comment}*/ let a = 1; }}"), ("незакрытый", f"{{ let a = 1; /*{comment}")):
+        chunks = [text[start:start + STREAM_CHUNK_SIZE] for start in range(0, len(text), STREAM_CHUNK_SIZE)]
+        errors = []
+        tokens, stream_time = timed(lambda: list(lexer.tokenize_stream(chunks, errors)))
+        expected, whole_time = timed(lexer.tokenize, text)
+        assert repr(expected) == repr((tokens, errors))
+        print(f"  {label:11} {len(text) / 2 ** 20:5.1f} МБ: tokenize {whole_time:6.3f} с, tokenize_stream {stream_time:6.3f} с")
+
+
+def bench_mmap(size_mb: float):
+    """
+    Чтение файла в str и tokenize против tokenize_file поверх mmap
+    """
+    lexer = LexicalAnalyzer()
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="ascii") as f:
+        f.write(make_source(size_mb, SAMPLE_PROGRAM.replace("$", "")))
+    try:
+        def read_and_tokenize():
+            with open(f.name, encoding="ascii") as source:
+                return lexer.tokenize(source.read())
+
+        for name, func in (("str", read_and_tokenize), ("mmap", lambda: lexer.tokenize_file(f.name))):
+            tracemalloc.start()
+            (tokens, _), elapsed = timed(func)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"  {name:5} {elapsed:8.3f} с  пик {peak / 2 ** 20:8.1f} МБ  токенов {len(tokens)}")
+            del tokens
+    finally:
+        os.unlink(f.name)
+
+
+def bench_token_buffer(size_mb: float):
+    """
+    Память на токен: список кортежей против TokenBuffer.
+    10 млн токенов получаются примерно при --size 40
+    """
+    lexer = LexicalAnalyzer()
+    program = make_source(size_mb, SAMPLE_PROGRAM.replace("$", ""))
+    for name, func in (("list", lexer.tokenize), ("TokenBuffer", lexer.tokenize_buffer)):
+        tracemalloc.start()
+        (tokens, _), elapsed = timed(func, program)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        per_token = current / len(tokens)
+        print(f"  {name:12} {elapsed:8.3f} с  {per_token:6.1f} Б/токен  "
+              f"{per_token * 10_000_000 / 2 ** 20:8.1f} МБ на 10 млн токенов  (токенов {len(tokens)})")
+        del tokens
+
+
+def bench_relex(size_mb: float):
+    """
+    Задержка повторного анализа после правки в зависимости от размера документа
+    """
+    lexer = LexicalAnalyzer()
+    rng = random.Random(0)
+    # Правки не оставляют незакрытого комментария: он по праву требует разбора до конца текста
+    edits = [("x", 0), ("", 1), ("/* c */", 0), ("", 2), (";", 0), ("1", 0)]
+    plain = SAMPLE_PROGRAM.replace("$", "").replace("/* comment */", "")
+    # Комментарии и лексические ошибки по всему документу: правка не должна переписывать их хвост
+    samples = [("без комментариев", plain), ("с комментариями", plain.replace(";", "; /* c */")),
+               ("с ошибками", plain.replace("let x", "let $x"))]
+    for label, sample in samples:
+        print(f"  {label}:")
+        for fraction in (0.01, 0.1, 1.0):
+            document = TokenDocument(make_source(size_mb * fraction, sample), lexer)
+            start = time.perf_counter()
+            count = 300
+            for _ in range(count):
+                offset = rng.randrange(len(document) - 2)
+                inserted, removed = rng.choice(edits)
+                if "/" in document.substring(offset, offset + removed) or "*" in document.substring(offset, offset + removed):
+                    continue
+                document.edit(offset, removed, inserted)
+            elapsed = (time.perf_counter() - start) / count
+            assert repr(lexer.tokenize(document.text)) == repr((document.tokens, document.errors))
+            print(f"    {len(document.text) / 2 ** 20:8.2f} МБ  {elapsed * 1000:8.3f} мс на правку")
+
+
+def bench_parallel(size_mb: float):
+    """
+    Параллельный анализ фрагментов в пуле процессов против последовательного
+    """
+    program = make_source(size_mb)
+    lexer = LexicalAnalyzer()
+    (serial, serial_errors), serial_time = timed(lexer.tokenize_buffer, program)
+    workers = os.cpu_count() or 1
+    (parallel, parallel_errors), parallel_time = timed(lexer.tokenize_parallel, program, workers)
+    assert serial.kinds == parallel.kinds and serial.starts == parallel.starts and serial.ends == parallel.ends
+    assert serial_errors == parallel_errors
+    print(f"  последовательно:    {serial_time:8.3f} с")
+    print(f"  процессов {workers:3}:      {parallel_time:8.3f} с  (x{serial_time / parallel_time:.1f})")
+
+    # Запуск процесса без fork (spawn): сборка ДКА против загрузки сохраненных таблиц
+    dfa = LexicalAnalyzer("dfa")
+    (dfa_parallel, _), dfa_time = timed(dfa.tokenize_parallel, program, workers)
+    assert dfa_parallel.kinds == serial.kinds and dfa_parallel.starts == serial.starts
+    path = lexer_tables_path(dfa.token_specification)
+    context = multiprocessing.get_context("spawn")
+    for label, tables in (("сборка ДКА", None), ("загрузка таблиц", path)):
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            startup = pool.submit(dfa_startup, tables).result()
+        print(f"  запуск процесса, {label:15} {startup * 1000:7.2f} мс")
+    print(f"  dfa, процессов {workers:3}: {dfa_time:8.3f} с")
+
+
+def dfa_startup(path: Optional[str]) -> float:
+    """
+    Подготовка ДКА-лексера в новом процессе: сборка таблиц или их загрузка из path
+    """
+    start = time.perf_counter()
+    if path is not None:
+        load_lexer_tables(path)
+    LexicalAnalyzer("dfa")
+    return time.perf_counter() - start
+
+
+def bench_comments(size_mb: float):
+    """
+    Незакрытые комментарии: прежнее правило перебирало остаток строки
+    от каждого '/*' (квадратичное время), новое находит конец один раз
+    """
+    lexer = LexicalAnalyzer()
+    legacy = LexicalAnalyzer(token_specification=[
+        ("COMMENT", r'/\*.*?\*/') if name == "COMMENT" else (name, pattern)
+        for name, pattern in lexer.token_specification if name != "UNCLOSED_COMMENT"
+    ])
+    for size_kb in (8, 16, 32):
+        program = "/* " * (size_kb * 1024 // 3)  # Одна строка без "*/"
+        (old_tokens, _), old_time = timed(legacy.tokenize, program)
+        (_, new_errors), new_time = timed(lexer.tokenize, program)
+        (_, dfa_errors), dfa_time = timed(LexicalAnalyzer("dfa").tokenize, program)
+        assert new_errors == dfa_errors == ["Незакрытый комментарий (строка 1, столбец 1)"]
+        print(f"  {size_kb:3} КБ  прежнее {old_time:8.3f} с ({len(old_tokens)} ложных токенов)  "
+              f"новое {new_time:8.4f} с  dfa {dfa_time:8.4f} с")
+    # Многострочный комментарий большого размера разбирается за один просмотр
+    program = "{ /*" + "\n" * int(size_mb * 1024 * 1024) + "*/ }"
+    (tokens, _), elapsed = timed(lexer.tokenize, program)
+    assert len(tokens) == 2
+    print(f"  многострочный комментарий {size_mb:g} МБ: {elapsed:8.3f} с")
+
+
+def bench_keywords(size_mb: float):
+    """
+    Ключевые слова: альтернатива KEYWORD перед IDENTIFIER против одного правила
+    для слов и поиска в словаре; строки идентификаторов с интернированием и без
+    него, имена лексера - те же объекты, что ключи таблицы символов
+    """
+    # Имена длиннее одного символа: однобуквенные строки CPython разделяет и без интернирования
+    sample = SAMPLE_PROGRAM.replace("$", "").replace("x", "count").replace("y", "total")
+    program = make_source(size_mb, sample)
+    lexer = LexicalAnalyzer()
+    specification = []
+    for name, pattern in lexer.token_specification:
+        if name == "IDENTIFIER":
+            specification.append(("KEYWORD", r'\b(let|if|then|else|for|do|while|loop|input|output)\b'))
+        specification.append((name, pattern))
+    legacy = LexicalAnalyzer(token_specification=specification)
+    for name, analyzer in (("KEYWORD + IDENTIFIER", legacy), ("IDENTIFIER + словарь", lexer)):
+        _, elapsed = timed(analyzer.tokenize, program)
+        tracemalloc.start()
+        tokens, _ = analyzer.tokenize(program)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  {name:22} {elapsed:8.3f} с  {current / 2 ** 20:8.1f} МБ")
+        del tokens
+    # Строки имен: интернированные значения лексера против среза текста на каждое
+    # вхождение - так имена выглядели бы без интернирования (match.group())
+    tokens, _ = lexer.tokenize(program)
+    identifiers = [token for token in tokens if token[0] == IDENTIFIER]
+    names = [token[1] for token in identifiers]
+    copies = [program[start:start + len(value)] for _, value, start in identifiers]
+    assert copies == names
+    for label, values in (("интернирование", names), ("без интернирования", copies)):
+        distinct = {id(value): value for value in values}
+        size = sum(map(sys.getsizeof, distinct.values()))
+        print(f"  {label:22} строк имен {len(distinct):7} на {len(values)} вхождений, {size / 2 ** 20:6.2f} МБ")
+    # Все вхождения имени - один объект, и он же ключ таблицы символов
+    assert len({id(value) for value in names}) == len(set(names))
+    shared = {value: value for value in names}
+    symbol_table = SyntaxAnalyzer(lexer.tokenize(sample)[0]).parse()["symbol_table"]
+    assert symbol_table and all(shared[key] is key for key in symbol_table)
+    del tokens, identifiers, names, copies
+    # Словесные операции теперь распознаются, раньше их перехватывал IDENTIFIER
+    assert token_view(lexer.tokenize("a or b and not c")[0]) == [
+        ("IDENTIFIER", "a"), ("ADD_OP", "or"), ("IDENTIFIER", "b"), ("MUL_OP", "and"),
+        ("UNARY_OP", "not"), ("IDENTIFIER", "c")]
+
+
+def bench_numpy(size_mb: float):
+    """
+    Векторный предварительный проход NumPy против regex при заполнении TokenBuffer
+    """
+    try:
+        check_engines("numpy")
+    except ImportError:
+        print("  numpy не установлен, замер пропущен")
+        return
+    # Образец с числами, комментариями и ошибками и сгенерированный текст из длинных имен
+    rng = random.Random(0)
+    names = ["counter_value", "total_amount", "index_position", "result_buffer", "flag_state"]
+    generated = "".join(f"    {rng.choice(names)}{i % 97} = {rng.choice(names)} + {i};\n" for i in range(2000))
+    for title, chunk in (("образец", SAMPLE_PROGRAM), ("длинные имена", "{\n" + generated + "}\n")):
+        program = make_source(size_mb, chunk)
+        results = {}
+        for engine in ("regex", "numpy"):
+            lexer = LexicalAnalyzer(engine)
+            (tokens, errors), elapsed = timed(lexer.tokenize_buffer, program)
+            results[engine] = (tokens, errors)
+            print(f"  {title:14} {engine:6} {elapsed:8.3f} с  {len(tokens) / elapsed / 1e6:6.2f} млн токенов/с")
+        (regex_tokens, regex_errors), (numpy_tokens, numpy_errors) = results["regex"], results["numpy"]
+        assert regex_tokens.kinds == numpy_tokens.kinds and regex_tokens.starts == numpy_tokens.starts
+        assert regex_tokens.ends == numpy_tokens.ends and regex_errors == numpy_errors
+
+
+def bench_cache(size_mb: float):
+    """
+    Кэш потоков токенов: анализ без кэша, промах с записью и попадание через mmap
+    """
+    program = make_source(size_mb)
+    lexer = LexicalAnalyzer()
+    with tempfile.TemporaryDirectory() as directory:
+        cache = TokenCache(directory, lexer=lexer)
+        (tokens, errors), plain_time = timed(lexer.tokenize_buffer, program)
+        _, miss_time = timed(cache.tokenize, program)
+        (cached, cached_errors), hit_time = timed(cache.tokenize, program)
+        assert cache.hits == 1 and cache.misses == 1
+        assert bytes(cached.kinds) == tokens.kinds.tobytes() and bytes(cached.starts) == tokens.starts.tobytes()
+        assert cached_errors == errors and cached[len(cached) // 2] == tokens[len(tokens) // 2]
+        size = os.path.getsize(cache.path(cache.key(program)))
+        print(f"  без кэша:  {plain_time:8.3f} с")
+        print(f"  промах:    {miss_time:8.3f} с  (файл {size / 2 ** 20:.1f} МБ, {size / len(tokens):.1f} Б/токен)")
+        print(f"  попадание: {hit_time:8.3f} с  (x{plain_time / hit_time:.0f})")
+        del cached
+
+        # Вытеснение: в кэш помещаются два файла, первым уходит давно не использованный
+        small = TokenCache(os.path.join(directory, "lru"), max_bytes=2 * size + size // 2, lexer=lexer)
+        first, second, third = program, program + " ", program + "  "
+        small.tokenize(first)
+        small.tokenize(second)
+        time.sleep(0.01)
+        small.tokenize(first)  # first становится свежее second
+        small.tokenize(third)
+        assert os.path.exists(small.path(small.key(first))) and not os.path.exists(small.path(small.key(second)))
+        print(f"  вытеснение: осталось файлов {len(os.listdir(small.directory))}")
+
+
+def make_dialect(engine: str) -> LexicalAnalyzer:
+    """
+    Диалект с операцией возведения в степень, операцией <> и ключевым словом until
+    """
+    lexer = LexicalAnalyzer(engine)
+    lexer.register_rule("POW_OP", r'\*\*', before="MUL_OP")
+    lexer.register_rule("NE_OP", r'<>', before="REL_OP")
+    return lexer.register_keyword("until")
+
+
+def bench_dialects(size_mb: float):
+    """
+    Переключение диалектов: первая сборка против повторных с кэшем по отпечатку
+    """
+    # Проверка приоритетов строит ДКА, поэтому первая сборка dfa уже находит его в кэше
+    for engine in ("regex", "dfa"):
+        _, first_time = timed(make_dialect, engine)
+        count = 1000
+        start = time.perf_counter()
+        for _ in range(count):
+            dialect = make_dialect(engine)
+            base = LexicalAnalyzer(engine)
+        switch_time = (time.perf_counter() - start) / count
+        print(f"  {engine:6} первая сборка {first_time * 1000:8.2f} мс  переключение {switch_time * 1000:8.3f} мс")
+    assert token_view(dialect.tokenize("x ** 2 <> y until")[0])[1::2] == [("POW_OP", "**"), ("NE_OP", "<>"),
+                                                                           ("KEYWORD", "until")]
+    assert token_view(base.tokenize("x ** 2")[0])[1:3] == [("MUL_OP", "*"), ("MUL_OP", "*")]
+    try:
+        LexicalAnalyzer().register_rule("POW_OP", r'\*\*')  # После MUL_OP правило не сработает
+    except ValueError as e:
+        print(f"  конфликт приоритетов: {e}")
+
+
+def bench_expressions(size_mb: float):
+    """
+    Разбор выражений с 10^4..10^6 операциями: время должно расти линейно,
+    глубина рекурсии от длины выражения не зависит
+    """
+    lexer = LexicalAnalyzer()
+    operators = ["<", "+", "*", "-", "or", "and", "/", ">="]
+    for count in (10 ** 4, 10 ** 5, 10 ** 6):
+        parts = ["x0"]
+        for i in range(1, count + 1):
+            operator = operators[i % len(operators)]
+            operand = f"not x{i % 10}" if i % 7 == 0 else f"(x{i % 10} + {i})" if i % 5 == 0 else str(i)
+            parts.append(f" {operator} {operand}")
+        tokens, errors = lexer.tokenize("".join(parts))
+        assert not errors
+        parser = SyntaxAnalyzer(tokens)
+        _, elapsed = timed(parser.parse_expression)
+        assert parser.current_token == len(tokens)
+        print(f"  {count:8} операций  {elapsed:8.3f} с  {elapsed / count * 1e6:6.2f} мкс на операцию")
+    # Глубокая вложенность скобок также разбирается без рекурсии
+    depth = 10 ** 5
+    tokens, _ = lexer.tokenize("(" * depth + "x" + ")" * depth)
+    _, elapsed = timed(SyntaxAnalyzer(tokens).parse_expression)
+    print(f"  скобки глубины {depth}: {elapsed:8.3f} с")
+
+
+def tree_signature(root) -> List[tuple]:
+    """
+    Плоская запись дерева для сравнения: тип, границы и значения полей-листьев
+    """
+    return [(type(node).__name__, node.start, node.end,
+             tuple(value for value in (getattr(node, name) for name in node.fields)
+                   if not hasattr(value, "fields") and not isinstance(value, list)))
+            for node in iter_nodes(root)]
+
+
+def nested_program(depth: int) -> str:
+    """
+    Программа с depth вложенными уровнями: чередуются блоки, if и do-while
+    """
+    openings = ["{ ", "if x < 1 then { ", "do { "]
+    closings = ["} ", "} else { output x; } ", "} while x < 2 "]
+    levels = [i % 3 for i in range(depth)]
+    return ("{ let x = 1; " + "".join(openings[level] for level in levels) + "output x; "
+            + "".join(closings[level] for level in reversed(levels)) + "}")
+
+
+def bench_nesting(size_mb: float):
+    """
+    Глубоко вложенные операторы: рекурсивный спуск против явного стека состояний
+    """
+    lexer = LexicalAnalyzer()
+    limit = sys.getrecursionlimit()
+    for depth in (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6):
+        tokens, _ = lexer.tokenize(nested_program(depth))
+        stack_result, stack_time = timed(SyntaxAnalyzer(tokens, mode="stack").parse)
+        assert stack_result["success"], stack_result
+        # Рекурсивному спуску нужно поднять предел рекурсии: до трех кадров на уровень
+        sys.setrecursionlimit(max(limit, 3 * depth + 100))
+        try:
+            recursive_result, recursive_time = timed(SyntaxAnalyzer(tokens).parse)
+            assert recursive_result["symbol_table"] == stack_result["symbol_table"]
+            assert tree_signature(recursive_result["tree"]) == tree_signature(stack_result["tree"])
+            recursive = f"{recursive_time:8.3f} с"
+        except (RecursionError, MemoryError) as e:
+            recursive = f"{type(e).__name__}"
+        finally:
+            sys.setrecursionlimit(limit)
+        print(f"  глубина {depth:8}  рекурсия {recursive:>14}  стек {stack_time:8.3f} с")
+    tokens, _ = lexer.tokenize(nested_program(10 ** 3))
+    try:
+        SyntaxAnalyzer(tokens).parse()
+        print(f"  при пределе рекурсии {limit} рекурсивный спуск справился с глубиной 1000")
+    except RecursionError:
+        print(f"  при пределе рекурсии {limit} рекурсивный спуск падает уже на глубине 1000")
+
+
+# Узлы-словари с теми же полями, что у классов узлов: так строил бы их прежний разбор
+DICT_NODES = {
+    Program: lambda body, start, end: {"type": "Program", "body": body, "start": start, "end": end},
+    Let: lambda name, value, start, end: {"type": "Let", "name": name, "value": value, "start": start, "end": end},
+    Assign: lambda name, value, start, end: {"type": "Assign", "name": name, "value": value, "start": start,
+                                             "end": end},
+    Binary: lambda operator, left, right, start, end: {"type": "Binary", "operator": operator, "left": left,
+                                                       "right": right, "start": start, "end": end},
+    Name: lambda name, start, end: {"type": "Name", "name": name, "start": start, "end": end},
+    Number: lambda value, start, end: {"type": "Number", "value": value, "start": start, "end": end},
+}
+
+
+def bench_ast(size_mb: float):
+    """
+    Дерево из ~10^6 узлов: узлы со __slots__ против словарей - память на узел и время создания
+    """
+    statements = 250000  # Assign, Binary, Name, Number на каждый оператор
+    program = "{ let a = 1; " + "a = a + 1; " * statements + "}"
+    tokens, errors = LexicalAnalyzer().tokenize(program)
+    assert not errors
+    result, parse_time = timed(SyntaxAnalyzer(tokens).parse)
+    nodes = list(iter_nodes(result["tree"]))
+    print(f"  разбор: {len(nodes)} узлов за {parse_time:.3f} с")
+    # Аргументы конструкторов; потомки - уже готовые узлы, так что сравнивается только сам узел
+    records = [(type(node), [getattr(node, name) for name in node.fields] + [node.start, node.end])
+               for node in nodes]
+    for label, make in (("__slots__", lambda cls, args: cls(*args)),
+                        ("dict", lambda cls, args: DICT_NODES[cls](*args))):
+        tracemalloc.start()
+        built, elapsed = timed(lambda: [make(cls, args) for cls, args in records])
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        per_node = (size - sys.getsizeof(built)) / len(built)
+        print(f"  {label:9}  {per_node:6.1f} байт на узел  {elapsed / len(built) * 1e9:6.1f} нс на узел")
+        del built
+
+
+def bench_arena(size_mb: float):
+    """
+    Дерево из ~10^6 узлов: объекты узлов против арены из параллельных массивов -
+    пиковая память разбора, время разбора и прохода, считающего использования имен
+    """
+    statements = 250000
+    program = "{ let a = 1; " + "".join(f"v{i % 1000} = a + {i}; " for i in range(statements)) + "}"
+    tokens, errors = LexicalAnalyzer().tokenize_buffer(program)
+    assert not errors
+    tree_result, tree_time = timed(SyntaxAnalyzer(tokens).parse)
+    arena_result, arena_time = timed(SyntaxAnalyzer(tokens).parse_arena)
+    tree, arena = tree_result["tree"], arena_result["arena"]
+    print(f"  узлов: {len(arena)}, массивы арены {arena.nbytes() / 2 ** 20:.1f} МБ, "
+          f"литералов {len(arena.literals)}")
+    for label, parse in (("объекты", SyntaxAnalyzer(tokens).parse), ("арена", SyntaxAnalyzer(tokens).parse_arena)):
+        tracemalloc.start()
+        result = parse()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        print(f"  {label:8} пик памяти разбора {peak / 2 ** 20:7.1f} МБ")
+    tree_uses, tree_pass = timed(lambda: Counter(node.name for node in iter_nodes(tree) if type(node) is Name))
+    arena_uses, arena_pass = timed(lambda: Counter(map(arena.value, arena.select(Name))))
+    assert tree_uses == arena_uses
+    print(f"  объекты: разбор {tree_time:.3f} с, проход {tree_pass:.3f} с")
+    print(f"  арена:   разбор {arena_time:.3f} с, проход {arena_pass:.3f} с")
+    print(f"  разбор в арену / в объекты: {arena_time / tree_time:.2f}")
+
+
+GRAMMAR_STATEMENTS = """
+    if x < y + 1 then { output x * 2; } else { input y; }
+    do { x = x + 1; y = (y - x) / 2; } while x < 100 and not y
+    for i = 1 while 10 { output i; }
+"""
+
+
+def bench_grammar(size_mb: float):
+    """
+    Табличный LL(1)-разбор по декларативной грамматике против рекурсивного
+    спуска и стекового режима: одинаковые деревья, время разбора
+    """
+    assert not MODEL_GRAMMAR.conflict_report(), MODEL_GRAMMAR.conflict_report()
+    grammar, build_time = timed(lambda: Grammar(MODEL_GRAMMAR.start, MODEL_GRAMMAR.productions, MODEL_GRAMMAR.errors))
+    _, table_time = timed(grammar._build_table)
+    print(f"  продукций: {len(grammar.productions)}, FIRST/FOLLOW {build_time * 1e3:.2f} мс, "
+          f"таблица {table_time * 1e3:.2f} мс")
+    program = "{ let x = 1; let y = 2;" + make_source(size_mb / 4, GRAMMAR_STATEMENTS) + "}"
+    tokens, errors = LexicalAnalyzer().tokenize_buffer(program)
+    assert not errors
+    tokens = list(tokens)
+    signatures = []
+    for mode in ("recursive", "stack", "table"):
+        result, elapsed = timed(SyntaxAnalyzer(tokens, mode=mode).parse)
+        assert result["success"], result
+        signatures.append(tree_signature(result["tree"]))
+        print(f"  {mode:9}  {len(tokens)} токенов  {elapsed:8.3f} с  {elapsed / len(tokens) * 1e9:6.0f} нс на токен")
+    assert signatures[0] == signatures[1] == signatures[2]
+
+
+def bench_recovery(size_mb: float):
+    """
+    Файл с 40 синтаксическими ошибками: один проход с восстановлением против
+    40 циклов "исправить первую ошибку и запустить заново"
+    """
+    lexer = LexicalAnalyzer()
+    body = make_source(size_mb / 400, GRAMMAR_STATEMENTS)  # Файл в 10 раз меньше size_mb: перезапусков 40
+    program = "{ let x = 1; let y = 2;" + "".join(body + "let z 3;" for _ in range(40)) + "}"
+    tokens, _ = lexer.tokenize(program)
+    result, elapsed = timed(SyntaxAnalyzer(tokens, recover=True).parse)
+    assert len(result["errors"]) == 40, result["errors"][:3]
+    print(f"  восстановление: {len(result['errors'])} ошибок за один проход, {elapsed:.3f} с")
+    # Каждый перезапуск заново лексирует и разбирает файл до очередной ошибки
+    start = time.perf_counter()
+    for fixed in range(40):
+        source = program.replace("let z 3;", "let z = 3;", fixed)
+        tokens, _ = lexer.tokenize(source)
+        assert not SyntaxAnalyzer(tokens).parse()["success"]
+    elapsed = time.perf_counter() - start
+    print(f"  перезапуски: 40 циклов лексического и синтаксического анализа, {elapsed:.3f} с")
+
+
+def program_chunks(size_mb: float):
+    """
+    Текст программы заданного размера фрагментами, без сборки в одну строку
+    """
+    block = GRAMMAR_STATEMENTS * (STREAM_CHUNK_SIZE // len(GRAMMAR_STATEMENTS))  # Фрагменты размером с чтение файла
+    yield "{ let x = 1; let y = 2;"
+    for _ in range(max(1, int(size_mb * 1024 * 1024) // len(block))):
+        yield block
+    yield "}"
+
+
+def bench_pipeline(size_mb: float):
+    """
+    Потоковый конвейер tokenize_stream -> TokenRing -> iter_program против
+    списка токенов и полного дерева: пиковая память и скорость
+    """
+    lexer = LexicalAnalyzer()
+
+    def streamed(size):
+        parser = SyntaxAnalyzer.from_stream(lexer.tokenize_stream(program_chunks(size)))
+        return sum(1 for _ in parser.iter_program())
+
+    def materialized(size):
+        tokens, _ = lexer.tokenize("".join(program_chunks(size)))
+        return len(SyntaxAnalyzer(tokens).parse()["tree"].body)
+
+    small = size_mb / 10  # Под tracemalloc разбор в разы медленнее
+    for label, run in (("поток", streamed), ("список", materialized)):
+        tracemalloc.start()
+        statements = run(small)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  {label:7} {small:g} МБ: {statements} операторов, пик памяти {peak / 2 ** 20:8.2f} МБ")
+    for label, run in (("поток", streamed), ("список", materialized)):
+        statements, elapsed = timed(run, size_mb)
+        print(f"  {label:7} {size_mb:g} МБ: {statements} операторов за {elapsed:.3f} с ({size_mb / elapsed:.2f} МБ/с)")
+
+
+def statement_end(document: SyntaxDocument, offset: int) -> int:
+    """
+    Смещение сразу после первого ';' не раньше offset, без склейки текста документа
+    """
+    return next(start for code, _, start in document.document.iter_tokens(offset) if code == SEMICOLON) + 1
+
+
+def bench_incremental(size_mb: float):
+    """
+    Правка внутри одного блока { ... } программы в 100 тыс. строк: SyntaxDocument
+    разбирает заново только этот блок против полного разбора после каждой правки.
+    Второй вариант программы - с комментарием на 4 строках из каждых 10
+    """
+    lexer = LexicalAnalyzer()
+    lines = 100_000
+    for label, step in (("без комментариев", "x = x + 1;\n"), ("с комментариями", "x = x + 1; /* шаг */\n")):
+        block = "{\n" + step * 4 + "if x < y then {\n    output x;\n} else {\n    input y;\n}\n}\n"
+        program = "{ let x = 1; let y = 2;\n" + block * (lines // block.count("\n")) + "}"
+        document, build = timed(SyntaxDocument, program, lexer)
+        before = list(document.tree.body)
+        rng = random.Random(0)
+        edits = [" output x;", " x = 2;", " { y = 1; }", " if x < 3 then { input y; }"]
+        count = 2000
+        window = 200  # Задержка по первым и последним window циклам: отложенные сдвиги не должны ее наращивать
+        times = []
+        for _ in range(count):
+            # Вставка после случайного ';' и ее отмена
+            start = time.perf_counter()
+            length = len(document.document)
+            offset = statement_end(document, rng.randrange(length // 2, length - 100))
+            inserted = rng.choice(edits)
+            document.edit(offset, 0, inserted)
+            document.edit(offset, len(inserted), "")
+            offset = statement_end(document, rng.randrange(length - 100))
+            document.edit(offset, 0, inserted)
+            times.append(time.perf_counter() - start)
+        elapsed = sum(times) / (3 * count)
+        first, last = (sum(part) / (3 * window) for part in (times[:window], times[-window:]))
+        _, flush_time = timed(lambda: document.tree)
+        tokens, _ = lexer.tokenize(document.text)
+        full, full_time = timed(SyntaxAnalyzer(tokens).parse)
+        assert tree_signature(full["tree"]) == tree_signature(document.tree)
+        reused = len({id(node) for node in before} & {id(node) for node in document.tree.body})
+        print(f"  {label}: {program.count(chr(10)) + 1} строк, построение {build:.3f} с")
+        print(f"    полный разбор:        {full_time * 1000:9.3f} мс")
+        print(f"    инкрементальная правка: {elapsed * 1000:7.3f} мс, прежних операторов программы {reused} из {len(before)}")
+        print(f"    {3 * count} правок: первые {first * 1000:.3f} мс, последние {last * 1000:.3f} мс, "
+              f"сдвиги в tree {flush_time * 1000:.1f} мс")
+
+
+def bench_parallel_parse(size_mb: float):
+    """
+    Разбор длинной плоской программы в пуле процессов (режим parallel) против
+    рекурсивного спуска: одинаковые дерево и таблица символов, время
+    """
+    program = "{ let x = 1; let y = 2;" + make_source(size_mb / 4, GRAMMAR_STATEMENTS) + "}"
+    tokens, _ = LexicalAnalyzer().tokenize_buffer(program)
+    lines = LineIndex(program)
+    serial, serial_time = timed(SyntaxAnalyzer(tokens, lines).parse)
+    expected = tree_signature(serial["tree"]), repr(serial["symbol_table"])
+    del serial  # Живое первое дерево замедляло бы сборку мусора во втором разборе
+    workers = os.cpu_count() or 1
+    parallel, parallel_time = timed(SyntaxAnalyzer(tokens, lines, mode="parallel", workers=workers).parse)
+    assert (tree_signature(parallel["tree"]), repr(parallel["symbol_table"])) == expected
+    print(f"  последовательно:    {serial_time:8.3f} с  ({len(tokens)} токенов)")
+    print(f"  процессов {workers:3}:      {parallel_time:8.3f} с  (x{serial_time / parallel_time:.1f})")
+
+
+def bench_hash_cons(size_mb: float):
+    """
+    Хэш-консинг выражений: одинаковые подвыражения сгенерированной программы
+    становятся одним объектом. Доля общих узлов, память дерева и время разбора
+    """
+    program = "{ let x = 1; let y = 2;" + make_source(size_mb / 10, GRAMMAR_STATEMENTS) + "}"
+    tokens, _ = LexicalAnalyzer().tokenize(program)
+    for hash_cons in (False, True):
+        parser = SyntaxAnalyzer(tokens, hash_cons=hash_cons)
+        tracemalloc.start()
+        result, elapsed = timed(parser.parse)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert result["success"], result
+        label = "хэш-консинг" if hash_cons else "обычный"
+        print(f"  {label:12} {elapsed:8.3f} с, дерево {memory / 2 ** 20:8.2f} МБ")
+        if hash_cons:
+            statistics = parser.statistics()
+            print(f"  узлов выражений {statistics['expression_nodes']}, новых {statistics['unique_expressions']}, "
+                  f"общих {statistics['dedup_ratio']:.2%}")
+
+
+BENCHMARKS: Dict[str, Callable[[float], None]] = {
+    "single_pass": bench_single_pass,
+    "dfa": bench_dfa,
+    "stream": bench_stream,
+    "mmap": bench_mmap,
+    "token_buffer": bench_token_buffer,
+    "relex": bench_relex,
+    "parallel": bench_parallel,
+    "comments": bench_comments,
+    "keywords": bench_keywords,
+    "numpy": bench_numpy,
+    "cache": bench_cache,
+    "dialects": bench_dialects,
+    "expressions": bench_expressions,
+    "nesting": bench_nesting,
+    "ast": bench_ast,
+    "arena": bench_arena,
+    "grammar": bench_grammar,
+    "recovery": bench_recovery,
+    "pipeline": bench_pipeline,
+    "incremental": bench_incremental,
+    "parallel_parse": bench_parallel_parse,
+    "hash_cons": bench_hash_cons,
+}
+
+
+def main(argv: List[str]):
+    size_mb = 10.0
+    if "--size" in argv:
+        index = argv.index("--size")
+        size_mb = float(argv[index + 1])
+        del argv[index:index + 2]
+    for name in argv or BENCHMARKS:
+        print(f"{name} ({size_mb:g} МБ):")
+        BENCHMARKS[name](size_mb)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,198 +1,4292 @@
 import re
+import bisect
+import gc
+import hashlib
+import heapq
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from collections.abc import Sequence
+from functools import partial
+from itertools import chain, repeat
+from operator import attrgetter, itemgetter
+from sys import intern
 from tabulate import tabulate
-from typing import List, Tuple, Dict, Any, Optional
+from typing import List, Tuple, Dict, Any, Optional, Iterator, Iterable
 
-class LexicalAnalyzer:
+try:
+    import numpy as np
+except ImportError:  # NumPy нужен только движку "numpy"
+    np = None
+
+LEXER_TABLES_VERSION = 3
+
+# Коды токенов. Ключевые слова и разделители получают собственные коды,
+# остальные токены кодируются своим видом
+(NUMBER, BIN_NUMBER, OCT_NUMBER, DEC_NUMBER, HEX_NUMBER, IDENTIFIER,
+ ASSIGN, REL_OP, ADD_OP, MUL_OP, UNARY_OP,
+ LET, IF, THEN, ELSE, FOR, DO, WHILE, LOOP, INPUT, OUTPUT,
+ LBRACE, RBRACE, LPAREN, RPAREN, SEMICOLON, COMMA) = range(27)
+
+KIND_CODES = {
+    "NUMBER": NUMBER, "BIN_NUMBER": BIN_NUMBER, "OCT_NUMBER": OCT_NUMBER, "DEC_NUMBER": DEC_NUMBER,
+    "HEX_NUMBER": HEX_NUMBER, "IDENTIFIER": IDENTIFIER, "ASSIGN": ASSIGN, "REL_OP": REL_OP,
+    "ADD_OP": ADD_OP, "MUL_OP": MUL_OP, "UNARY_OP": UNARY_OP,
+}
+KEYWORD_CODES = {
+    "let": LET, "if": IF, "then": THEN, "else": ELSE, "for": FOR,
+    "do": DO, "while": WHILE, "loop": LOOP, "input": INPUT, "output": OUTPUT,
+}
+DELIMITER_CODES = {"{": LBRACE, "}": RBRACE, "(": LPAREN, ")": RPAREN, ";": SEMICOLON, ",": COMMA}
+# Виды, код которых определяется лексемой
+LEXEME_CODES = {"KEYWORD": KEYWORD_CODES, "DELIMITER": DELIMITER_CODES}
+# Все слова разбираются одним правилом IDENTIFIER, а ключевые слова
+# и словесные операции отделяются от идентификаторов поиском в словаре
+WORD_CODES = {**KEYWORD_CODES, "or": ADD_OP, "and": MUL_OP, "not": UNARY_OP}
+
+# Обратное отображение для вывода: код -> прежнее имя вида и фиксированная лексема
+TOKEN_NAMES = [""] * (COMMA + 1)
+TOKEN_LEXEMES: Dict[int, str] = {}
+for _name, _code in KIND_CODES.items():
+    TOKEN_NAMES[_code] = _name
+for _kind, _codes in LEXEME_CODES.items():
+    for _lexeme, _code in _codes.items():
+        TOKEN_NAMES[_code] = _kind
+        TOKEN_LEXEMES[_code] = _lexeme
+del _name, _code, _kind, _codes, _lexeme
+
+
+def register_token_kind(name: str, code: Optional[int] = None) -> int:
+    """
+    Код вида токенов, который добавил диалект. Без code выделяется следующий
+    свободный код; code задается при переносе диалекта в другой процесс
+    """
+    if name in KIND_CODES:
+        return KIND_CODES[name]
+    if code is None:
+        code = len(TOKEN_NAMES)
+    if code > 255:
+        raise ValueError(f"Нет свободного кода для вида токенов {name}")
+    TOKEN_NAMES.extend([""] * (code + 1 - len(TOKEN_NAMES)))
+    TOKEN_NAMES[code] = name
+    KIND_CODES[name] = code
+    return code
+
+
+def register_lexeme_code(kind: str, lexeme: str) -> int:
+    """
+    Код лексемы вида, код которого определяется лексемой (KEYWORD, DELIMITER);
+    одна и та же лексема во всех диалектах получает один код
+    """
+    codes = LEXEME_CODES[kind]
+    if lexeme in codes:
+        return codes[lexeme]
+    code = len(TOKEN_NAMES)
+    if code > 255:
+        raise ValueError(f"Нет свободного кода для лексемы {lexeme!r} вида {kind}")
+    TOKEN_NAMES.append(kind)
+    TOKEN_LEXEMES[code] = lexeme
+    codes[lexeme] = code
+    return code
+
+
+def register_keyword_code(word: str) -> int:
+    """
+    Код ключевого слова диалекта; одно и то же слово во всех диалектах получает один код
+    """
+    return register_lexeme_code("KEYWORD", word)
+
+
+def token_code(kind: str, lexeme: str, word_codes: Dict[str, int] = WORD_CODES) -> int:
+    """
+    Код токена по имени вида из спецификации и лексеме
+    """
+    if kind == "IDENTIFIER":
+        return word_codes.get(lexeme, IDENTIFIER)
+    codes = LEXEME_CODES.get(kind)
+    return codes[lexeme] if codes is not None else KIND_CODES[kind]
+
+
+# Токен: (код, значение, смещение начала лексемы в тексте)
+Token = Tuple[int, Any, int]
+
+
+def token_view(tokens) -> List[Tuple[str, Any]]:
+    """
+    Представление токенов с именами видов вместо кодов, для вывода
+    """
+    return [(TOKEN_NAMES[token[0]], token[1]) for token in tokens]
+
+
+def describe_token(token: Optional[Token]) -> str:
+    return str((TOKEN_NAMES[token[0]], token[1])) if token is not None else "конец файла"
+
+
+def lexical_error(kind: str, lexeme) -> str:
+    """
+    Текст лексической ошибки без позиции
+    """
+    if kind == "UNCLOSED_COMMENT":
+        return "Незакрытый комментарий"
+    if not isinstance(lexeme, str):
+        lexeme = bytes(lexeme).decode("ascii", "backslashreplace")
+    return f"Неизвестный символ: {lexeme}"
+
+
+class LineIndex:
+    """
+    Индекс начал строк исходного текста для перевода смещений в строку и столбец.
+    Строится при первом запросе позиции, поиск строки - bisect
+    """
+
+    def __init__(self, source):
+        self.source = source  # str или байтовый буфер
+        self.line_starts: Optional[array] = None
+
+    def build(self):
+        newline = _NEWLINE if isinstance(self.source, str) else _NEWLINE_BYTES
+        self.line_starts = array("q", [0])
+        self.line_starts.extend(match.end() for match in newline.finditer(self.source))
+
+    def position(self, offset: int) -> Tuple[int, int]:
+        """
+        Строка и столбец (с единицы) для смещения в тексте
+        """
+        if self.line_starts is None:
+            self.build()
+        line = bisect.bisect_right(self.line_starts, offset)
+        return line, offset - self.line_starts[line - 1] + 1
+
+    def describe(self, offset: int) -> str:
+        line, column = self.position(offset)
+        return f"строка {line}, столбец {column}"
+
+
+class _StreamLines:
+    """
+    Окно потокового анализа: прочитанные фрагменты, начиная с того, в котором
+    начинается незавершенный токен, и счетчик строк в уже отброшенных фрагментах.
+    Фрагменты не склеиваются; срез окна по смещениям от начала текста дает
+    текст токена
+    """
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.starts: List[int] = []  # Смещение начала каждого фрагмента от начала текста
+        self.end = 0  # Смещение конца прочитанного текста
+        self.lines_before = 0  # Строк до первого фрагмента окна
+        self.line_start = 0  # Смещение начала строки, в которой начинается первый фрагмент
+        self.remembered: Tuple[int, str] = (-1, "")  # Смещение и его описание, см. remember
+
+    def append(self, chunk: str):
+        self.chunks.append(chunk)
+        self.starts.append(self.end)
+        self.end += len(chunk)
+
+    def discard(self, offset: int):
+        """
+        Отбрасывает фрагменты, которые целиком лежат до смещения offset
+        """
+        count = bisect.bisect_right(self.starts, offset) - 1
+        for start, chunk in zip(self.starts[:count], self.chunks[:count]):
+            self.lines_before += chunk.count("\n")
+            last = chunk.rfind("\n")
+            if last >= 0:
+                self.line_start = start + last + 1
+        del self.starts[:count]
+        del self.chunks[:count]
+
+    def __getitem__(self, span: slice) -> str:
+        start, stop = span.start, span.stop
+        index = bisect.bisect_right(self.starts, start) - 1
+        base = self.starts[index]
+        if stop <= base + len(self.chunks[index]):
+            return self.chunks[index][start - base:stop - base]
+        parts = [self.chunks[index][start - base:]]
+        for base, chunk in zip(self.starts[index + 1:], self.chunks[index + 1:]):
+            if base >= stop:
+                break
+            parts.append(chunk[:stop - base])
+        return "".join(parts)
+
+    def remember(self, offset: int):
+        """
+        Запоминает строку и столбец смещения offset: его фрагмент может быть отброшен
+        """
+        if self.remembered[0] != offset:
+            self.remembered = (offset, self.describe(offset))
+
+    def describe(self, offset: int) -> str:
+        if offset == self.remembered[0]:
+            return self.remembered[1]
+        index = bisect.bisect_right(self.starts, offset) - 1
+        local = offset - self.starts[index]
+        line = self.lines_before + sum(chunk.count("\n") for chunk in self.chunks[:index])
+        line += self.chunks[index].count("\n", 0, local) + 1
+        start = self.line_start
+        for position in range(index, -1, -1):
+            last = self.chunks[position].rfind("\n", 0, local if position == index else None)
+            if last >= 0:
+                start = self.starts[position] + last + 1
+                break
+        return f"строка {line}, столбец {offset - start + 1}"
+
+
+_NEWLINE = re.compile("\n")
+_NEWLINE_BYTES = re.compile(b"\n")
+
+# Скомпилированные шаблоны лексера, общие для всех экземпляров процесса.
+# Ключ - отпечаток спецификации токенов
+_token_patterns: Dict[str, "re.Pattern[str]"] = {}
+_token_patterns_bytes: Dict[str, "re.Pattern[bytes]"] = {}
+
+
+def spec_fingerprint(token_specification: List[Tuple[str, str]]) -> str:
+    """
+    Отпечаток спецификации токенов (sha256 от имен и шаблонов)
+    """
+    digest = hashlib.sha256(str(LEXER_TABLES_VERSION).encode())
+    for name, regex in token_specification:
+        digest.update(b"\0" + name.encode() + b"\0" + regex.encode())
+    return digest.hexdigest()
+
+
+def compile_token_regex(token_specification: List[Tuple[str, str]]) -> "re.Pattern[str]":
+    """
+    Возвращает общий скомпилированный шаблон для спецификации токенов
+    """
+    fingerprint = spec_fingerprint(token_specification)
+    pattern = _token_patterns.get(fingerprint)
+    if pattern is None:
+        token_regex = '|'.join(f'(?P<{name}>{regex})' for name, regex in token_specification)
+        pattern = _token_patterns[fingerprint] = re.compile(token_regex)
+    return pattern
+
+
+def compile_token_regex_bytes(token_specification: List[Tuple[str, str]]) -> "re.Pattern[bytes]":
+    """
+    То же для байтового режима. \\d, \\s и \\b в байтовых шаблонах понимают только ASCII
+    """
+    fingerprint = spec_fingerprint(token_specification)
+    pattern = _token_patterns_bytes.get(fingerprint)
+    if pattern is None:
+        token_regex = compile_token_regex(token_specification).pattern
+        pattern = _token_patterns_bytes[fingerprint] = re.compile(token_regex.encode("ascii"))
+    return pattern
+
+
+# Правила, которые никогда не срабатывают, по отпечатку спецификации
+_shadowed_rules: Dict[str, List[str]] = {}
+
+
+def shadowed_rules(token_specification: List[Tuple[str, str]]) -> List[str]:
+    """
+    Правила, которые перекрыты более приоритетными: на любом пути ДКА к принятию
+    правила раньше (или в том же состоянии) принимается правило с меньшим номером.
+    Правила с \b принимаются не всегда и поэтому никого не перекрывают
+    """
+    fingerprint = spec_fingerprint(token_specification)
+    if fingerprint in _shadowed_rules:
+        return _shadowed_rules[fingerprint]
+    tables = compile_dfa(token_specification).tables
+    accepts, transitions, class_count = tables["accepts"], tables["transitions"], tables["class_count"]
+    bounded = [before or after for before, after in zip(tables["bound_before"], tables["bound_after"])]
+    never = len(token_specification)
+    blocking = [min((rule for rule in rules if not bounded[rule]), default=never) for rules in accepts]
+    # Для каждого состояния - наибольший по путям минимум blocking вдоль пути
+    widest = [-1] * len(accepts)
+    widest[1] = never
+    heap = [(-never, 1)]
+    while heap:
+        width, state = heapq.heappop(heap)
+        width = -width
+        if width < widest[state]:
+            continue
+        for target in set(transitions[state * class_count:(state + 1) * class_count]):
+            if target and min(width, blocking[target]) > widest[target]:
+                widest[target] = min(width, blocking[target])
+                heapq.heappush(heap, (-widest[target], target))
+    winners = {rule for state, rules in enumerate(accepts) for rule in rules if widest[state] >= rule}
+    shadowed = _shadowed_rules[fingerprint] = [
+        name for index, (name, _) in enumerate(token_specification) if index not in winners
+    ]
+    return shadowed
+
+
+def validate_token_specification(token_specification: List[Tuple[str, str]],
+                                 previous: Optional[List[Tuple[str, str]]] = None):
+    """
+    Проверка спецификации диалекта: имена, шаблоны и приоритеты. Если задана
+    прежняя спецификация, ошибкой считаются только новые перекрытия правил
+    """
+    names = [name for name, _ in token_specification]
+    for name, regex in token_specification:
+        if not name.isidentifier() or names.count(name) > 1:
+            raise ValueError(f"Недопустимое или повторное имя правила: {name}")
+        try:
+            pattern = re.compile(regex)
+        except re.error as e:
+            raise ValueError(f"Ошибка в шаблоне правила {name}: {e}") from None
+        if pattern.fullmatch(""):
+            raise ValueError(f"Правило {name} совпадает с пустой строкой")
+        for early, late in alternation_conflicts(regex):
+            raise ValueError(f"Правило {name}: ветвь {early!r} совпадает с началом более поздней ветви {late!r}; "
+                             f"re выберет первую, ДКА - самую длинную. Поставьте более длинную ветвь раньше")
+        if name in LEXEME_CODES and rule_lexemes(regex) is None:
+            # Каждая лексема такого вида получает собственный код токена
+            raise ValueError(f"Правило {name} должно задавать конечный набор лексем "
+                             f"(не больше {LEXEME_RULE_MAX})")
+    conflicts = set(shadowed_rules(token_specification))
+    if previous is not None:
+        conflicts -= set(shadowed_rules(previous))
+    if conflicts:
+        raise ValueError(f"Правила перекрыты более приоритетными и никогда не сработают: "
+                         f"{', '.join(name for name in names if name in conflicts)}")
+
+
+def save_lexer_tables(path: str, token_specification: List[Tuple[str, str]]) -> str:
+    """
+    Сохраняет таблицы ДКА лексера в файл, чтобы рабочие процессы и короткие
+    запуски не собирали их заново. Шаблон re не сохраняется: его компиляция
+    дешевле чтения. Файл заменяется целиком. Возвращает отпечаток спецификации
+    """
+    fingerprint = spec_fingerprint(token_specification)
+    tables = {
+        "version": LEXER_TABLES_VERSION,
+        "fingerprint": fingerprint,
+        "specification": [list(spec) for spec in token_specification],
+        "dfa": compile_dfa(token_specification).tables,
+    }
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        marshal.dump(tables, f)
+    os.replace(temporary, path)
+    return fingerprint
+
+
+def load_lexer_tables(path: str, fingerprint: Optional[str] = None) -> Optional[str]:
+    """
+    Загружает таблицы ДКА из файла в кэш процесса. Если ожидаемый отпечаток
+    уже в кэше (процесс унаследовал его при fork), файл не читается.
+    Возвращает отпечаток или None, если файл отсутствует или устарел
+    """
+    if fingerprint is not None and fingerprint in _dfa_scanners:
+        return fingerprint
+    try:
+        with open(path, "rb") as f:
+            tables = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(tables, dict) or tables.get("version") != LEXER_TABLES_VERSION:
+        return None
+    specification = [tuple(spec) for spec in tables["specification"]]
+    found = spec_fingerprint(specification)
+    if found != tables["fingerprint"] or fingerprint not in (None, found):
+        return None
+    if found not in _dfa_scanners:
+        _dfa_scanners[found] = DFAScanner(tables["dfa"])
+    return found
+
+
+def lexer_tables_path(token_specification: List[Tuple[str, str]]) -> str:
+    """
+    Файл таблиц ДКА спецификации во временном каталоге; сохраняется при первом запросе
+    """
+    path = os.path.join(tempfile.gettempdir(), f"lexer-tables-{spec_fingerprint(token_specification)[:16]}.marshal")
+    if not os.path.exists(path):
+        save_lexer_tables(path, token_specification)
+    return path
+
+
+# ---------------------------------------------------------------------------
+# Табличный ДКА-движок лексера
+# ---------------------------------------------------------------------------
+
+# Категории символов в том же смысле, что и у модуля re для str
+_CATEGORIES = {
+    "d": lambda props: props[0], "D": lambda props: not props[0],
+    "s": lambda props: props[1], "S": lambda props: not props[1],
+    "w": lambda props: props[2], "W": lambda props: not props[2],
+}
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v"}
+_WORD_SET = (False, (), frozenset("w"))
+_PROPS_COMBINATIONS = [(d, s, w) for d in (False, True) for s in (False, True) for w in (False, True)]
+
+# Кэш ДКА-сканеров процесса, ключ - отпечаток спецификации
+_dfa_scanners: Dict[str, "DFAScanner"] = {}
+
+
+def _char_props(char: str) -> Tuple[bool, bool, bool]:
+    return char.isdecimal(), char.isspace(), char.isalnum() or char == "_"
+
+
+def _charset_contains(charset, code: int, props: Tuple[bool, bool, bool]) -> bool:
+    negated, ranges, categories = charset
+    found = any(lo <= code <= hi for lo, hi in ranges) or any(_CATEGORIES[c](props) for c in categories)
+    return found != negated
+
+
+class _RegexParser:
+    """
+    Разбор подмножества синтаксиса re, достаточного для спецификации токенов:
+    литералы, классы [...], '.', \\d \\s \\w, группы, '|', квантификаторы
+    (в том числе ленивые) и \\b в начале или конце правила
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+        self.alternations: List[List[Tuple[int, int]]] = []  # Границы ветвей каждой '|' в шаблоне
+
+    def error(self, message: str):
+        return ValueError(f"ДКА-движок: {message} в шаблоне {self.pattern!r} (позиция {self.pos})")
+
+    def peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def parse(self):
+        node = self.parse_alternation()
+        if self.pos != len(self.pattern):
+            raise self.error("лишняя ')'")
+        return node
+
+    def parse_alternation(self):
+        start = self.pos
+        branches = [self.parse_sequence()]
+        spans = [(start, self.pos)]
+        while self.peek() == "|":
+            self.pos += 1
+            start = self.pos
+            branches.append(self.parse_sequence())
+            spans.append((start, self.pos))
+        if len(branches) == 1:
+            return branches[0]
+        self.alternations.append(spans)
+        return ("alt", branches)
+
+    def parse_sequence(self):
+        items = []
+        while self.peek() not in (None, "|", ")"):
+            atom = self.parse_atom()
+            items.append(self.parse_quantifier(atom))
+        return ("cat", items)
+
+    def parse_quantifier(self, atom):
+        char = self.peek()
+        if char == "*":
+            low, high = 0, None
+        elif char == "+":
+            low, high = 1, None
+        elif char == "?":
+            low, high = 0, 1
+        elif char == "{":
+            end = self.pattern.find("}", self.pos)
+            bounds = self.pattern[self.pos + 1:end].split(",") if end > 0 else []
+            if not 1 <= len(bounds) <= 2 or not bounds[0].isdigit():
+                raise self.error("неподдерживаемый квантификатор")
+            low = int(bounds[0])
+            high = low if len(bounds) == 1 else (int(bounds[1]) if bounds[1] else None)
+            self.pos = end
+        else:
+            return atom
+        self.pos += 1
+        lazy = self.peek() == "?"
+        if lazy:
+            self.pos += 1
+        if atom[0] == "bound":
+            raise self.error("квантификатор после \\b")
+        return ("rep", atom, low, high, lazy)
+
+    def parse_atom(self):
+        char = self.pattern[self.pos]
+        self.pos += 1
+        if char == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            elif self.pattern.startswith("?P<", self.pos):
+                self.pos = self.pattern.index(">", self.pos) + 1
+            elif self.peek() == "?":
+                raise self.error("неподдерживаемая группа")
+            node = self.parse_alternation()
+            if self.peek() != ")":
+                raise self.error("незакрытая группа")
+            self.pos += 1
+            return node
+        if char == "[":
+            return ("set", self.parse_class())
+        if char == ".":
+            return ("set", (True, ((10, 10),), frozenset()))
+        if char == "\\":
+            escape = self.pattern[self.pos]
+            self.pos += 1
+            if escape == "b":
+                return ("bound",)
+            return ("set", self.escape_set(escape))
+        if char in "*+?{":
+            raise self.error("квантификатор без операнда")
+        if char in "^$":
+            # re понимает их как якоря, а не как символы
+            raise self.error(f"якорь {char} не поддерживается")
+        return ("set", (False, ((ord(char), ord(char)),), frozenset()))
+
+    def escape_set(self, escape: str):
+        if escape in _CATEGORIES:
+            return (False, (), frozenset(escape))
+        if escape in _ESCAPES:
+            code = ord(_ESCAPES[escape])
+        elif escape.isalnum():
+            raise self.error(f"неподдерживаемая последовательность \\{escape}")
+        else:
+            code = ord(escape)
+        return (False, ((code, code),), frozenset())
+
+    def parse_class(self):
+        negated = self.peek() == "^"
+        if negated:
+            self.pos += 1
+        ranges = []
+        categories = set()
+        first = True
+        while True:
+            char = self.peek()
+            if char is None:
+                raise self.error("незакрытый класс символов")
+            if char == "]" and not first:
+                self.pos += 1
+                break
+            first = False
+            self.pos += 1
+            if char == "\\":
+                escape = self.pattern[self.pos]
+                self.pos += 1
+                if escape in _CATEGORIES:
+                    categories.add(escape)
+                    continue
+                char = chr(self.escape_set(escape)[1][0][0])
+            low = ord(char)
+            if self.peek() == "-" and self.pattern[self.pos + 1:self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                high_char = self.pattern[self.pos]
+                self.pos += 1
+                if high_char == "\\":
+                    high_char = chr(self.escape_set(self.pattern[self.pos])[1][0][0])
+                    self.pos += 1
+                ranges.append((low, ord(high_char)))
+            else:
+                ranges.append((low, low))
+        return (negated, tuple(sorted(ranges)), frozenset(categories))
+
+
+def order_alternations(regex: str) -> str:
+    """
+    Переставляет ветви '|', каждая из которых - одна строка, от длинных
+    к коротким: тогда первая совпавшая ветвь re - самая длинная, как у ДКА
+    """
+    parser = _RegexParser(regex)
+    parser.parse()
+    for spans in parser.alternations:
+        branches = [regex[start:end] for start, end in spans]
+        strings = [rule_lexemes(branch) for branch in branches]
+        if all(lexemes is not None and len(lexemes) == 1 for lexemes in strings):
+            # Длина текста ветвей не меняется, поэтому границы остальных '|' остаются верными
+            ordered = [branch for _, branch in sorted(zip(strings, branches), key=lambda item: -len(item[0][0]))]
+            regex = regex[:spans[0][0]] + "|".join(ordered) + regex[spans[-1][1]:]
+    return regex
+
+
+def alternation_conflicts(regex: str) -> List[Tuple[str, str]]:
+    """
+    Пары ветвей '|' (ранняя, поздняя), на которых re и ДКА могут разойтись:
+    re берет первую совпавшую ветвь, ДКА - самое длинное совпадение. Расхождение
+    возможно, если строка ранней ветви - начало более длинной строки поздней.
+    Продолжение шаблона после '|' не учитывается, так что проверка строже, чем нужно
+    """
+    parser = _RegexParser(regex)
+    parser.parse()
+    conflicts = []
+    for spans in parser.alternations:
+        branches = [regex[start:end] for start, end in spans]
+        # Ветвь, совпадающая с пустой строкой, - начало любой строки поздних ветвей
+        empty = [re.fullmatch(branch, "") is not None for branch in branches]
+        pairs = {(early, late) for early in range(len(branches)) if empty[early]
+                 for late in range(early + 1, len(branches))}
+        rules = [index for index in range(len(branches)) if not empty[index]]
+        tables = build_dfa_tables([(f"B{index}", branches[index]) for index in rules])
+        accepts, transitions, class_count = tables["accepts"], tables["transitions"], tables["class_count"]
+        later = [set() for _ in accepts]  # Ветви, принимаемые хотя бы через один переход
+        changed = True
+        while changed:
+            changed = False
+            for state in range(1, len(accepts)):
+                reachable = set()
+                for target in set(transitions[state * class_count:(state + 1) * class_count]):
+                    if target:
+                        reachable.update(accepts[target])
+                        reachable |= later[target]
+                if not reachable <= later[state]:
+                    later[state] |= reachable
+                    changed = True
+        pairs |= {(rules[early], rules[late]) for state, accepted in enumerate(accepts)
+                  for early in accepted for late in later[state] if late > early}
+        conflicts.extend((branches[early], branches[late]) for early, late in sorted(pairs))
+    return conflicts
+
+
+# Сколько лексем может задавать правило вида с кодами по лексемам
+LEXEME_RULE_MAX = 64
+
+
+def rule_lexemes(regex: str, limit: int = LEXEME_RULE_MAX) -> Optional[List[str]]:
+    """
+    Все строки, с которыми совпадает шаблон, в порядке сортировки, или None,
+    если их бесконечно много или больше limit. \\b на набор строк не влияет
+    """
+    def language(node) -> Optional[set]:
+        kind = node[0]
+        if kind == "bound":
+            return {""}
+        if kind == "set":
+            negated, ranges, categories = node[1]
+            if negated or categories or sum(high - low + 1 for low, high in ranges) > limit:
+                return None
+            return {chr(code) for low, high in ranges for code in range(low, high + 1)}
+        if kind == "alt":
+            result = set()
+            for branch in node[1]:
+                strings = language(branch)
+                if strings is None:
+                    return None
+                result |= strings
+        elif kind == "cat":
+            result = {""}
+            for item in node[1]:
+                strings = language(item)
+                if strings is None or len(result) * len(strings) > limit:
+                    return None
+                result = {head + tail for head in result for tail in strings}
+        else:  # rep
+            _, atom, low, high, _ = node
+            strings = language(atom)
+            if strings is None:
+                return None
+            if high is None:
+                return {""} if strings <= {""} else None
+            result = set()
+            power = {""}
+            for count in range(high + 1):
+                if count >= low:
+                    result |= power
+                if count < high:
+                    if len(power) * len(strings) > limit:
+                        return None
+                    power = {head + tail for head in power for tail in strings}
+        return result if len(result) <= limit else None
+
+    strings = language(_RegexParser(regex).parse())
+    return sorted(strings) if strings is not None else None
+
+
+class _NFA:
     def __init__(self):
+        self.epsilon: List[List[int]] = []
+        self.edges: List[List[Tuple[int, int]]] = []
+        self.charsets: Dict[Any, int] = {}
+
+    def new_state(self) -> int:
+        self.epsilon.append([])
+        self.edges.append([])
+        return len(self.epsilon) - 1
+
+    def emit(self, node, start: int) -> int:
+        """
+        Строит фрагмент автомата по Томпсону, возвращает конечное состояние
+        """
+        kind = node[0]
+        if kind == "set":
+            end = self.new_state()
+            charset = self.charsets.setdefault(node[1], len(self.charsets))
+            self.edges[start].append((charset, end))
+            return end
+        if kind == "cat":
+            for item in node[1]:
+                start = self.emit(item, start)
+            return start
+        if kind == "alt":
+            end = self.new_state()
+            for branch in node[1]:
+                branch_start = self.new_state()
+                self.epsilon[start].append(branch_start)
+                self.epsilon[self.emit(branch, branch_start)].append(end)
+            return end
+        if kind == "rep":
+            _, item, low, high, _ = node
+            for _ in range(low):
+                start = self.emit(item, start)
+            if high is None:
+                loop = self.new_state()
+                self.epsilon[start].append(loop)
+                self.epsilon[self.emit(item, loop)].append(loop)
+                return loop
+            for _ in range(high - low):
+                end = self.new_state()
+                self.epsilon[start].append(end)
+                self.epsilon[self.emit(item, start)].append(end)
+                start = end
+            return start
+        raise ValueError("ДКА-движок: \\b допускается только в начале или конце правила")
+
+    def closure(self, states) -> frozenset:
+        stack = list(states)
+        seen = set(stack)
+        while stack:
+            for target in self.epsilon[stack.pop()]:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+
+def _is_lazy(node) -> bool:
+    if node[0] == "rep":
+        return node[4] or _is_lazy(node[1])
+    if node[0] in ("cat", "alt"):
+        return any(_is_lazy(item) for item in node[1])
+    return False
+
+
+def build_dfa_tables(token_specification: List[Tuple[str, str]]) -> Dict[str, Any]:
+    """
+    Строит таблицы ДКА по спецификации токенов.
+
+    Семантика совпадает с re: побеждает первое по порядку правило, которое
+    совпадает в текущей позиции, а его длина - самое длинное совпадение
+    (самое короткое, если в правиле есть ленивый квантификатор).
+    Результат состоит только из встроенных типов и сохраняется через marshal
+    """
+    nfa = _NFA()
+    start = nfa.new_state()
+    accepting: Dict[int, int] = {}
+    kinds, lazy, bound_before, bound_after = [], [], [], []
+    for index, (name, regex) in enumerate(token_specification):
+        node = _RegexParser(regex).parse()
+        items = list(node[1]) if node[0] == "cat" else [node]
+        before = bool(items) and items[0][0] == "bound"
+        if before:
+            items.pop(0)
+        after = bool(items) and items[-1][0] == "bound"
+        if after:
+            items.pop()
+        rule_start = nfa.new_state()
+        nfa.epsilon[start].append(rule_start)
+        accepting[nfa.emit(("cat", items), rule_start)] = index
+        kinds.append(name)
+        lazy.append(_is_lazy(node))
+        bound_before.append(before)
+        bound_after.append(after)
+
+    # Разбиение алфавита на классы эквивалентности. Для символов вне ASCII
+    # класс зависит только от интервала между границами диапазонов и от \d \s \w
+    charsets = sorted(nfa.charsets, key=nfa.charsets.get) + [_WORD_SET]
+    class_ids: Dict[Tuple[bool, ...], int] = {}
+    signatures: List[Tuple[bool, ...]] = []
+
+    def class_of(code: int, props: Tuple[bool, bool, bool]) -> int:
+        signature = tuple(_charset_contains(charset, code, props) for charset in charsets)
+        if signature not in class_ids:
+            class_ids[signature] = len(signatures)
+            signatures.append(signature)
+        return class_ids[signature]
+
+    ascii_classes = bytes(class_of(code, _char_props(chr(code))) for code in range(128))
+    class_starts = sorted({128} | {bound for charset in charsets for lo, hi in charset[1]
+                                   for bound in (lo, hi + 1) if bound > 128})
+    class_lookup = {(interval, d, s, w): class_of(interval_start, (d, s, w))
+                    for interval, interval_start in enumerate(class_starts)
+                    for d, s, w in _PROPS_COMBINATIONS}
+    class_count = len(signatures)
+    if class_count > 255:
+        raise ValueError("ДКА-движок: слишком много классов символов")
+
+    # Построение подмножеств; состояние 0 - тупиковое, 1 - начальное
+    initial = nfa.closure([start])
+    states = [frozenset(), initial]
+    numbers = {frozenset(): 0, initial: 1}
+    transitions: List[int] = [0] * class_count
+    accepts: List[Tuple[int, ...]] = [()]
+    index = 1
+    while index < len(states):
+        current = states[index]
+        accepts.append(tuple(sorted(accepting[s] for s in current if s in accepting)))
+        for cls in range(class_count):
+            signature = signatures[cls]
+            targets = [target for s in current for charset, target in nfa.edges[s] if signature[charset]]
+            if not targets:
+                transitions.append(0)
+                continue
+            target_set = nfa.closure(targets)
+            if target_set not in numbers:
+                numbers[target_set] = len(states)
+                states.append(target_set)
+            transitions.append(numbers[target_set])
+        index += 1
+    if accepts[1]:
+        raise ValueError("ДКА-движок: правило совпадает с пустой строкой")
+
+    # Наименьший номер правила, достижимый хотя бы за один переход
+    unreachable = len(kinds)
+    future_min = [unreachable] * len(states)
+    changed = True
+    while changed:
+        changed = False
+        for state in range(1, len(states)):
+            best = future_min[state]
+            for target in transitions[state * class_count:(state + 1) * class_count]:
+                if target:
+                    best = min(best, future_min[target], accepts[target][0] if accepts[target] else unreachable)
+            if best < future_min[state]:
+                future_min[state] = best
+                changed = True
+
+    return {
+        "kinds": kinds,
+        "lazy": lazy,
+        "bound_before": bound_before,
+        "bound_after": bound_after,
+        "ascii_classes": ascii_classes,
+        "class_starts": class_starts,
+        "class_lookup": class_lookup,
+        "class_word": bytes(signature[-1] for signature in signatures),
+        "class_count": class_count,
+        "transitions": transitions,
+        "accepts": accepts,
+        "future_min": future_min,
+    }
+
+
+class _ClassMap(dict):
+    """
+    Таблица для str.translate: код символа -> символ с номером класса.
+    Классы символов вне ASCII вычисляются при первой встрече
+    """
+
+    def __init__(self, tables: Dict[str, Any]):
+        super().__init__((code, chr(cls)) for code, cls in enumerate(tables["ascii_classes"]))
+        self.class_starts = tables["class_starts"]
+        self.class_lookup = tables["class_lookup"]
+
+    def __missing__(self, code: int) -> str:
+        interval = bisect.bisect_right(self.class_starts, code) - 1
+        cls = self[code] = chr(self.class_lookup[(interval,) + _char_props(chr(code))])
+        return cls
+
+
+class DFAScanner:
+    """
+    Сканер по плоской таблице переходов ДКА, без возвратов регулярных выражений
+    """
+
+    def __init__(self, tables: Dict[str, Any]):
+        self.tables = tables
+        self.kinds = tables["kinds"]
+        self.class_map = _ClassMap(tables)
+        # Состояния с петлей по большинству классов (тело комментария): участок
+        # на петле проходится поиском первого класса, выводящего из состояния.
+        # Правила без \b: их допуск на всем участке одинаков
+        class_count = tables["class_count"]
+        transitions = tables["transitions"]
+        self.skips: List[Optional["re.Pattern[bytes]"]] = [None] * (len(transitions) // class_count)
+        for state in range(1, len(self.skips)):
+            row = transitions[state * class_count:(state + 1) * class_count]
+            loop = [cls for cls in range(class_count) if row[cls] == state]
+            if 2 * len(loop) < class_count or any(tables["bound_before"][rule] or tables["bound_after"][rule]
+                                                  for rule in tables["accepts"][state]):
+                continue
+            self.skips[state] = re.compile(b"[^" + b"".join(re.escape(bytes([cls])) for cls in loop) + b"]")
+        # Правила, которые еще могут быть допущены из состояния
+        accepts = tables["accepts"]
+        self.future_rules = [set(rules) for rules in accepts]
+        changed = True
+        while changed:
+            changed = False
+            for state in range(1, len(self.skips)):
+                rules = self.future_rules[state]
+                for target in set(transitions[state * class_count:(state + 1) * class_count]):
+                    if target and not self.future_rules[target] <= rules:
+                        rules |= self.future_rules[target]
+                        changed = True
+
+    def scan(self, program: str, pos: int = 0):
+        """
+        Выдает тройки (вид, начало, конец) в том же порядке, что и re.finditer
+        """
+        tables = self.tables
+        kinds = self.kinds
+        lazy = tables["lazy"]
+        bound_before = tables["bound_before"]
+        bound_after = tables["bound_after"]
+        class_word = tables["class_word"]
+        class_count = tables["class_count"]
+        transitions = tables["transitions"]
+        accepts = tables["accepts"]
+        future_min = tables["future_min"]
+        classes = program.translate(self.class_map).encode("latin-1")
+        length = len(classes)
+
+        def boundary(position: int) -> bool:
+            before = position > 0 and class_word[classes[position - 1]]
+            after = position < length and class_word[classes[position]]
+            return before != after
+
+        while pos < length:
+            state = 1
+            index = pos
+            best = -1
+            best_end = pos
+            while index < length:
+                state = transitions[state * class_count + classes[index]]
+                if not state:
+                    break
+                index += 1
+                rules = accepts[state]
+                if rules:
+                    for rule in rules:
+                        if best >= 0 and (rule > best or (rule == best and lazy[rule])):
+                            break
+                        if bound_before[rule] and not boundary(pos):
+                            continue
+                        if bound_after[rule] and not boundary(index):
+                            continue
+                        best = rule
+                        best_end = index
+                        break
+                if best >= 0:
+                    rest = future_min[state]
+                    if rest > best or (rest == best and lazy[best]):
+                        break
+            if best < 0:
+                pos += 1
+                continue
+            yield kinds[best], pos, best_end
+            pos = best_end
+
+    def scan_stream(self, chunks: Iterable[str], window: _StreamLines,
+                    textless: Iterable[str] = ()) -> Iterator[Tuple[str, int, int]]:
+        """
+        То же, что scan по склеенному тексту, для текста, который приходит
+        фрагментами; смещения - от начала текста, фрагменты складываются в window.
+        Каждый фрагмент переводится в классы символов один раз. Токен, не
+        законченный к концу фрагмента, продолжается со следующего фрагмента с
+        сохраненного состояния ДКА, а участки, где ДКА стоит на петле (тело
+        комментария), проходятся поиском первого класса, выводящего из нее.
+        textless - виды, текст которых потребителю не нужен: если незаконченный
+        токен может стать только ими, window хранит не его текст, а лишь символ
+        перед концом совпадения и описание позиции начала
+        """
+        tables = self.tables
+        kinds = self.kinds
+        lazy = tables["lazy"]
+        bound_before = tables["bound_before"]
+        bound_after = tables["bound_after"]
+        class_word = tables["class_word"]
+        class_count = tables["class_count"]
+        transitions = tables["transitions"]
+        accepts = tables["accepts"]
+        future_min = tables["future_min"]
+        skips = self.skips
+        class_map = self.class_map
+        textless = set(textless)
+        free = [all(kinds[rule] in textless for rule in rules) for rules in self.future_rules]
+        # Незаконченный токен: начало pos, пройдены символы [pos, index), состояние
+        # ДКА state, лучшее совпадение best до best_end; check - допуск state
+        # в index еще не проверен, для \b нужен следующий символ
+        carried = False
+        pos = index = 0
+        state = 1
+        best = -1
+        best_end = 0
+        check = False
+        word_before = word_first = word_last = 0  # Словесность символов перед pos, в pos и перед index
+        base = 0  # Смещение classes[0] от начала текста
+        classes = b""
+        for chunk in chain(chunks, (None,)):
+            final = chunk is None
+            if not final:
+                if not chunk:
+                    continue
+                if carried and free[state]:
+                    # Возврат после конца токена начнется с символа перед best_end
+                    window.remember(pos)
+                    window.discard(best_end - 1 if best >= 0 else pos)
+                else:
+                    window.discard(pos)
+                window.append(chunk)
+            word_previous = class_word[classes[-1]] if classes else 0  # Символ перед новым фрагментом
+            base += len(classes)
+            classes = chunk.translate(class_map).encode("latin-1") if not final else b""
+            length = len(classes)
+
+            # Продолжение токена из прошлых фрагментов
+            local = index - base
+            while carried:
+                finished = False
+                if check:
+                    if local < length:
+                        after = class_word[classes[local]]
+                    elif final:
+                        after = 0
+                    else:
+                        break
+                    check = False
+                    for rule in accepts[state]:
+                        if best >= 0 and (rule > best or (rule == best and lazy[rule])):
+                            break
+                        if bound_before[rule] and word_before == word_first:
+                            continue
+                        if bound_after[rule] and word_last == after:
+                            continue
+                        best = rule
+                        best_end = index
+                        break
+                    if best >= 0:
+                        rest = future_min[state]
+                        finished = rest > best or (rest == best and lazy[best])
+                if not finished:
+                    skip = skips[state]
+                    if skip is not None and local < length:
+                        match = skip.search(classes, local)
+                        stop = match.start() if match else length
+                        if stop > local:
+                            if best >= 0 and best_end == index:
+                                best_end += stop - local
+                            index += stop - local
+                            local = stop
+                            word_last = class_word[classes[local - 1]]
+                    if local < length:
+                        state = transitions[state * class_count + classes[local]]
+                        if state:
+                            word_last = class_word[classes[local]]
+                            local += 1
+                            index += 1
+                            check = bool(accepts[state])
+                            continue
+                    elif not final:
+                        break
+                carried = False
+                if best >= 0:
+                    yield kinds[best], pos, best_end
+                    pos = best_end
+                else:
+                    pos += 1
+                if pos < base:
+                    # ДКА прошел дальше конца токена в прошлый фрагмент: текст от
+                    # символа перед концом токена переводится заново
+                    classes = window[pos - 1:base + length].translate(class_map).encode("latin-1")
+                    base = pos - 1
+                    length = len(classes)
+                    word_previous = 0  # Не нужен: новое начало позже base
+            if carried:
+                continue
+
+            # Токены внутри фрагмента, как в scan
+            pos -= base
+            while pos < length:
+                state = 1
+                index = pos
+                best = -1
+                best_end = pos
+                while index < length:
+                    state = transitions[state * class_count + classes[index]]
+                    if not state:
+                        break
+                    index += 1
+                    rules = accepts[state]
+                    if rules:
+                        if index == length and not final:
+                            check = True  # Для \b после совпадения нужен следующий символ
+                            break
+                        for rule in rules:
+                            if best >= 0 and (rule > best or (rule == best and lazy[rule])):
+                                break
+                            if bound_before[rule]:
+                                before = class_word[classes[pos - 1]] if pos else word_previous
+                                if before == class_word[classes[pos]]:
+                                    continue
+                            if bound_after[rule]:
+                                after = class_word[classes[index]] if index < length else 0
+                                if class_word[classes[index - 1]] == after:
+                                    continue
+                            best = rule
+                            best_end = index
+                            break
+                        if best >= 0:
+                            rest = future_min[state]
+                            if rest > best or (rest == best and lazy[best]):
+                                break
+                else:
+                    check = False
+                if index == length and state and not final:
+                    # Токен может продолжиться в следующем фрагменте
+                    carried = True
+                    word_before = class_word[classes[pos - 1]] if pos else word_previous
+                    word_first = class_word[classes[pos]]
+                    word_last = class_word[classes[index - 1]]
+                    best_end += base
+                    index += base
+                    break
+                if best < 0:
+                    pos += 1
+                    continue
+                yield kinds[best], base + pos, base + best_end
+                pos = best_end
+            pos += base
+
+
+def compile_dfa(token_specification: List[Tuple[str, str]]) -> DFAScanner:
+    """
+    Возвращает общий ДКА-сканер для спецификации токенов
+    """
+    fingerprint = spec_fingerprint(token_specification)
+    scanner = _dfa_scanners.get(fingerprint)
+    if scanner is None:
+        scanner = _dfa_scanners[fingerprint] = DFAScanner(build_dfa_tables(token_specification))
+    return scanner
+
+
+class TokenBuffer(Sequence):
+    """
+    Компактное хранилище токенов: коды токенов в array('B'), границы лексем
+    в array('q'), значения извлекаются из исходного текста при обращении.
+    Снаружи выглядит как список токенов (код, значение, смещение)
+    """
+
+    def __init__(self, source):
+        self.source = source  # str, bytes, mmap или memoryview
+        self.kinds = array("B")
+        self.starts = array("q")
+        self.ends = array("q")
+
+    def append(self, code: int, start: int, end: int):
+        self.kinds.append(code)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def value(self, index: int) -> Any:
+        code = self.kinds[index]
+        if code in TOKEN_LEXEMES:
+            return TOKEN_LEXEMES[code]
+        value = self.source[self.starts[index]:self.ends[index]]
+        if not isinstance(value, str):
+            value = bytes(value).decode("ascii")
+        if code == IDENTIFIER:
+            value = intern(value)
+        elif code == NUMBER:
+            value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+        return value
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.kinds[index], self.value(index), self.starts[index]
+
+    def __iter__(self) -> Iterator[Token]:
+        for index in range(len(self.kinds)):
+            yield self[index]
+
+    def nbytes(self) -> int:
+        """
+        Объем массивов токенов в байтах (без исходного текста)
+        """
+        return sum(column.itemsize * len(column) for column in (self.kinds, self.starts, self.ends))
+
+
+# Классы символов для векторного прохода движка "numpy". Буквы a-f отделены
+# от остальных: с них может начинаться шестнадцатеричное число вида 0Fh
+(_CLASS_OTHER, _CLASS_SKIP, _CLASS_SINGLE, _CLASS_LETTER, _CLASS_HEX_LETTER, _CLASS_DIGIT) = range(6)
+# Односимвольные токены, с которых не начинается более длинная лексема
+_SINGLE_CODES = {"{": LBRACE, "}": RBRACE, "(": LPAREN, ")": RPAREN, ";": SEMICOLON, ",": COMMA,
+                 "=": ASSIGN, "+": ADD_OP, "-": ADD_OP, "*": MUL_OP}
+_WORD_MAX = max(map(len, WORD_CODES))
+_numpy_tables: List[Any] = []
+
+
+def _numpy_char_tables():
+    """
+    Таблицы движка "numpy": класс каждого из 256 байтов, код односимвольного
+    токена по байту и упакованные в uint64 ключевые слова с их кодами
+    """
+    if not _numpy_tables:
+        classes = np.full(256, _CLASS_OTHER, np.uint8)
+        single_codes = np.zeros(256, np.uint8)
+        for char in " \t\n\r\v\f":
+            classes[ord(char)] = _CLASS_SKIP
+        for char in "ghijklmnopqrstuvwxyzGHIJKLMNOPQRSTUVWXYZ_":
+            classes[ord(char)] = _CLASS_LETTER
+        for char in "abcdefABCDEF":
+            classes[ord(char)] = _CLASS_HEX_LETTER
+        for char in "0123456789":
+            classes[ord(char)] = _CLASS_DIGIT
+        for char, code in _SINGLE_CODES.items():
+            classes[ord(char)] = _CLASS_SINGLE
+            single_codes[ord(char)] = code
+        words = sorted((int.from_bytes(word.encode("ascii"), "little"), code) for word, code in WORD_CODES.items())
+        word_keys = np.array([key for key, _ in words], np.uint64)
+        word_codes = np.array([code for _, code in words], np.uint8)
+        _numpy_tables.extend((classes, single_codes, word_keys, word_codes))
+    return _numpy_tables
+
+
+class CachedTokenBuffer(TokenBuffer):
+    """
+    TokenBuffer поверх файла кэша, отображенного в память: колонки - memoryview
+    без копирования, значения литералов берутся из таблицы литералов
+    """
+
+    def __init__(self, source, data, count: int, literals: List[Any]):
+        super().__init__(source)
+        self.data = data  # mmap должен жить, пока живут колонки
+        view = memoryview(data)
+        offset = _CACHE_HEADER.size
+        self.starts = view[offset:offset + 8 * count].cast("q")
+        offset += 8 * count
+        self.ends = view[offset:offset + 8 * count].cast("q")
+        offset += 8 * count
+        self.literal_index = view[offset:offset + 4 * count].cast("i")
+        offset += 4 * count
+        self.kinds = view[offset:offset + count]
+        self.literals = literals
+
+    def append(self, code: int, start: int, end: int):
+        raise TypeError("Токены из кэша доступны только для чтения")
+
+    def value(self, index: int) -> Any:
+        code = self.kinds[index]
+        if code in TOKEN_LEXEMES:
+            return TOKEN_LEXEMES[code]
+        return self.literals[self.literal_index[index]]
+
+
+LEXER_ENGINES = ("regex", "dfa", "numpy")
+STREAM_CHUNK_SIZE = 1 << 16
+TOKEN_BLOCK_SIZE = 1024
+# Куски текста TokenDocument и начальное окно повторного анализа после правки
+TEXT_PIECE_SIZE = 1 << 16
+TEXT_WINDOW_SIZE = 1 << 12
+PARALLEL_MIN_CHUNK = 1 << 20
+
+
+class LexicalAnalyzer:
+    def __init__(self, engine: str = "regex", token_specification: Optional[List[Tuple[str, str]]] = None,
+                 word_codes: Optional[Dict[str, int]] = None):
+        if engine not in LEXER_ENGINES:
+            raise ValueError(f"Неизвестный движок лексера: {engine}")
+        if engine == "numpy" and np is None:
+            raise ImportError("Движку numpy нужен пакет numpy")
+        self.engine = engine
         self.token_specification = [
-            ("COMMENT", r'/\*.*?\*/'),  # Многострочный комментарий
+            ("COMMENT", r'/\*[\s\S]*?\*/'),  # Комментарий, в том числе многострочный
+            ("UNCLOSED_COMMENT", r'/\*[\s\S]*'),  # Незакрытый комментарий до конца текста - ошибка
             ("NUMBER", r'\d+(?:\.\d+)?(?:[Ee][+-]?\d+)?'),  # Числа (целые и вещественные)
             ("BIN_NUMBER", r'[01]+[Bb]'),  # Двоичное число
             ("OCT_NUMBER", r'[0-7]+[Oo]'),  # Восьмеричное число
             ("DEC_NUMBER", r'\d+[Dd]?'),  # Десятичное число
             ("HEX_NUMBER", r'[0-9A-Fa-f]+[Hh]'),  # Шестнадцатеричное число
-            ("KEYWORD", r'\b(let|if|then|else|for|do|while|loop|input|output)\b'),  # Ключевые слова
-            ("IDENTIFIER", r'[A-Za-z_][A-Za-z_0-9]*'),  # Идентификаторы
+            ("IDENTIFIER", r'[A-Za-z_][A-Za-z_0-9]*'),  # Слова: идентификаторы, ключевые слова, or/and/not
             ("ASSIGN", r'='),  # Присваивание
             ("REL_OP", r'[<>]=?'),  # Операции отношения
-            ("ADD_OP", r'[+\-]|or'),  # Операции сложения
-            ("MUL_OP", r'[*/]|and'),  # Операции умножения
-            ("UNARY_OP", r'not'),  # Унарная операция
+            ("ADD_OP", r'[+\-]'),  # Операции сложения
+            ("MUL_OP", r'[*/]'),  # Операции умножения
             ("DELIMITER", r'[{}();,]'),  # Разделители
             ("WHITESPACE", r'[ \t]+'),  # Пробелы
             ("NEWLINE", r'\n'),  # Новые строки
+            ("MISMATCH", r'[^\s]'),  # Любой другой непробельный символ - ошибка
         ]
-        self.token_regex = '|'.join(f'(?P<{name}>{regex})' for name, regex in self.token_specification)
+        self.default_specification = self.token_specification
+        self._compile(self.token_specification if token_specification is None else list(token_specification),
+                      WORD_CODES if word_codes is None else dict(word_codes))
+
+    def _compile(self, token_specification: List[Tuple[str, str]], word_codes: Dict[str, int]):
+        """
+        Устанавливает спецификацию и таблицу слов. Шаблон и ДКА кэшируются
+        по отпечатку, так что повторная сборка уже встречавшегося диалекта
+        ничего не стоит
+        """
+        if self.engine == "numpy" and (token_specification != self.default_specification or word_codes != WORD_CODES):
+            raise ValueError("Движок numpy работает только со стандартной спецификацией токенов")
+        for name, regex in token_specification:
+            if name in LEXEME_CODES:
+                for lexeme in rule_lexemes(regex) or ():
+                    register_lexeme_code(name, lexeme)
+            elif name not in ("WHITESPACE", "NEWLINE", "COMMENT", "UNCLOSED_COMMENT", "MISMATCH"):
+                register_token_kind(name)
+        self.token_pattern = compile_token_regex(token_specification)
+        self.token_regex = self.token_pattern.pattern
+        self.dfa = compile_dfa(token_specification) if self.engine == "dfa" else None
+        self.token_specification = token_specification
+        self.word_codes = word_codes
+
+    def register_rule(self, name: str, regex: str, before: Optional[str] = None) -> "LexicalAnalyzer":
+        """
+        Добавляет правило диалекта или заменяет шаблон существующего правила.
+        Новое правило ставится перед before, по умолчанию перед MISMATCH;
+        замененное остается на своем месте, если before не задан.
+        Ветви-строки в '|' переставляются от длинных к коротким, как выбирает ДКА.
+        Правило, которое перекрыто более ранними или само перекрывает
+        работавшие правила, отклоняется. Возвращает self
+        """
+        regex = order_alternations(regex)
+        specification = [rule for rule in self.token_specification if rule[0] != name]
+        names = [rule[0] for rule in specification]
+        if before is not None:
+            if before not in names:
+                raise ValueError(f"Нет правила {before}")
+            index = names.index(before)
+        elif len(specification) < len(self.token_specification):
+            index = [rule[0] for rule in self.token_specification].index(name)
+        else:
+            index = names.index("MISMATCH") if "MISMATCH" in names else len(names)
+        specification.insert(index, (name, regex))
+        validate_token_specification(specification, self.token_specification)
+        self._compile(specification, self.word_codes)
+        return self
+
+    def register_keyword(self, word: str, code: Optional[int] = None) -> "LexicalAnalyzer":
+        """
+        Добавляет слово диалекта: без code - новое ключевое слово, иначе слово
+        получает готовый код, например ADD_OP для словесной операции. Возвращает self
+        """
+        identifier = dict(self.token_specification).get("IDENTIFIER")
+        if identifier is None or not re.fullmatch(identifier, word):
+            raise ValueError(f"Слово {word!r} не разбирается правилом IDENTIFIER")
+        self._compile(self.token_specification,
+                      {**self.word_codes, word: register_keyword_code(word) if code is None else code})
+        return self
+
+    def fingerprint(self) -> str:
+        """
+        Отпечаток диалекта: спецификация токенов и таблица слов
+        """
+        words = ",".join(f"{word}={code}" for word, code in sorted(self.word_codes.items()))
+        return hashlib.sha256(f"{spec_fingerprint(self.token_specification)}:{words}".encode()).hexdigest()
+
+    def tokenize(self, program: str) -> List[Token]:
+        """
+        Лексический анализ программы
+        """
+        if self.dfa is not None:
+            return self.tokenize_dfa(program)
+        if self.engine == "numpy":
+            tokens, errors = self.tokenize_buffer(program)
+            return list(tokens), errors
+        tokens = []
+        errors = []
+        lines = LineIndex(program)
+        for match in self.token_pattern.finditer(program):
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind in ("WHITESPACE", "NEWLINE", "COMMENT"):
+                continue
+            elif kind == "MISMATCH" or kind == "UNCLOSED_COMMENT":
+                errors.append(f"{lexical_error(kind, value)} ({lines.describe(match.start())})")
+                continue
+            elif kind == "IDENTIFIER":
+                value = intern(value)  # Одинаковые имена разделяют одну строку
+            elif kind == "NUMBER":
+                value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+            tokens.append((token_code(kind, value, self.word_codes), value, match.start()))
+
+        return tokens, errors
+
+    def tokenize_buffer(self, program) -> Tuple[TokenBuffer, List[str]]:
+        """
+        Лексический анализ в компактный TokenBuffer вместо списка кортежей.
+        program - str или байтовый буфер (bytes, mmap, memoryview) с ASCII-текстом
+        """
+        tokens, raw_errors = self._fill_buffer(program)
+        lines = LineIndex(program)
+        errors = [f"{message} ({lines.describe(offset)})" for offset, message in raw_errors]
+        return tokens, errors
+
+    def tokenize_parallel(self, program: str, workers: Optional[int] = None) -> Tuple[TokenBuffer, List[str]]:
+        """
+        Параллельный лексический анализ: текст делится на фрагменты по безопасным
+        переводам строк, фрагменты разбираются в пуле процессов, а их буферы
+        склеиваются с поправкой смещений. Результат совпадает с tokenize_buffer
+        """
+        workers = workers or os.cpu_count() or 1
+        bounds = split_source(program, workers)
+        if len(bounds) <= 2:
+            return self.tokenize_buffer(program)
+        chunks = [program[start:end] for start, end in zip(bounds, bounds[1:])]
+        # Процессы, запущенные без fork, загружают готовые таблицы ДКА, а не собирают их
+        startup = {}
+        if self.engine == "dfa":
+            startup = {"initializer": load_lexer_tables,
+                       "initargs": (lexer_tables_path(self.token_specification),
+                                    spec_fingerprint(self.token_specification))}
+        with ProcessPoolExecutor(workers, **startup) as pool:
+            kind_codes = {name: KIND_CODES[name] for name, _ in self.token_specification if name in KIND_CODES}
+            dialect = (self.engine, self.token_specification, self.word_codes, kind_codes)
+            results = list(pool.map(_lex_chunk, repeat(dialect), chunks))
+
+        tokens = TokenBuffer(program)
+        raw_errors = []
+        for base, (kinds, starts, ends, chunk_errors) in zip(bounds, results):
+            tokens.kinds.frombytes(kinds)
+            tokens.starts.extend(map(base.__add__, starts))
+            tokens.ends.extend(map(base.__add__, ends))
+            raw_errors.extend((base + offset, char) for offset, char in chunk_errors)
+        lines = LineIndex(program)
+        errors = [f"{message} ({lines.describe(offset)})" for offset, message in raw_errors]
+        return tokens, errors
+
+    def _fill_buffer(self, program) -> Tuple[TokenBuffer, List[Tuple[int, str]]]:
+        """
+        Заполняет TokenBuffer; ошибки возвращаются парами (смещение, текст)
+        """
+        if self.engine == "numpy":
+            return self._fill_buffer_numpy(program)
+        tokens = TokenBuffer(program)
+        errors = []
+        if isinstance(program, str):
+            if self.dfa is not None:
+                spans = self.dfa.scan(program)
+            else:
+                spans = ((match.lastgroup, match.start(), match.end()) for match in self.token_pattern.finditer(program))
+        else:
+            pattern = compile_token_regex_bytes(self.token_specification)
+            spans = ((match.lastgroup, match.start(), match.end()) for match in pattern.finditer(program))
+        kinds_append = tokens.kinds.append
+        starts_append = tokens.starts.append
+        ends_append = tokens.ends.append
+        for kind, start, end in spans:
+            if kind in ("WHITESPACE", "NEWLINE", "COMMENT"):
+                continue
+            elif kind == "MISMATCH" or kind == "UNCLOSED_COMMENT":
+                errors.append((start, lexical_error(kind, program[start:end] if kind == "MISMATCH" else "")))
+                continue
+            if kind in LEXEME_CODES or kind == "IDENTIFIER":
+                lexeme = program[start:end]
+                lexeme = lexeme if isinstance(lexeme, str) else bytes(lexeme).decode("ascii")
+                kinds_append(token_code(kind, lexeme, self.word_codes))
+            else:
+                kinds_append(KIND_CODES[kind])
+            starts_append(start)
+            ends_append(end)
+
+        return tokens, errors
+
+    def _fill_buffer_numpy(self, program) -> Tuple[TokenBuffer, List[Tuple[int, str]]]:
+        """
+        Заполнение TokenBuffer с векторным предварительным проходом: символы
+        переводятся в классы таблицей на 256 элементов, границы серий букв и цифр
+        и односимвольные токены находятся через diff/nonzero. Скалярному regex
+        достаются только неоднозначные места: числа с точкой, порядком или
+        суффиксом, возможные шестнадцатеричные числа, комментарии, '<', '>'
+        и неизвестные символы
+        """
+        classes, single_codes, word_keys, word_codes = _numpy_char_tables()
+        if not isinstance(program, str):
+            data = np.frombuffer(program, np.uint8)
+            pattern = compile_token_regex_bytes(self.token_specification)
+        elif program.isascii():
+            data = np.frombuffer(program.encode("ascii"), np.uint8)
+            pattern = self.token_pattern
+        else:
+            # Символы вне ASCII попадают в класс неоднозначных и разбираются regex
+            data = np.minimum(np.frombuffer(program.encode("utf-32-le"), np.uint32), 255).astype(np.uint8)
+            pattern = self.token_pattern
+        length = len(data)
+        char_classes = classes[data]
+
+        # Серии символов слов [A-Za-z0-9_]
+        word = char_classes >= _CLASS_LETTER
+        edges = np.diff(word.view(np.int8), prepend=np.int8(0), append=np.int8(0))
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
+        last = max(length - 1, 0)
+        first = char_classes[run_starts]
+
+        # Серия с буквы - один IDENTIFIER, если с ее начала не читается [0-9A-Fa-f]+[Hh]
+        non_hex = np.append(np.flatnonzero(char_classes < _CLASS_HEX_LETTER), length)
+        hex_end = non_hex[np.searchsorted(non_hex, run_starts)]
+        suffix = data[np.minimum(hex_end, last)]
+        hex_number = (hex_end > run_starts) & (hex_end < run_ends) & ((suffix == ord("h")) | (suffix == ord("H")))
+        identifier = (first != _CLASS_DIGIT) & ~hex_number
+        # Серия из одних цифр - NUMBER, если за ней нет дробной части или цифры вне ASCII
+        non_digit = np.append(np.flatnonzero(char_classes != _CLASS_DIGIT), length)
+        digits_end = non_digit[np.searchsorted(non_digit, run_starts)]
+        following = data[np.minimum(run_ends, last)]
+        number = (first == _CLASS_DIGIT) & (digits_end == run_ends) & \
+            ((run_ends == length) | ((following != ord(".")) & (following < 128)))
+
+        # Ключевые слова и словесные операции: первые байты слова упаковываются в uint64
+        word_starts = run_starts[identifier]
+        word_lengths = run_ends[identifier] - word_starts
+        keys = np.zeros(len(word_starts), np.uint64)
+        for k in range(_WORD_MAX):
+            chars = data[np.minimum(word_starts + k, last)].astype(np.uint64)
+            keys |= np.where(k < word_lengths, chars, 0).astype(np.uint64) << np.uint64(8 * k)
+        found = np.minimum(np.searchsorted(word_keys, keys), len(word_keys) - 1)
+        hit = (word_keys[found] == keys) & (word_lengths <= _WORD_MAX)
+        word_kinds = np.where(hit, word_codes[found], IDENTIFIER).astype(np.uint8)
+
+        singles = np.flatnonzero(char_classes == _CLASS_SINGLE)
+        starts = np.concatenate((word_starts, run_starts[number], singles))
+        order = np.argsort(starts, kind="stable")
+        starts = starts[order]
+        ends = np.concatenate((run_ends[identifier], run_ends[number], singles + 1))[order]
+        kinds = np.concatenate((word_kinds, np.full(np.count_nonzero(number), NUMBER, np.uint8),
+                                single_codes[data[singles]]))[order]
+        ambiguous = np.union1d(np.flatnonzero(char_classes == _CLASS_OTHER), run_starts[~(identifier | number)])
+        is_word = word.tobytes()
+        simple_starts = array("q", starts.tobytes())
+
+        # Скалярный разбор неоднозначных мест; простые токены, которые он поглотил
+        # (например, внутри комментария), отмечаются диапазонами индексов
+        scalar_kinds, scalar_starts, scalar_ends = array("B"), array("q"), array("q")
+        consumed = []
+        errors = []
+        pos = 0
+        for position, low in zip(ambiguous.tolist(), np.searchsorted(starts, ambiguous).tolist()):
+            if position < pos:
+                continue
+            pos = position
+            while True:  # Пока позиция не вернется на границу серии
+                match = pattern.match(program, pos)
+                if match is None:
+                    pos += 1  # Пробельный символ без правила
+                else:
+                    kind = match.lastgroup
+                    start, pos = match.span()
+                    if kind in ("WHITESPACE", "NEWLINE", "COMMENT"):
+                        pass
+                    elif kind == "MISMATCH" or kind == "UNCLOSED_COMMENT":
+                        errors.append((start, lexical_error(kind, program[start:pos] if kind == "MISMATCH" else "")))
+                    else:
+                        lexeme = program[start:pos]
+                        if not isinstance(lexeme, str):
+                            lexeme = bytes(lexeme).decode("ascii")
+                        scalar_kinds.append(token_code(kind, lexeme))
+                        scalar_starts.append(start)
+                        scalar_ends.append(pos)
+                if pos >= length or not (is_word[pos] and is_word[pos - 1]):
+                    break
+            if low < len(simple_starts) and simple_starts[low] < pos:
+                consumed.append((low, bisect.bisect_left(simple_starts, pos, low)))
+
+        keep = np.ones(len(starts), bool)
+        for low, high in consumed:
+            keep[low:high] = False
+        starts = np.concatenate((starts[keep], np.frombuffer(scalar_starts, np.int64)))
+        order = np.argsort(starts, kind="stable")
+        tokens = TokenBuffer(program)
+        tokens.starts.frombytes(starts[order].tobytes())
+        tokens.ends.frombytes(np.concatenate((ends[keep], np.frombuffer(scalar_ends, np.int64)))[order].tobytes())
+        tokens.kinds.frombytes(np.concatenate((kinds[keep], np.frombuffer(scalar_kinds, np.uint8)))[order].tobytes())
+        return tokens, errors
+
+    def tokenize_bytes(self, data) -> List[Token]:
+        """
+        Лексический анализ ASCII-текста в байтах (bytes, mmap, memoryview) без
+        декодирования всего буфера. Декодируются только лексемы найденных токенов
+        """
+        pattern = compile_token_regex_bytes(self.token_specification)
+        decoded: Dict[bytes, Tuple[int, str]] = {}  # Кэш слов, операций и разделителей
+        tokens = []
+        errors = []
+        lines = LineIndex(data)
+        for match in pattern.finditer(data):
+            kind = match.lastgroup
+            if kind in ("WHITESPACE", "NEWLINE", "COMMENT"):
+                continue
+            raw = match.group(kind)
+            if kind == "MISMATCH" or kind == "UNCLOSED_COMMENT":
+                errors.append(f"{lexical_error(kind, raw)} ({lines.describe(match.start())})")
+                continue
+            elif kind == "NUMBER":
+                tokens.append((NUMBER, float(raw) if b'.' in raw or b'E' in raw or b'e' in raw else int(raw),
+                               match.start()))
+            else:
+                token = decoded.get(raw)
+                if token is None:
+                    value = intern(raw.decode("ascii"))
+                    token = decoded[raw] = (token_code(kind, value, self.word_codes), value)
+                tokens.append((token[0], token[1], match.start()))
+
+        return tokens, errors
+
+    def tokenize_file(self, path: str) -> List[Token]:
+        """
+        Лексический анализ файла через mmap: файл не читается в память целиком
+        """
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return [], []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return self.tokenize_bytes(data)
+
+    def tokenize_dfa(self, program: str) -> List[Token]:
+        """
+        Лексический анализ табличным ДКА, результат совпадает с tokenize
+        """
+        errors = []
+        tokens = list(self._span_tokens(program, self.dfa.scan(program), 0, LineIndex(program), errors))
+        return tokens, errors
+
+    def tokenize_stream(self, source, errors: Optional[List[str]] = None) -> Iterator[Token]:
+        """
+        Потоковый лексический анализ файла или итератора фрагментов текста.
+        Токены выдаются по мере чтения, в памяти держатся только фрагменты
+        от начала незавершенного токена; у комментария, текст которого не нужен, -
+        лишь последний фрагмент. Ошибки дописываются в список errors
+        """
+        scanner = self.dfa or compile_dfa(self.token_specification)
+        if errors is None:
+            errors = []
+        if hasattr(source, "read"):
+            source = iter(partial(source.read, STREAM_CHUNK_SIZE), "")
+        lines = _StreamLines()
+        spans = scanner.scan_stream(source, lines, ("WHITESPACE", "NEWLINE", "COMMENT", "UNCLOSED_COMMENT"))
+        yield from self._span_tokens(lines, spans, 0, lines, errors)
+
+    def _span_tokens(self, program, spans, base: int, lines, errors: List[str]):
+        """
+        Превращает тройки сканера в токены; program - текст или окно _StreamLines
+        """
+        for kind, start, end in spans:
+            if kind in ("WHITESPACE", "NEWLINE", "COMMENT"):
+                continue
+            elif kind == "UNCLOSED_COMMENT":
+                errors.append(f"{lexical_error(kind, '')} ({lines.describe(base + start)})")
+                continue
+            value = program[start:end]
+            if kind == "MISMATCH":
+                errors.append(f"{lexical_error(kind, value)} ({lines.describe(base + start)})")
+                continue
+            elif kind == "IDENTIFIER":
+                value = intern(value)
+            elif kind == "NUMBER":
+                value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+            yield token_code(kind, value, self.word_codes), value, base + start
+
+
+def split_source(program: str, parts: int, min_chunk: int = PARALLEL_MIN_CHUNK) -> List[int]:
+    """
+    Границы фрагментов для параллельного анализа, включая 0 и len(program).
+    Граница ставится после '\n', который не находится внутри комментария /* ... */;
+    комментарии находятся быстрым проходом по str.find. Незакрытый '/*' считается
+    комментарием до конца текста
+    """
+    length = len(program)
+    step = max(length // max(parts, 1), min_chunk)
+    bounds = [0]
+    pos = 0  # Отсюда ищутся начала комментариев; раньше все проверено
+    target = step
+    while target < length:
+        while True:
+            newline = program.find("\n", max(target, pos))
+            if newline < 0:
+                break
+            opening = program.find("/*", pos, newline)
+            if opening < 0:
+                break
+            closing = program.find("*/", opening + 2)
+            if closing < 0:
+                newline = -1
+                break
+            pos = closing + 2
+        if newline < 0 or newline + 1 >= length:
+            break
+        bounds.append(newline + 1)
+        pos = newline + 1
+        target = pos + step
+    bounds.append(length)
+    return bounds
+
+
+def _lex_chunk(dialect: Tuple[str, List[Tuple[str, str]], Dict[str, int], Dict[str, int]], chunk: str):
+    """
+    Разбор одного фрагмента в процессе пула. Возвращает колонки TokenBuffer и ошибки.
+    Коды видов диалекта передаются явно: процесс пула мог не видеть их регистрации
+    """
+    engine, token_specification, word_codes, kind_codes = dialect
+    for name, code in kind_codes.items():
+        register_token_kind(name, code)
+    tokens, errors = LexicalAnalyzer(engine, token_specification, word_codes)._fill_buffer(chunk)
+    return tokens.kinds.tobytes(), tokens.starts, tokens.ends, errors
+
+
+TOKEN_CACHE_VERSION = 1
+TOKEN_CACHE_MAX_BYTES = 256 << 20
+# Заголовок файла кэша: сигнатура, версия формата, число токенов, размер метаданных
+_CACHE_HEADER = struct.Struct("<4sIQQ")
+_CACHE_MAGIC = b"TOKS"
+
+
+class TokenCache:
+    """
+    Кэш потоков токенов на диске. Ключ - sha256 от текста программы и отпечатка
+    диалекта лексера. Файл: заголовок, колонки начал и концов (int64),
+    индексы литералов (int32), коды токенов (uint8) и в конце marshal с таблицей
+    литералов и ошибками. Колонки читаются через mmap без копирования, так что
+    попадание в кэш обходится без лексического анализа. Общий размер файлов
+    ограничен max_bytes: вытесняются давно не использованные (по mtime).
+    Колонки хранятся в порядке байтов машины, кэш не переносится между платформами
+    """
+
+    def __init__(self, directory: str, max_bytes: int = TOKEN_CACHE_MAX_BYTES,
+                 lexer: Optional[LexicalAnalyzer] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lexer = lexer or LexicalAnalyzer()
+        self.fingerprint = self.lexer.fingerprint()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, program) -> str:
+        """
+        Ключ кэша: смещения в str и в байтах различаются, поэтому учитывается и тип текста
+        """
+        kind = "str" if isinstance(program, str) else "bytes"
+        digest = hashlib.sha256(f"{TOKEN_CACHE_VERSION}:{self.fingerprint}:{kind}:".encode())
+        digest.update(program.encode("utf-8", "surrogatepass") if isinstance(program, str) else program)
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".tok")
+
+    def tokenize(self, program) -> Tuple[TokenBuffer, List[str]]:
+        """
+        Токены программы из кэша; при промахе - лексический анализ и запись в кэш
+        """
+        key = self.key(program)
+        loaded = self.load(key, program)
+        if loaded is None:
+            self.misses += 1
+            tokens, raw_errors = self.lexer._fill_buffer(program)
+            self.store(key, tokens, raw_errors)
+        else:
+            self.hits += 1
+            tokens, raw_errors = loaded
+        lines = LineIndex(program)
+        return tokens, [f"{message} ({lines.describe(offset)})" for offset, message in raw_errors]
+
+    def load(self, key: str, program) -> Optional[Tuple[CachedTokenBuffer, List[Tuple[int, str]]]]:
+        """
+        Читает файл кэша; None, если его нет или он поврежден
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # ValueError - пустой файл
+            return None
+        try:
+            magic, version, count, meta_size = _CACHE_HEADER.unpack_from(data)
+            if magic != _CACHE_MAGIC or version != TOKEN_CACHE_VERSION or \
+                    len(data) != _CACHE_HEADER.size + 21 * count + meta_size:
+                raise ValueError(path)
+            literals, raw_errors = marshal.loads(data[len(data) - meta_size:])
+        except (struct.error, ValueError, EOFError, TypeError):
+            data.close()
+            return None
+        os.utime(path)  # Отметка использования для вытеснения
+        literals = [intern(value) if isinstance(value, str) else value for value in literals]
+        return CachedTokenBuffer(program, data, count, literals), raw_errors
+
+    def store(self, key: str, tokens: TokenBuffer, raw_errors: List[Tuple[int, str]]):
+        """
+        Записывает токены в кэш через временный файл и вытесняет лишнее
+        """
+        literals = []
+        literal_ids: Dict[Tuple[int, Any], int] = {}  # (код, лексема) -> индекс литерала
+        literal_index = array("i")
+        source = tokens.source
+        for index, (code, start, end) in enumerate(zip(tokens.kinds, tokens.starts, tokens.ends)):
+            if code in TOKEN_LEXEMES:
+                literal_index.append(-1)
+                continue
+            lexeme = source[start:end]
+            literal_key = (code, lexeme if isinstance(lexeme, str) else bytes(lexeme))
+            literal = literal_ids.get(literal_key)
+            if literal is None:
+                literal = literal_ids[literal_key] = len(literals)
+                literals.append(tokens.value(index))
+            literal_index.append(literal)
+        meta = marshal.dumps((literals, raw_errors))
+
+        path = self.path(key)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(_CACHE_HEADER.pack(_CACHE_MAGIC, TOKEN_CACHE_VERSION, len(tokens), len(meta)))
+            for column in (tokens.starts, tokens.ends, literal_index, tokens.kinds, meta):
+                f.write(column)
+        os.replace(temporary, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Удаляет давно не использованные файлы, пока кэш больше max_bytes
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(".tok"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class TokenDocument:
+    """
+    Документ для повторного лексического анализа после правок в редакторе.
+    После правки заново разбирается только поврежденный участок: от начала
+    строки с правкой (или от начала комментария, в который она попала) до
+    первого токена, который совпал с прежним потоком. '\n' пересекают только
+    комментарии, поэтому такое начало - безопасная точка перезапуска.
+    Токены хранятся блоками со своим сдвигом смещений, так что правка
+    не переписывает смещения всего хвоста документа. Ошибки и комментарии
+    хранятся в блоке первого токена после них (хвост документа - в последнем)
+    в смещениях блока. Текст тоже хранится кусками: правка копирует один кусок,
+    а не весь текст, и разбирается окном текста после начала разбора
+    """
+
+    def __init__(self, text: str, lexer: Optional[LexicalAnalyzer] = None):
+        self.lexer = lexer or LexicalAnalyzer()
+        self._text: Optional[str] = text  # Склеенный текст, None после правки
+        self._pieces = [text[start:start + TEXT_PIECE_SIZE] for start in range(0, len(text), TEXT_PIECE_SIZE)] or [""]
+        self._piece_starts = list(range(0, len(self._pieces) * TEXT_PIECE_SIZE, TEXT_PIECE_SIZE))
+        self._length = len(text)
+        errors: List[Tuple[int, str]] = []
+        comments: List[Tuple[int, int]] = []
+        tokens = list(self._lex(0, errors, comments, len(text)))
+        # Реальное смещение токена = смещение в блоке + сдвиг блока
+        self._blocks = self._split(tokens)
+        self._shifts = [0] * len(self._blocks)
+        self._starts = list(range(0, len(self._blocks) * TOKEN_BLOCK_SIZE, TOKEN_BLOCK_SIZE))  # Токенов до блока
+        self._errors = self._assign(self._blocks, errors)  # По блокам: (смещение, текст ошибки)
+        self._comments = self._assign(self._blocks, comments)  # По блокам: (начало, конец)
+        self._flat: Optional[List[Token]] = tokens
+
+    @staticmethod
+    def _split(tokens: List[Token]) -> List[List[Token]]:
+        if not tokens:
+            return [[]]
+        return [tokens[start:start + TOKEN_BLOCK_SIZE] for start in range(0, len(tokens), TOKEN_BLOCK_SIZE)]
+
+    @staticmethod
+    def _assign(blocks: List[List[Token]], items: List[tuple]) -> List[List[tuple]]:
+        """
+        Раскладывает ошибки или комментарии (по порядку, в тех же смещениях, что и
+        токены блоков) по блокам: в блок первого токена после элемента, хвост - в последний
+        """
+        result: List[List[tuple]] = [[] for _ in blocks]
+        block = 0
+        for item in items:
+            while block < len(blocks) - 1 and (not blocks[block] or blocks[block][-1][2] < item[0]):
+                block += 1
+            result[block].append(item)
+        return result
+
+    @staticmethod
+    def _moved(items: List[tuple], delta: int) -> List[tuple]:
+        # Ошибки (смещение, текст) или комментарии (начало, конец), сдвинутые на delta
+        if not delta or not items:
+            return items
+        if isinstance(items[0][1], str):
+            return [(offset + delta, message) for offset, message in items]
+        return [(start + delta, end + delta) for start, end in items]
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = "".join(self._pieces)
+        return self._text
+
+    def __len__(self) -> int:
+        return self._length
+
+    def substring(self, start: int, end: int) -> str:
+        """
+        Участок текста [start, end) без склейки всего текста
+        """
+        start, end = max(start, 0), min(end, self._length)
+        if start >= end:
+            return ""
+        if self._text is not None:
+            return self._text[start:end]
+        piece = bisect.bisect_right(self._piece_starts, start) - 1
+        parts = []
+        while start < end:
+            offset = start - self._piece_starts[piece]
+            part = self._pieces[piece][offset:offset + end - start]
+            parts.append(part)
+            start += len(part)
+            piece += 1
+        return "".join(parts)
+
+    def _replace(self, offset: int, removed: int, inserted: str):
+        # Правка кусков текста: задетые куски сливаются в один и делятся, если он велик
+        pieces, starts = self._pieces, self._piece_starts
+        first = bisect.bisect_right(starts, offset) - 1
+        last = bisect.bisect_right(starts, offset + removed) - 1
+        # Удаление до конца куска: следующий кусок не задет
+        if last > first and starts[last] == offset + removed:
+            last -= 1
+        merged = (pieces[first][:offset - starts[first]] + inserted
+                  + pieces[last][offset + removed - starts[last]:])
+        parts = [merged[start:start + TEXT_PIECE_SIZE] for start in range(0, len(merged), TEXT_PIECE_SIZE)] \
+            if len(merged) > 2 * TEXT_PIECE_SIZE else [merged]
+        if not merged and len(pieces) > last - first + 1:
+            parts = []
+        base = starts[first]
+        pieces[first:last + 1] = parts
+        starts[first:last + 1] = [base + part * TEXT_PIECE_SIZE for part in range(len(parts))]
+        delta = len(inserted) - removed
+        later = first + len(parts)
+        starts[later:] = map(delta.__add__, starts[later:])
+        self._length += delta
+        self._text = None
+
+    def _line_start(self, offset: int) -> int:
+        # Начало строки со смещением offset: '\n' ищется по кускам назад
+        piece = bisect.bisect_right(self._piece_starts, offset) - 1
+        while piece >= 0:
+            base = self._piece_starts[piece]
+            found = self._pieces[piece].rfind("\n", 0, offset - base)
+            if found >= 0:
+                return base + found + 1
+            offset = base
+            piece -= 1
+        return 0
+
+    def _lex(self, start: int, errors: List[Tuple[int, str]], comments: List[Tuple[int, int]],
+             size: int = TEXT_WINDOW_SIZE) -> Iterator[Token]:
+        """
+        Токены текста с позиции start; ошибки и комментарии дописываются в списки.
+        Текст разбирается окнами с одним символом перед ними (для \b); лексема,
+        упершаяся в край окна, разбирается заново в окне вдвое больше
+        """
+        pattern = self.lexer.token_pattern
+        word_codes = self.lexer.word_codes
+        while True:
+            context = 1 if start else 0
+            end = min(start + size, self._length)
+            window = self.substring(start - context, end)
+            base = start - context
+            for match in pattern.finditer(window, context):
+                if end < self._length and match.end() == len(window):
+                    break  # Лексема может продолжаться за окном
+                kind = match.lastgroup
+                if kind in ("WHITESPACE", "NEWLINE"):
+                    continue
+                elif kind == "COMMENT" or kind == "UNCLOSED_COMMENT":
+                    comments.append((base + match.start(), base + match.end()))
+                    if kind == "UNCLOSED_COMMENT":
+                        errors.append((base + match.start(), lexical_error(kind, "")))
+                    continue
+                value = match.group(kind)
+                if kind == "MISMATCH":
+                    errors.append((base + match.start(), lexical_error(kind, value)))
+                    continue
+                elif kind == "IDENTIFIER":
+                    value = intern(value)
+                elif kind == "NUMBER":
+                    value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+                yield token_code(kind, value, word_codes), value, base + match.start()
+            else:
+                return
+            start = base + match.start()
+            size *= 2
+
+    def _locate(self, offset: int) -> Tuple[int, int]:
+        """
+        Блок и индекс в нем первого токена, начинающегося не раньше offset
+        """
+        blocks, shifts = self._blocks, self._shifts
+        low, high = 0, len(blocks)
+        while low < high:
+            middle = (low + high) // 2
+            block = blocks[middle]
+            if not block or block[-1][2] + shifts[middle] < offset:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(blocks):
+            return low - 1, len(blocks[-1])
+        return low, bisect.bisect_left(blocks[low], offset - shifts[low], key=itemgetter(2))
+
+    def edit(self, offset: int, removed: int, inserted: str) -> Tuple[int, int, int]:
+        """
+        Применяет правку: удаление removed символов с позиции offset и вставку inserted.
+        Возвращает (индекс первого измененного токена, сколько токенов удалено, сколько вставлено)
+        """
+        if offset < 0 or removed < 0 or offset + removed > self._length:
+            raise ValueError(f"Правка за пределами текста: {offset}+{removed}")
+        delta = len(inserted) - removed
+        edit_end = offset + len(inserted)  # Конец вставки в новом тексте
+        restart = self._line_start(offset)
+        blocks, shifts = self._blocks, self._shifts
+        # Комментарий, в котором лежит начало строки, хранится в блоке первого токена после него -
+        # том же, что и у самого начала строки
+        first_block, _ = self._locate(restart)
+        comments = self._comments[first_block]
+        enclosing = bisect.bisect_left(comments, (restart - shifts[first_block], -1)) - 1
+        # Начало строки внутри комментария; незакрытый комментарий поглощает и дописанный в конец текст
+        if enclosing >= 0 and comments[enclosing][1] + shifts[first_block] >= restart:
+            restart = comments[enclosing][0] + shifts[first_block]
+        old_length = self._length
+        self._replace(offset, removed, inserted)
+        self._flat = None
+
+        # Разбор от начала строки до первого токена после правки, совпавшего с прежним
+        first_block, first_index = block, index = self._locate(restart)
+        new_tokens: List[Token] = []
+        new_errors: List[Tuple[int, str]] = []
+        new_comments: List[Tuple[int, int]] = []
+        resync_offset = old_length
+        for code, value, position in self._lex(restart, new_errors, new_comments):
+            if position > edit_end:
+                old_position = position - delta
+                while block < len(blocks):
+                    if index == len(blocks[block]):
+                        block, index = block + 1, 0
+                    elif blocks[block][index][2] + shifts[block] < old_position:
+                        index += 1
+                    else:
+                        break
+                if block < len(blocks) and blocks[block][index][2] + shifts[block] == old_position \
+                        and blocks[block][index][0] == code:
+                    resync_offset = old_position
+                    break
+            new_tokens.append((code, value, position))
+        else:
+            block, index = len(blocks) - 1, len(blocks[-1])
+
+        starts = self._starts
+        first = starts[first_block] + first_index
+        removed_tokens = starts[block] + index - first
+
+        # Блоки от первого до блока синхронизации сливаются в один (и делятся, если он велик),
+        # у последующих блоков меняются только сдвиг и число токенов перед ними
+        base = shifts[first_block]
+        tail_shift = shifts[block] + delta - base
+        merged = blocks[first_block][:first_index]
+        merged.extend((code, value, position - base) for code, value, position in new_tokens)
+        merged.extend((code, value, position + tail_shift) for code, value, position in blocks[block][index:])
+        # Ошибки и комментарии слитых блоков: прежние до начала разбора и после точки синхронизации
+        # остаются, найденные на поврежденном участке заменяют остальные
+        items = []
+        for kept, found in ((self._errors, new_errors), (self._comments, new_comments)):
+            head = kept[first_block]
+            head = head[:bisect.bisect_left(head, restart - base, key=itemgetter(0))]
+            tail = kept[block]
+            tail = tail[bisect.bisect_left(tail, resync_offset - shifts[block], key=itemgetter(0)):]
+            items.append(head + self._moved(found, -base) + self._moved(tail, tail_shift))
+        parts = self._split(merged) if len(merged) > 2 * TOKEN_BLOCK_SIZE else [merged]
+        if not merged and len(blocks) > block - first_block + 1:
+            parts = []
+        count = starts[block] + len(blocks[block]) - starts[first_block]
+        blocks[first_block:block + 1] = parts
+        shifts[first_block:block + 1] = [base] * len(parts)
+        starts[first_block:block + 1] = [starts[first_block] + part * TOKEN_BLOCK_SIZE for part in range(len(parts))]
+        later = first_block + len(parts)
+        shifts[later:] = map(delta.__add__, shifts[later:])
+        starts[later:] = map((len(merged) - count).__add__, starts[later:])
+        for kept, found in zip((self._errors, self._comments), items):
+            if parts:
+                kept[first_block:block + 1] = self._assign(parts, found)
+            elif first_block < len(blocks):
+                # Токенов не осталось: элементы переходят в следующий блок
+                del kept[first_block:block + 1]
+                kept[first_block][:0] = self._moved(found, base - shifts[first_block])
+            else:
+                del kept[first_block:block + 1]
+                kept[-1].extend(self._moved(found, base - shifts[-1]))
+        return first, removed_tokens, len(new_tokens)
+
+    def iter_tokens(self, offset: int = 0) -> Iterator[Token]:
+        """
+        Токены с реальными смещениями, начиная с первого, который начинается не раньше offset
+        """
+        block, index = self._locate(offset)
+        for tokens, shift in zip(self._blocks[block:], self._shifts[block:]):
+            for position in range(index, len(tokens)):
+                code, value, start = tokens[position]
+                yield code, value, start + shift
+            index = 0
+
+    def token(self, index: int) -> Token:
+        block = bisect.bisect_right(self._starts, index) - 1
+        if index < 0 or index - self._starts[block] >= len(self._blocks[block]):
+            raise IndexError(index)
+        code, value, offset = self._blocks[block][index - self._starts[block]]
+        return code, value, offset + self._shifts[block]
+
+    @property
+    def tokens(self) -> List[Token]:
+        """
+        Плоский список токенов с реальными смещениями
+        """
+        if self._flat is None:
+            self._flat = []
+            for block, shift in zip(self._blocks, self._shifts):
+                if shift:
+                    self._flat.extend((code, value, offset + shift) for code, value, offset in block)
+                else:
+                    self._flat.extend(block)
+        return self._flat
+
+    @property
+    def errors(self) -> List[str]:
+        lines = LineIndex(self.text)
+        return [f"{message} ({lines.describe(offset + shift)})"
+                for errors, shift in zip(self._errors, self._shifts) for offset, message in errors]
+
+
+# Размер окна TokenRing по умолчанию
+TOKEN_RING_SIZE = 16
+
+
+class TokenRing(Sequence):
+    """
+    Окно фиксированного размера над потоком токенов для синтаксического
+    анализатора. Индексы абсолютные, как у списка токенов, доступны последние
+    size прочитанных токенов. len() - число уже прочитанных токенов: поток
+    читается на lookahead токенов дальше последнего запрошенного индекса,
+    а после конца потока len() равна его настоящей длине
+    """
+
+    def __init__(self, tokens: Iterable[Token], size: int = TOKEN_RING_SIZE, lookahead: int = 2):
+        if size < 2 * lookahead + 2:
+            raise ValueError(f"Окну из {size} токенов мало для просмотра вперед на {lookahead}")
+        self.tokens = iter(tokens)
+        self.ring: List[Optional[Token]] = [None] * size
+        self.size = size
+        self.lookahead = lookahead
+        self.read = 0  # Прочитано токенов
+        self.position = 0  # Наибольший запрошенный индекс
+        self.exhausted = False
+
+    def _fill(self, index: int):
+        # Читает поток, пока не прочитан токен index или поток не кончился
+        while self.read <= index and not self.exhausted:
+            token = next(self.tokens, None)
+            if token is None:
+                self.exhausted = True
+            else:
+                self.ring[self.read % self.size] = token
+                self.read += 1
+
+    def __len__(self) -> int:
+        if self.read <= self.position + self.lookahead:
+            self._fill(self.position + self.lookahead)
+        return self.read
+
+    def __getitem__(self, index):
+        if self.position <= index < self.read:
+            self.position = index
+            return self.ring[index % self.size]
+        if not isinstance(index, int):
+            raise TypeError("TokenRing не поддерживает срезы")
+        if index < 0:
+            if not self.exhausted:
+                raise IndexError("Отсчет от конца TokenRing известен только после конца потока")
+            index += self.read
+        if index > self.position:
+            self.position = index
+        if index >= self.read:
+            self._fill(index)
+            if index >= self.read:
+                raise IndexError(index)
+        elif index < self.read - self.size:
+            raise IndexError(f"Токен {index} уже вытеснен из окна TokenRing")
+        return self.ring[index % self.size]
+
+
+# ---------------------------------------------------------------------------
+# Синтаксическое дерево
+# ---------------------------------------------------------------------------
+
+class Node:
+    """
+    Узел синтаксического дерева. start и end - смещения начала и конца узла
+    в тексте программы (конец не включается), fields - имена полей-потомков и значений
+    """
+    __slots__ = ("start", "end")
+    fields: Tuple[str, ...] = ()
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.fields)
+        return f"{type(self).__name__}({values})"
+
+    def __reduce__(self):
+        # Конструкторы узлов принимают поля по порядку и границы: pickle вызывает
+        # конструктор вместо общего восстановления __slots__, это в разы быстрее
+        return type(self), tuple(getattr(self, name) for name in self.fields) + (self.start, self.end)
+
+
+class Program(Node):
+    __slots__ = ("body",)
+    fields = ("body",)
+
+    def __init__(self, body: List[Node], start: int, end: int):
+        self.body = body
+        self.start = start
+        self.end = end
+
+
+class Block(Node):
+    """
+    Составной оператор { ... }
+    """
+    __slots__ = ("body",)
+    fields = ("body",)
+
+    def __init__(self, body: List[Node], start: int, end: int):
+        self.body = body
+        self.start = start
+        self.end = end
+
+
+class Let(Node):
+    __slots__ = ("name", "value")
+    fields = ("name", "value")
+
+    def __init__(self, name: str, value: Node, start: int, end: int):
+        self.name = name
+        self.value = value
+        self.start = start
+        self.end = end
+
+
+class Assign(Node):
+    __slots__ = ("name", "value")
+    fields = ("name", "value")
+
+    def __init__(self, name: str, value: Node, start: int, end: int):
+        self.name = name
+        self.value = value
+        self.start = start
+        self.end = end
+
+
+class If(Node):
+    __slots__ = ("condition", "then_branch", "else_branch")
+    fields = ("condition", "then_branch", "else_branch")
+
+    def __init__(self, condition: Node, then_branch: Optional[Block], else_branch: Optional[Block],
+                 start: int, end: int):
+        self.condition = condition
+        self.then_branch = then_branch
+        self.else_branch = else_branch
+        self.start = start
+        self.end = end
+
+
+class For(Node):
+    __slots__ = ("name", "first", "direction", "last", "body")
+    fields = ("name", "first", "direction", "last", "body")
+
+    def __init__(self, name: str, first: Node, direction: str, last: Node, body: Optional[Block],
+                 start: int, end: int):
+        self.name = name
+        self.first = first
+        self.direction = direction  # Ключевое слово между границами цикла
+        self.last = last
+        self.body = body
+        self.start = start
+        self.end = end
+
+
+class DoWhile(Node):
+    __slots__ = ("body", "condition")
+    fields = ("body", "condition")
+
+    def __init__(self, body: Optional[Block], condition: Optional[Node], start: int, end: int):
+        self.body = body
+        self.condition = condition
+        self.start = start
+        self.end = end
+
+
+class Input(Node):
+    __slots__ = ("name",)
+    fields = ("name",)
+
+    def __init__(self, name: str, start: int, end: int):
+        self.name = name
+        self.start = start
+        self.end = end
+
+
+class Output(Node):
+    __slots__ = ("value",)
+    fields = ("value",)
+
+    def __init__(self, value: Node, start: int, end: int):
+        self.value = value
+        self.start = start
+        self.end = end
+
+
+class Binary(Node):
+    __slots__ = ("operator", "left", "right", "__weakref__")  # Слабая ссылка - для таблицы хэш-консинга
+    fields = ("operator", "left", "right")
+
+    def __init__(self, operator: str, left: Node, right: Node, start: int, end: int):
+        self.operator = operator
+        self.left = left
+        self.right = right
+        self.start = start
+        self.end = end
+
+
+class Unary(Node):
+    __slots__ = ("operator", "operand", "__weakref__")
+    fields = ("operator", "operand")
+
+    def __init__(self, operator: str, operand: Node, start: int, end: int):
+        self.operator = operator
+        self.operand = operand
+        self.start = start
+        self.end = end
+
+
+class Name(Node):
+    __slots__ = ("name", "__weakref__")
+    fields = ("name",)
+
+    def __init__(self, name: str, start: int, end: int):
+        self.name = name
+        self.start = start
+        self.end = end
+
+
+class Number(Node):
+    __slots__ = ("value", "__weakref__")
+    fields = ("value",)
+
+    def __init__(self, value, start: int, end: int):
+        self.value = value
+        self.start = start
+        self.end = end
+
+
+def node_children(node: Node) -> List[Node]:
+    """
+    Потомки узла в порядке полей
+    """
+    children = []
+    for name in node.fields:
+        value = getattr(node, name)
+        if isinstance(value, Node):
+            children.append(value)
+        elif isinstance(value, list):
+            children.extend(value)
+    return children
+
+
+def node_literal(node: Node) -> Any:
+    """
+    Значения полей-листьев узла: одно значение, пара у for или None
+    """
+    values = tuple(value for value in (getattr(node, name) for name in node.fields)
+                   if value is not None and not isinstance(value, (Node, list)))
+    if not values:
+        return None
+    return values[0] if len(values) == 1 else values
+
+
+def iter_nodes(root: Node) -> Iterator[Node]:
+    """
+    Обход дерева в прямом порядке без рекурсии
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node_children(node)))
+
+
+def symbol_value(expression: Node) -> Any:
+    """
+    Значение для таблицы символов: число или имя как есть, иначе узел выражения
+    """
+    if isinstance(expression, Number):
+        return expression.value
+    if isinstance(expression, Name):
+        return expression.name
+    return expression
+
+
+# Типы узлов арены: код узла - индекс класса в этом кортеже
+NODE_TYPES = (Program, Block, Let, Assign, If, For, DoWhile, Input, Output, Binary, Unary, Name, Number)
+NODE_KINDS = {node_type: kind for kind, node_type in enumerate(NODE_TYPES)}
+(_KIND_PROGRAM, _KIND_BLOCK, _KIND_LET, _KIND_ASSIGN, _KIND_IF, _KIND_FOR, _KIND_DO_WHILE, _KIND_INPUT,
+ _KIND_OUTPUT, _KIND_BINARY, _KIND_UNARY, _KIND_NAME, _KIND_NUMBER) = range(len(NODE_TYPES))
+
+
+def row_value(expression: tuple) -> Any:
+    """
+    symbol_value для кортежа выражения разбора в арену: число или имя как есть,
+    иначе сам кортеж - узлом он становится в конце разбора
+    """
+    if expression[0] in (_KIND_NAME, _KIND_NUMBER):
+        return expression[2]
+    return expression
+
+
+class AstArena:
+    """
+    Синтаксическое дерево без объекта на каждый узел: узлы лежат в параллельных
+    массивах. first_child и next_sibling - связи (-1 - нет), token - индекс
+    первого токена узла, literal - индекс в таблице литералов literals (-1 - нет).
+    Узлы добавляются в прямом порядке, поэтому поддерево узла занимает
+    непрерывный отрезок индексов. Корень программы - узел 0
+    """
+
+    def __init__(self):
+        self.kinds = array("B")
+        self.first_child = array("i")
+        self.next_sibling = array("i")
+        self.token = array("i")
+        self.literal = array("i")
+        self.literals: List[Any] = []
+        # Ключ - строка или (тип, значение): 1 и 1.0 - разные литералы
+        self._literal_index: Dict[Any, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def add(self, kind: int, token: int, literal: Any = None) -> int:
+        """
+        Добавляет узел без связей и возвращает его индекс
+        """
+        index = len(self.kinds)
+        self.kinds.append(kind)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.token.append(token)
+        if literal is None:
+            self.literal.append(-1)
+        else:
+            key = literal if type(literal) is str else (type(literal), literal)
+            position = self._literal_index.get(key)
+            if position is None:
+                position = self._literal_index[key] = len(self.literals)
+                self.literals.append(literal)
+            self.literal.append(position)
+        return index
+
+    def add_child(self, parent: int, previous: int, kind: int, token: int, literal: Any = None) -> int:
+        """
+        Добавляет узел следующим потомком parent после previous (-1 - первым)
+        """
+        index = self.add(kind, token, literal)
+        if previous >= 0:
+            self.next_sibling[previous] = index
+        else:
+            self.first_child[parent] = index
+        return index
+
+    def add_expression(self, root: tuple, parent: int, previous: int = -1) -> int:
+        """
+        Переносит выражение из кортежей разбора (код, токен, литерал, начало,
+        конец, потомки) следующим потомком parent. Возвращает индекс корня
+        """
+        literals, literal_index = self.literals, self._literal_index
+        kinds, first_child, next_sibling, token_column, literal_column = (
+            self.kinds, self.first_child, self.next_sibling, self.token, self.literal)
+        first = index = len(kinds)
+        if previous >= 0:
+            next_sibling[previous] = index
+        else:
+            first_child[parent] = index
+        stack = [root]  # Кортежи узлов; число - индекс левого операнда, брат которого - следующий узел
+        while stack:
+            node = stack.pop()
+            if type(node) is int:
+                next_sibling[node] = index
+                continue
+            kind, token, literal, _, _, children = node
+            kinds.append(kind)
+            next_sibling.append(-1)
+            token_column.append(token)
+            if children:
+                # Прямой порядок: первый потомок - сразу за узлом
+                first_child.append(index + 1)
+                if len(children) == 2:
+                    stack.append(children[1])
+                    stack.append(index + 1)
+                stack.append(children[0])
+            else:
+                first_child.append(-1)
+            key = literal if type(literal) is str else (type(literal), literal)  # У выражений литерал есть всегда
+            position = literal_index.get(key)
+            if position is None:
+                position = literal_index[key] = len(literals)
+                literals.append(literal)
+            literal_column.append(position)
+            index += 1
+        return first
+
+    def mark(self) -> Tuple[int, int]:
+        """
+        Размеры арены и таблицы литералов для отката rollback
+        """
+        return len(self.kinds), len(self.literals)
+
+    def rollback(self, mark: Tuple[int, int], parent: int, previous: int):
+        """
+        Удаляет узлы и литералы, добавленные после mark, вместе со ссылкой на
+        первый удаленный узел из parent или previous
+        """
+        nodes, literals = mark
+        for column in (self.kinds, self.first_child, self.next_sibling, self.token, self.literal):
+            del column[nodes:]
+        for literal in self.literals[literals:]:
+            del self._literal_index[literal if type(literal) is str else (type(literal), literal)]
+        del self.literals[literals:]
+        if previous >= 0:
+            self.next_sibling[previous] = -1
+        elif 0 <= parent < nodes:
+            self.first_child[parent] = -1
+
+    def add_tree(self, root: Node, token_index, parent: int = -1, previous: int = -1) -> int:
+        """
+        Переносит дерево узлов-объектов в арену последним потомком parent
+        (previous - его предыдущий потомок). token_index(offset) - индекс токена
+        по смещению. Возвращает индекс корня
+        """
+        first = len(self.kinds)
+        last: Dict[int, int] = {parent: previous}  # Последний уже добавленный потомок узла
+        stack = [(root, parent)]
+        while stack:
+            node, owner = stack.pop()
+            index = self.add(NODE_KINDS[type(node)], token_index(node.start), node_literal(node))
+            if owner >= 0:
+                if last.get(owner, -1) >= 0:
+                    self.next_sibling[last[owner]] = index
+                else:
+                    self.first_child[owner] = index
+                last[owner] = index
+            stack.extend((child, index) for child in reversed(node_children(node)))
+        return first
+
+    def node_type(self, index: int) -> type:
+        return NODE_TYPES[self.kinds[index]]
+
+    def value(self, index: int) -> Any:
+        """
+        Литерал узла: имя, операция, число; у for - пара (имя, ключевое слово)
+        """
+        position = self.literal[index]
+        return self.literals[position] if position >= 0 else None
+
+    def children(self, index: int) -> Iterator[int]:
+        child = self.first_child[index]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def subtree_end(self, index: int) -> int:
+        """
+        Индекс за последним узлом поддерева: спуск по последним потомкам
+        """
+        first_child, next_sibling = self.first_child, self.next_sibling
+        while first_child[index] >= 0:
+            index = first_child[index]
+            while next_sibling[index] >= 0:
+                index = next_sibling[index]
+        return index + 1
+
+    def walk(self, index: int = 0) -> range:
+        """
+        Узлы поддерева в прямом порядке; поддерево непрерывно, поэтому это отрезок индексов
+        """
+        return range(index, self.subtree_end(index))
+
+    def select(self, node_type: type) -> List[int]:
+        """
+        Индексы всех узлов данного типа; с numpy - векторным сравнением
+        """
+        kind = NODE_KINDS[node_type]
+        if np is not None:
+            return np.flatnonzero(np.frombuffer(self.kinds, np.uint8) == kind).tolist()
+        return [index for index, node_kind in enumerate(self.kinds) if node_kind == kind]
+
+    def numpy_columns(self) -> Dict[str, Any]:
+        """
+        Массивы арены как массивы numpy без копирования
+        """
+        if np is None:
+            raise ImportError("numpy_columns нужен пакет numpy")
+        return {"kinds": np.frombuffer(self.kinds, np.uint8),
+                "first_child": np.frombuffer(self.first_child, np.int32),
+                "next_sibling": np.frombuffer(self.next_sibling, np.int32),
+                "token": np.frombuffer(self.token, np.int32),
+                "literal": np.frombuffer(self.literal, np.int32)}
+
+    def nbytes(self) -> int:
+        """
+        Объем массивов арены в байтах (без таблицы литералов)
+        """
+        return sum(column.itemsize * len(column)
+                   for column in (self.kinds, self.first_child, self.next_sibling, self.token, self.literal))
+
+
+# Приоритеты операций в выражениях: чем больше, тем сильнее связывает.
+# Бинарные операции левоассоциативны, унарная not сильнее любой бинарной
+BINARY_PRECEDENCE = {REL_OP: 1, ADD_OP: 2, MUL_OP: 3}
+UNARY_PRECEDENCE = 4
+# Запись числа в тексте: значение токена NUMBER исходную запись не хранит
+_NUMBER_LEXEME = re.compile(r'\d+(?:\.\d+)?(?:[Ee][+-]?\d+)?')
+
+# Режимы синтаксического анализатора: рекурсивный спуск, явный стек состояний,
+# таблица LL(1), построенная по декларативной грамматике, или параллельный разбор
+# операторов верхнего уровня в пуле процессов
+PARSER_MODES = ("recursive", "stack", "table", "parallel")
+# Меньше токенов на процесс не делим: передача дерева обратно дороже разбора
+PARALLEL_MIN_TOKENS = 1 << 16
+# Состояния стекового разбора операторов
+(_STATE_PROGRAM, _STATE_BLOCK, _STATE_AFTER_THEN, _STATE_AFTER_DO) = range(4)
+
+
+def split_statements(codes: Iterable[int], count: int, parts: int, min_tokens: int = PARALLEL_MIN_TOKENS) -> List[int]:
+    """
+    Предварительный проход по скобкам: номера токенов, с которых начинаются
+    операторы верхнего уровня программы, примерно через равные доли, включая 1
+    (после '{') и count - 1 (закрывающая '}'). Оператор кончается на ';' или на '}'
+    на глубине программы, если дальше не else и не while цикла do. Пустой
+    список - скобки не сбалансированы, делить нечего
+    """
+    step = max((count - 2) // max(parts, 1), min_tokens)
+    bounds = [1]
+    target = 1 + step
+    depth = 0
+    after_block = False  # Предыдущий токен - '}', закрывший блок верхнего уровня
+    for index, code in enumerate(codes):
+        if after_block and index >= target and code != ELSE and code != WHILE:
+            bounds.append(index)
+            target = index + step
+        after_block = False
+        if code == LBRACE:
+            depth += 1
+        elif code == RBRACE:
+            depth -= 1
+            if depth <= 0 and index != count - 1:
+                return []
+            after_block = depth == 1
+        elif code == SEMICOLON and depth == 1 and index + 1 >= target:
+            bounds.append(index + 1)
+            target = index + 1 + step
+    if depth != 0:
+        return []
+    if bounds[-1] != count - 1:
+        bounds.append(count - 1)
+    return bounds
+
+
+def _parse_segment(tokens: Sequence, source: Optional[str], base: int) -> Optional[Tuple[List[Node], Dict[str, Any]]]:
+    """
+    Разбор последовательности операторов верхнего уровня в процессе пула.
+    Смещения токенов отсчитываются от начала source (текст фрагмента), узлы
+    сдвигаются на base. None - синтаксическая ошибка: сообщение о ней дает
+    последовательный разбор всей программы
+    """
+    parser = SyntaxAnalyzer(tokens, LineIndex(source) if source is not None else None)
+    body = []
+    try:
+        while parser.current_token < len(tokens):
+            if parser.peek_code() == LET:
+                body.append(parser.parse_declaration())
+            else:
+                body.append(parser.parse_statement())
+    except SyntaxError:
+        return None
+    if base:
+        for statement in body:
+            for node in iter_nodes(statement):
+                node.start += base
+                node.end += base
+    return body, parser.symbol_table
+
+
+class _TableRow(dict):
+    """
+    Строка таблицы LL(1) для нетерминала: код токена (None - конец файла) -> номер
+    продукции. default - ε-продукция, выбираемая при любом другом токене
+    """
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+        self.default: Optional[int] = None
+
+
+# Таблицы LL(1) процесса, ключ - отпечаток грамматики
+_ll1_tables: Dict[str, Tuple[Dict[str, _TableRow], List[tuple], List[int], List[int],
+                              List[Tuple[str, Any, int, int]]]] = {}
+# Виды раскрытия продукции в табличном разборе: пустая правая часть; общий случай;
+# первый символ - терминал (он уже совпал с текущим токеном и сдвигается сразу);
+# единственный терминал с действием (узел строится без стека)
+(_EXPAND_EMPTY, _EXPAND, _EXPAND_SHIFT, _EXPAND_TOKEN) = range(4)
+
+
+class Grammar:
+    """
+    Декларативная грамматика: продукции (левая часть, правая часть, действие).
+    Терминалы - коды токенов, нетерминалы - строки. Действие - имя метода
+    SyntaxAnalyzer, который строит значение из значений правой части; None
+    допустим для продукции из одного символа и передает его значение как есть.
+    errors - сообщения об ошибке для нетерминалов ({found} - найденный токен);
+    у остальных нетерминалов ε-продукция выбирается при любом неожиданном
+    токене, и ошибку сообщает следующий терминал. commit - сколько первых
+    символов продукций нетерминала должно совпасть, чтобы выбор стал
+    окончательным (по умолчанию один, как в LL(1)); несовпадение раньше
+    сообщается по errors[нетерминал] с первым токеном продукции в {found}
+    """
+
+    def __init__(self, start: str, productions, errors: Optional[Dict[str, str]] = None,
+                 commit: Optional[Dict[str, int]] = None):
+        self.start = start
+        self.productions = tuple((lhs, tuple(rhs), action) for lhs, rhs, action in productions)
+        self.errors = dict(errors or {})
+        self.commit = dict(commit or {})
+        self.nonterminals = list(dict.fromkeys(lhs for lhs, _, _ in self.productions))
+        missing = {symbol for _, rhs, _ in self.productions for symbol in rhs
+                   if isinstance(symbol, str)} - set(self.nonterminals)
+        if missing:
+            raise ValueError(f"Нетерминалы без продукций: {', '.join(sorted(missing))}")
+        for lhs, rhs, action in self.productions:
+            if action is None and len(rhs) != 1:
+                raise ValueError(f"Продукции {lhs} без действия нужен ровно один символ")
+        self.nullable, self.first = self._first_sets()
+        self.follow = self._follow_sets()
+
+    def first_of(self, symbols, first=None, nullable=None) -> Tuple[set, bool]:
+        """
+        FIRST цепочки символов и признак того, что она выводит пустую цепочку
+        """
+        first = self.first if first is None else first
+        nullable = self.nullable if nullable is None else nullable
+        result = set()
+        for symbol in symbols:
+            if not isinstance(symbol, str):
+                result.add(symbol)
+                return result, False
+            result |= first[symbol]
+            if symbol not in nullable:
+                return result, False
+        return result, True
+
+    def _first_sets(self) -> Tuple[set, Dict[str, set]]:
+        nullable = set()
+        first = {name: set() for name in self.nonterminals}
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, _ in self.productions:
+                symbols, empty = self.first_of(rhs, first, nullable)
+                if not symbols <= first[lhs]:
+                    first[lhs] |= symbols
+                    changed = True
+                if empty and lhs not in nullable:
+                    nullable.add(lhs)
+                    changed = True
+        return nullable, first
+
+    def _follow_sets(self) -> Dict[str, set]:
+        follow = {name: set() for name in self.nonterminals}
+        follow[self.start].add(None)  # Конец файла
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, _ in self.productions:
+                for index, symbol in enumerate(rhs):
+                    if not isinstance(symbol, str):
+                        continue
+                    symbols, empty = self.first_of(rhs[index + 1:])
+                    if empty:
+                        symbols = symbols | follow[lhs]
+                    if not symbols <= follow[symbol]:
+                        follow[symbol] |= symbols
+                        changed = True
+        return follow
+
+    def fingerprint(self) -> str:
+        """
+        Отпечаток грамматики (sha256 от продукций и сообщений об ошибках)
+        """
+        return hashlib.sha256(repr((self.start, self.productions, sorted(self.errors.items()))).encode()).hexdigest()
 
-    def tokenize(self, program: str) -> List[Tuple[str, Any]]:
+    def compile(self) -> Tuple[Dict[str, _TableRow], List[tuple], List[int], List[int],
+                               List[Tuple[str, Any, int, int]]]:
         """
-        Лексический анализ программы
+        Таблица LL(1): строки нетерминалов, раскрытия продукций для стека
+        разбора, виды раскрытия, длины правых частей и конфликты (нетерминал,
+        токен, выбранная продукция, отброшенная продукция). Кэшируется
+        по отпечатку грамматики
         """
-        tokens = []
-        errors = []
-        for match in re.finditer(self.token_regex, program):
-            kind = match.lastgroup
-            value = match.group(kind)
-            if kind in ("WHITESPACE", "NEWLINE", "COMMENT"):
-                continue
-            elif kind == "NUMBER":
-                value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
-            tokens.append((kind, value))
+        fingerprint = self.fingerprint()
+        compiled = _ll1_tables.get(fingerprint)
+        if compiled is None:
+            compiled = _ll1_tables[fingerprint] = self._build_table()
+        return compiled
+
+    def _build_table(self):
+        rows = {name: _TableRow(name) for name in self.nonterminals}
+        conflicts = []
+        for index, (lhs, rhs, _) in enumerate(self.productions):
+            row = rows[lhs]
+            lookahead, empty = self.first_of(rhs)
+            if empty:
+                lookahead = lookahead | self.follow[lhs]
+                if not rhs:
+                    if lhs in self.errors:
+                        lookahead.add(None)
+                    else:
+                        row.default = index
+            for code in lookahead:
+                if code in row and row[code] != index:
+                    conflicts.append((lhs, code, row[code], index))  # Остается первая продукция
+                else:
+                    row[code] = index
+        # Цепные продукции A -> B без действия: строка A сразу выбирает продукцию B
+        # для того же токена, и B не раскрывается отдельным шагом
+        for row in rows.values():
+            for code, index in row.items():
+                _, rhs, action = self.productions[index]
+                while action is None and isinstance(rhs[0], str) and code in rows[rhs[0]]:
+                    index = rows[rhs[0]][code]
+                    _, rhs, action = self.productions[index]
+                row[code] = index
+        # Раскрытие продукции: маркер сборки (~номер) и правая часть в обратном порядке,
+        # без первого терминала у вида _EXPAND_SHIFT
+        expansions = []
+        shapes = []
+        for index, (_, rhs, action) in enumerate(self.productions):
+            if not rhs:
+                shape = _EXPAND_EMPTY
+            elif isinstance(rhs[0], str):
+                shape = _EXPAND
+            elif len(rhs) == 1 and action is not None:
+                shape = _EXPAND_TOKEN
+            else:
+                shape = _EXPAND_SHIFT
+            rest = rhs[1:] if shape == _EXPAND_SHIFT else rhs
+            symbols = tuple(rows[symbol] if isinstance(symbol, str) else symbol for symbol in reversed(rest))
+            expansions.append(symbols if action is None else (~index,) + symbols)
+            shapes.append(shape)
+        lengths = [len(rhs) for _, rhs, _ in self.productions]
+        return rows, expansions, shapes, lengths, conflicts
 
-        # Проверка на оставшиеся нераспознанные символы
-        non_matching = re.finditer(r'[^\s]', program)
-        for match in non_matching:
-            if not any(re.match(spec[1], match.group(0)) for spec in self.token_specification):
-                errors.append(f"Неизвестный символ: {match.group(0)}")
+    def conflict_report(self) -> List[str]:
+        """
+        Конфликты LL(1) в читаемом виде; пустой список - грамматика LL(1)
+        """
+        report = []
+        for lhs, code, chosen, dropped in self.compile()[4]:
+            terminal = "конец файла" if code is None else TOKEN_NAMES[code]
+            report.append(f"{lhs} при {terminal}: продукции {self.describe(chosen)} и {self.describe(dropped)}")
+        return report
 
-        return tokens, errors
+    def describe(self, index: int) -> str:
+        lhs, rhs, _ = self.productions[index]
+        symbols = [symbol if isinstance(symbol, str) else TOKEN_NAMES[symbol] for symbol in rhs]
+        return f"{lhs} -> {' '.join(symbols) or 'ε'}"
+
+
+# Грамматика модельного языка. Выражение - операнды через бинарные операции;
+# хвост OperatorTail собирает пары (операция, операнд), а приоритеты
+# BINARY_PRECEDENCE применяются при свертке, как и в parse_expression
+MODEL_GRAMMAR = Grammar("Program", [
+    ("Program", (LBRACE, "Items", RBRACE), "build_program"),
+    ("Items", ("Declaration", "Items"), "build_sequence"),
+    ("Items", ("Statement", "Items"), "build_sequence"),
+    ("Items", (), "build_empty"),
+    ("Statements", ("Statement", "Statements"), "build_sequence"),
+    ("Statements", (), "build_empty"),
+    ("Declaration", (LET, IDENTIFIER, ASSIGN, "Expression", SEMICOLON), "build_declaration"),
+    ("Statement", ("Assignment",), None),
+    ("Statement", ("Conditional",), None),
+    ("Statement", ("FixedLoop",), None),
+    ("Statement", ("WhileLoop",), None),
+    ("Statement", ("Input",), None),
+    ("Statement", ("Output",), None),
+    ("Statement", ("Block",), None),
+    ("Assignment", (IDENTIFIER, ASSIGN, "Expression", SEMICOLON), "build_assignment"),
+    ("Conditional", (IF, "Expression", THEN, "Block", "ElsePart"), "build_conditional"),
+    ("ElsePart", (ELSE, "Block"), "build_else"),
+    ("ElsePart", (), "build_none"),
+    ("FixedLoop", (FOR, IDENTIFIER, ASSIGN, "Expression", "Keyword", "Expression", "Block"), "build_fixed_loop"),
+    *(("Keyword", (code,), None) for code in range(LET, OUTPUT + 1)),
+    ("WhileLoop", (DO, "Block", WHILE, "Expression"), "build_while_loop"),
+    ("Input", (INPUT, IDENTIFIER, SEMICOLON), "build_input"),
+    ("Output", (OUTPUT, "Expression", SEMICOLON), "build_output"),
+    ("Block", (LBRACE, "Statements", RBRACE), "build_block"),
+    ("Expression", ("Factor", "OperatorTail"), "build_expression"),
+    *(("OperatorTail", (code, "Factor", "OperatorTail"), "build_tail") for code in BINARY_PRECEDENCE),
+    ("OperatorTail", (), "build_empty"),
+    ("Factor", (UNARY_OP, "Factor"), "build_unary"),
+    ("Factor", (IDENTIFIER,), "build_name"),
+    ("Factor", (NUMBER,), "build_number"),
+    ("Factor", (LPAREN, "Expression", RPAREN), "build_parenthesized"),
+], errors={
+    "Items": "Неизвестный оператор: {found}",
+    "Statements": "Неизвестный оператор: {found}",
+    "Statement": "Неизвестный оператор: {found}",
+    "Keyword": "Ожидался KEYWORD, найдено {found}",
+    "Expression": "Ожидался IDENTIFIER или NUMBER, найдено {found}",
+    "Factor": "Ожидался IDENTIFIER или NUMBER, найдено {found}",
+    # Рекурсивный спуск выбирает присваивание по двум токенам, IDENTIFIER и ASSIGN
+    "Assignment": "Неизвестный оператор: {found}",
+}, commit={"Assignment": 2})
+
+
+# Предел числа синтаксических ошибок в режиме восстановления
+MAX_SYNTAX_ERRORS = 100
+# Токены, с которых начинается оператор: на них останавливается синхронизация
+_SYNC_CODES = frozenset((LET, IF, FOR, DO, INPUT, OUTPUT))
+
+
+class _ErrorLimit(Exception):
+    """
+    Достигнут предел числа синтаксических ошибок
+    """
 
 
 class SyntaxAnalyzer:
-    def __init__(self, tokens: List[Tuple[str, Any]]):
+    def __init__(self, tokens: List[Token], lines: Optional[LineIndex] = None, mode: str = "recursive",
+                 grammar: Grammar = MODEL_GRAMMAR, recover: bool = False, max_errors: int = MAX_SYNTAX_ERRORS,
+                 workers: Optional[int] = None, hash_cons: bool = False):
+        if mode not in PARSER_MODES:
+            raise ValueError(f"Неизвестный режим синтаксического анализатора: {mode}")
+        if recover and mode != "recursive":
+            raise ValueError("Восстановление после ошибок есть только в режиме recursive")
+        if hash_cons and mode not in ("recursive", "stack"):
+            raise ValueError("Хэш-консинг выражений есть только в режимах recursive и stack")
         self.tokens = tokens
         self.current_token = 0
         self.symbol_table = {}
+        self.lines = lines  # Индекс строк для сообщений об ошибках
+        self.mode = mode
+        self.grammar = grammar  # Грамматика табличного режима
+        self.recover = recover  # Записывать ошибки и продолжать разбор с точки синхронизации
+        self.max_errors = max_errors
+        self.errors: List[str] = []
+        self.workers = workers  # Процессов параллельного режима, по умолчанию по числу ядер
+        # Хэш-консинг выражений: структура узла -> живой общий узел
+        self.expressions: Optional[weakref.WeakValueDictionary] = weakref.WeakValueDictionary() if hash_cons else None
+        self.expression_nodes = 0  # Построено узлов выражений при хэш-консинге
+        self.unique_expressions = 0  # Из них новых, остальные заменены общими
 
     def parse(self) -> Dict[str, Any]:
         """
-        Синтаксический анализ программы
+        Синтаксический анализ программы; при успехе в результате есть дерево "tree".
+        В режиме восстановления при ошибках результат содержит все ошибки "errors",
+        частичную таблицу символов и частичное дерево
+        """
+        tree = None
+        try:
+            if self.mode == "stack":
+                tree = self.parse_program_stack()
+            elif self.mode == "table":
+                tree = self.parse_program_table()
+            elif self.mode == "parallel":
+                tree = self.parse_program_parallel()
+            else:
+                tree = self.parse_program()
+        except SyntaxError as e:
+            if not self.recover:
+                return {"success": False, "error": str(e)}
+            self.errors.append(str(e))  # Ошибка вне операторов, например нет открывающей {
+        except _ErrorLimit:
+            self.errors.append(f"Больше {self.max_errors} синтаксических ошибок, разбор остановлен")
+        if self.errors:
+            return {"success": False, "error": self.errors[0], "errors": self.errors,
+                    "symbol_table": self.symbol_table, "tree": tree}
+        return {"success": True, "symbol_table": self.symbol_table, "tree": tree}
+
+    def record_error(self, error: SyntaxError):
+        """
+        Записывает ошибку режима восстановления; повтор той же ошибки подряд
+        (несколько незакрытых блоков в конце файла) не записывается
+        """
+        message = str(error)
+        if self.errors and self.errors[-1] == message:
+            return
+        if len(self.errors) >= self.max_errors:
+            raise _ErrorLimit()
+        self.errors.append(message)
+
+    def parse_item(self, parse) -> Optional[Node]:
+        """
+        Разбор одного оператора. В режиме восстановления ошибка записывается,
+        токены пропускаются до точки синхронизации, и возвращается None
+        """
+        if not self.recover:
+            return parse()
+        start = self.current_token
+        try:
+            return parse()
+        except SyntaxError as e:
+            self.record_error(e)
+            self.synchronize(start)
+            return None
+
+    def synchronize(self, start: int):
+        """
+        Пропуск токенов после ошибки: до ; (включительно), до } или до начала
+        оператора. Вложенные блоки { ... } пропускаются целиком. Хотя бы один
+        токен пропускается всегда, чтобы разбор не зациклился
+        """
+        tokens = self.tokens
+        if self.current_token == start:
+            self.current_token += 1
+        depth = 0
+        while self.current_token < len(tokens):
+            code = tokens[self.current_token][0]
+            if code == LBRACE:
+                depth += 1
+            elif code == RBRACE:
+                if not depth:
+                    return
+                depth -= 1
+                if not depth:
+                    self.current_token += 1
+                    return
+            elif not depth:
+                if code == SEMICOLON:
+                    self.current_token += 1
+                    return
+                if code in _SYNC_CODES:
+                    return
+            self.current_token += 1
+
+    def close_block(self) -> int:
+        """
+        Закрывающая } блока или программы; возвращает смещение конца. В режиме
+        восстановления блок, не закрытый до конца файла, закрывается там
+        """
+        if not self.recover or self.current_token < len(self.tokens):
+            return self.token_end(self.match(RBRACE))  # }
+        try:
+            self.match(RBRACE)
+        except SyntaxError as e:
+            self.record_error(e)
+        return self.token_end(self.tokens[-1])
+
+    def parse_arena(self) -> Dict[str, Any]:
+        """
+        Разбор в арену AstArena: узлы добавляются в арену прямо во время разбора,
+        без объектов узлов, индекс токена узла - текущая позиция разбора. Над
+        TokenRing это разбор в постоянной памяти (кроме арены и таблицы символов).
+        Выражение разбирается в кортежи и переносится в арену целиком; значения-
+        выражения таблицы символов становятся узлами в конце разбора. Результат -
+        как у parse, с ареной "arena" вместо дерева
         """
+        arena = AstArena()
         try:
-            self.parse_program()
-            return {"success": True, "symbol_table": self.symbol_table}
+            self.arena_program(arena)
         except SyntaxError as e:
-            return {"success": False, "error": str(e)}
+            if not self.recover:
+                return {"success": False, "error": str(e)}
+            self.errors.append(str(e))  # Ошибка вне операторов, например нет открывающей {
+        except _ErrorLimit:
+            self.errors.append(f"Больше {self.max_errors} синтаксических ошибок, разбор остановлен")
+        for entry in self.symbol_table.values():
+            if isinstance(entry["value"], tuple):
+                entry["value"] = self.expression_node(entry["value"])
+        if self.errors:
+            return {"success": False, "error": self.errors[0], "errors": self.errors,
+                    "symbol_table": self.symbol_table, "arena": arena}
+        return {"success": True, "symbol_table": self.symbol_table, "arena": arena}
+
+    def arena_program(self, arena: AstArena):
+        arena.add(_KIND_PROGRAM, self.current_token)
+        self.match(LBRACE)  # {
+        previous = -1
+        while self.current_token < len(self.tokens) and self.tokens[self.current_token][0] != RBRACE:
+            parse = self.arena_declaration if self.tokens[self.current_token][0] == LET else self.arena_statement
+            previous = self.arena_item(arena, parse, 0, previous)
+        self.close_block()
+
+    def arena_item(self, arena: AstArena, parse, parent: int, previous: int) -> int:
+        """
+        parse_item для разбора в арену: parse добавляет оператор потомком parent
+        после previous и возвращает его индекс. В режиме восстановления узлы
+        оператора с ошибкой удаляются из арены и возвращается previous
+        """
+        if not self.recover:
+            return parse(arena, parent, previous)
+        start = self.current_token
+        mark = arena.mark()
+        try:
+            return parse(arena, parent, previous)
+        except SyntaxError as e:
+            arena.rollback(mark, parent, previous)
+            self.record_error(e)
+            self.synchronize(start)
+            return previous
+
+    def arena_declaration(self, arena: AstArena, parent: int, previous: int) -> int:
+        start = self.current_token
+        self.match(LET)  # let
+        identifier = self.match(IDENTIFIER)
+        self.match(ASSIGN)
+        value = self.parse_expression_row()
+        self.match(SEMICOLON)  # ;
+        self.symbol_table[identifier[1]] = {"type": "variable", "value": row_value(value), "declared": True}
+        index = arena.add_child(parent, previous, _KIND_LET, start, identifier[1])
+        arena.add_expression(value, index)
+        return index
+
+    def arena_statement(self, arena: AstArena, parent: int, previous: int) -> int:
+        if self.current_token >= len(self.tokens):
+            raise SyntaxError("Неожиданный конец файла")
+
+        current = self.tokens[self.current_token]
+        code = current[0]
+        if code == IDENTIFIER and self.peek_code(1) == ASSIGN:
+            return self.arena_assignment(arena, parent, previous)
+        elif code == IF:
+            return self.arena_conditional(arena, parent, previous)
+        elif code == FOR:
+            return self.arena_fixed_loop(arena, parent, previous)
+        elif code == DO:
+            return self.arena_while_loop(arena, parent, previous)
+        elif code == INPUT:
+            return self.arena_input(arena, parent, previous)
+        elif code == OUTPUT:
+            return self.arena_output(arena, parent, previous)
+        elif code == LBRACE:
+            return self.arena_block(arena, parent, previous)
+        else:
+            raise self.error(f"Неизвестный оператор: {describe_token(current)}", current)
+
+    def arena_assignment(self, arena: AstArena, parent: int, previous: int) -> int:
+        start = self.current_token
+        identifier = self.match(IDENTIFIER)
+        self.match(ASSIGN)
+        value = self.parse_expression_row()
+        self.match(SEMICOLON)  # ;
+        if identifier[1] in self.symbol_table:
+            self.symbol_table[identifier[1]]["value"] = row_value(value)
+        else:
+            self.symbol_table[identifier[1]] = {"type": "variable", "value": row_value(value)}
+        index = arena.add_child(parent, previous, _KIND_ASSIGN, start, identifier[1])
+        arena.add_expression(value, index)
+        return index
 
-    def match(self, expected_type: str) -> Optional[Tuple[str, Any]]:
-        if self.current_token < len(self.tokens) and self.tokens[self.current_token][0] == expected_type:
+    def arena_conditional(self, arena: AstArena, parent: int, previous: int) -> int:
+        start = self.current_token
+        self.match(IF)  # if
+        condition = self.parse_expression_row()
+        self.match(THEN)  # then
+        index = arena.add_child(parent, previous, _KIND_IF, start)
+        branch = self.arena_block(arena, index, arena.add_expression(condition, index))
+        if self.peek_code() == ELSE:
+            self.match(ELSE)  # else
+            self.arena_block(arena, index, branch)
+        return index
+
+    def arena_fixed_loop(self, arena: AstArena, parent: int, previous: int) -> int:
+        start = self.current_token
+        self.match(FOR)  # for
+        identifier = self.match(IDENTIFIER)
+        self.match(ASSIGN)
+        first = self.parse_expression_row()
+        direction = self.match_keyword()  # to/downto (упрощено)
+        last = self.parse_expression_row()
+        index = arena.add_child(parent, previous, _KIND_FOR, start, (identifier[1], direction[1]))
+        bound = arena.add_expression(last, index, arena.add_expression(first, index))
+        self.arena_block(arena, index, bound)
+        return index
+
+    def arena_while_loop(self, arena: AstArena, parent: int, previous: int) -> int:
+        start = self.current_token
+        self.match(DO)  # do
+        index = arena.add_child(parent, previous, _KIND_DO_WHILE, start)
+        body = self.arena_block(arena, index, -1)
+        self.match(WHILE)  # while
+        arena.add_expression(self.parse_expression_row(), index, body)
+        return index
+
+    def arena_input(self, arena: AstArena, parent: int, previous: int) -> int:
+        start = self.current_token
+        self.match(INPUT)  # input
+        identifier = self.match(IDENTIFIER)
+        self.match(SEMICOLON)  # ;
+        return arena.add_child(parent, previous, _KIND_INPUT, start, identifier[1])
+
+    def arena_output(self, arena: AstArena, parent: int, previous: int) -> int:
+        start = self.current_token
+        self.match(OUTPUT)  # output
+        value = self.parse_expression_row()
+        self.match(SEMICOLON)  # ;
+        index = arena.add_child(parent, previous, _KIND_OUTPUT, start)
+        arena.add_expression(value, index)
+        return index
+
+    def arena_block(self, arena: AstArena, parent: int, previous: int) -> int:
+        start = self.current_token
+        self.match(LBRACE)  # {
+        index = arena.add_child(parent, previous, _KIND_BLOCK, start)
+        child = -1
+        while self.current_token < len(self.tokens) and self.tokens[self.current_token][0] != RBRACE:
+            child = self.arena_item(arena, self.arena_statement, index, child)
+        self.close_block()
+        return index
+
+    @classmethod
+    def from_stream(cls, tokens: Iterable[Token], lines: Optional[LineIndex] = None,
+                    size: int = TOKEN_RING_SIZE, **options) -> "SyntaxAnalyzer":
+        """
+        Анализатор над любым итератором токенов, например tokenize_stream:
+        токены читаются через окно TokenRing и целиком в памяти не хранятся
+        """
+        return cls(TokenRing(tokens, size), lines, **options)
+
+    def iter_program(self) -> Iterator[Node]:
+        """
+        Операторы верхнего уровня программы по одному, без общего узла Program.
+        Вместе с TokenRing это разбор в постоянной памяти (кроме таблицы символов).
+        Ошибка разбора - SyntaxError, в режиме восстановления ошибки копятся в errors
+        """
+        self.match(LBRACE)  # {
+        try:
+            while self.current_token < len(self.tokens) and self.tokens[self.current_token][0] != RBRACE:
+                if self.tokens[self.current_token][0] == LET:
+                    statement = self.parse_item(self.parse_declaration)
+                else:
+                    statement = self.parse_item(self.parse_statement)
+                if statement is not None:
+                    yield statement
+            self.close_block()
+        except _ErrorLimit:
+            self.errors.append(f"Больше {self.max_errors} синтаксических ошибок, разбор остановлен")
+
+    def token_index(self, offset: int) -> int:
+        """
+        Индекс токена, начинающегося со смещения offset
+        """
+        if isinstance(self.tokens, TokenBuffer):
+            return bisect.bisect_left(self.tokens.starts, offset)
+        return bisect.bisect_left(self.tokens, offset, key=itemgetter(2))
+
+    def error(self, message: str, token: Optional[Token] = None) -> SyntaxError:
+        """
+        Ошибка с позицией токена; строка и столбец вычисляются только здесь
+        """
+        if token is not None:
+            where = self.lines.describe(token[2]) if self.lines is not None else f"позиция {token[2]}"
+            message = f"{message} ({where})"
+        return SyntaxError(message)
+
+    def token_end(self, token: Token) -> int:
+        """
+        Смещение конца лексемы токена. Длина записи числа берется из текста,
+        если он известен через индекс строк
+        """
+        value = token[1]
+        if isinstance(value, str):
+            return token[2] + len(value)
+        if self.lines is not None and isinstance(self.lines.source, str):
+            return _NUMBER_LEXEME.match(self.lines.source, token[2]).end()
+        return token[2] + len(str(value))
+
+    def match(self, expected_code: int) -> Optional[Token]:
+        if self.current_token < len(self.tokens) and self.tokens[self.current_token][0] == expected_code:
+            token = self.tokens[self.current_token]
+            self.current_token += 1
+            return token
+        expected = repr(TOKEN_LEXEMES[expected_code]) if expected_code in TOKEN_LEXEMES else TOKEN_NAMES[expected_code]
+        token_found = self.tokens[self.current_token] if self.current_token < len(self.tokens) else None
+        raise self.error(f"Ожидался {expected}, найдено {describe_token(token_found)}", token_found)
+
+    def match_keyword(self) -> Token:
+        if self.current_token < len(self.tokens) and LET <= self.tokens[self.current_token][0] <= OUTPUT:
             token = self.tokens[self.current_token]
             self.current_token += 1
             return token
-        token_found = self.tokens[self.current_token] if self.current_token < len(self.tokens) else "конец файла"
-        raise SyntaxError(f"Ожидался {expected_type}, найдено {token_found}")
-
-    def parse_program(self):
-        self.match("DELIMITER")  # {
-        while self.current_token < len(self.tokens) and self.tokens[self.current_token][1] != "}":
-            if self.tokens[self.current_token][0] == "KEYWORD" and self.tokens[self.current_token][1] == "let":
-                self.parse_declaration()
+        token_found = self.tokens[self.current_token] if self.current_token < len(self.tokens) else None
+        raise self.error(f"Ожидался KEYWORD, найдено {describe_token(token_found)}", token_found)
+
+    def parse_program(self) -> Program:
+        program = Program([], self.match(LBRACE)[2], 0)  # {
+        while self.current_token < len(self.tokens) and self.tokens[self.current_token][0] != RBRACE:
+            if self.tokens[self.current_token][0] == LET:
+                statement = self.parse_item(self.parse_declaration)
             else:
-                self.parse_statement()
-        self.match("DELIMITER")  # }
+                statement = self.parse_item(self.parse_statement)
+            if statement is not None:
+                program.body.append(statement)
+        program.end = self.close_block()
+        return program
 
-    def parse_declaration(self):
+    def parse_declaration(self) -> Let:
         """
         Разбор объявления переменной (let x = 10;)
         """
-        self.match("KEYWORD")  # let
-        identifier = self.match("IDENTIFIER")  # Переменная
-        self.match("ASSIGN")  # Знак =
+        start = self.match(LET)[2]  # let
+        identifier = self.match(IDENTIFIER)  # Переменная
+        self.match(ASSIGN)  # Знак =
         value = self.parse_expression()  # Получаем значение
-        self.match("DELIMITER")  # ;
-        self.symbol_table[identifier[1]] = {"type": "variable", "value": value}
+        end = self.token_end(self.match(SEMICOLON))  # ;
+        self.symbol_table[identifier[1]] = {"type": "variable", "value": symbol_value(value)}
         # Добавляем переменную в множество объявленных
         self.symbol_table[identifier[1]]["declared"] = True
+        return Let(identifier[1], value, start, end)
 
-    def parse_statement(self):
+    def parse_statement(self) -> Node:
         if self.current_token >= len(self.tokens):
             raise SyntaxError("Неожиданный конец файла")
 
         current = self.tokens[self.current_token]
-        if current[0] == "IDENTIFIER" and self.tokens[self.current_token + 1][0] == "ASSIGN":
-            self.parse_assignment()
-        elif current[0] == "KEYWORD":
-            if current[1] == "if":
-                self.parse_conditional()
-            elif current[1] == "for":
-                self.parse_fixed_loop()
-            elif current[1] == "do":
-                self.parse_while_loop()
-            elif current[1] == "input":
-                self.parse_input()
-            elif current[1] == "output":
-                self.parse_output()
-        elif current[0] == "DELIMITER" and current[1] == "{":
-            self.parse_compound_statement()
+        code = current[0]
+        if code == IDENTIFIER and self.peek_code(1) == ASSIGN:
+            return self.parse_assignment()
+        elif code == IF:
+            return self.parse_conditional()
+        elif code == FOR:
+            return self.parse_fixed_loop()
+        elif code == DO:
+            return self.parse_while_loop()
+        elif code == INPUT:
+            return self.parse_input()
+        elif code == OUTPUT:
+            return self.parse_output()
+        elif code == LBRACE:
+            return self.parse_compound_statement()
         else:
-            raise SyntaxError(f"Неизвестный оператор: {current}")
+            raise self.error(f"Неизвестный оператор: {describe_token(current)}", current)
+
+    def peek_code(self, offset: int = 0) -> Optional[int]:
+        """
+        Код токена через offset позиций от текущего или None за концом потока
+        """
+        index = self.current_token + offset
+        return self.tokens[index][0] if index < len(self.tokens) else None
+
+    def parse_conditional(self) -> If:
+        statement = self.parse_conditional_head()
+        statement.then_branch = self.parse_compound_statement()  # Разбираем блок then
+        if self.peek_code() == ELSE:
+            self.match(ELSE)  # else
+            statement.else_branch = self.parse_compound_statement()  # Разбираем блок else
+        statement.end = (statement.else_branch or statement.then_branch).end
+        return statement
 
-    def parse_conditional(self):
-        self.match("KEYWORD")  # if
+    def parse_conditional_head(self) -> If:
+        """
+        if <условие> then; блоки дописывает вызывающий
+        """
+        start = self.match(IF)[2]  # if
         condition = self.parse_expression()  # Разбираем условие
-        self.match("KEYWORD")  # then
-        self.parse_compound_statement()  # Разбираем блок then
-        if self.current_token < len(self.tokens) and self.tokens[self.current_token][1] == "else":
-            self.match("KEYWORD")  # else
-            self.parse_compound_statement()  # Разбираем блок else
-
-    def parse_fixed_loop(self):
-        self.match("KEYWORD")  # for
-        self.match("IDENTIFIER")
-        self.match("ASSIGN")
-        self.parse_expression()
-        self.match("KEYWORD")  # to/downto (упрощено)
-        self.parse_expression()
-        self.parse_compound_statement()
-
-    def parse_while_loop(self):
-        self.match("KEYWORD")  # do
-        self.parse_compound_statement()
-        self.match("KEYWORD")  # while
-        self.parse_expression()
-
-    def parse_input(self):
-        self.match("KEYWORD")  # input
-        self.match("IDENTIFIER")
-        self.match("DELIMITER")  # ;
-
-    def parse_output(self):
-        self.match("KEYWORD")  # output
-        self.parse_expression()
-        self.match("DELIMITER")  # ;
-
-    def parse_compound_statement(self):
-        self.match("DELIMITER")  # {
-        while self.current_token < len(self.tokens) and self.tokens[self.current_token][1] != "}":
-            self.parse_statement()
-        self.match("DELIMITER")  # }
-
-    def parse_assignment(self):
-        identifier = self.match("IDENTIFIER")
-        self.match("ASSIGN")
+        self.match(THEN)  # then
+        return If(condition, None, None, start, 0)
+
+    def parse_fixed_loop(self) -> For:
+        statement = self.parse_fixed_loop_head()
+        statement.body = self.parse_compound_statement()
+        statement.end = statement.body.end
+        return statement
+
+    def parse_fixed_loop_head(self) -> For:
+        """
+        for <имя> = <выражение> <ключевое слово> <выражение>; тело дописывает вызывающий
+        """
+        start = self.match(FOR)[2]  # for
+        identifier = self.match(IDENTIFIER)
+        self.match(ASSIGN)
+        first = self.parse_expression()
+        direction = self.match_keyword()  # to/downto (упрощено)
+        last = self.parse_expression()
+        return For(identifier[1], first, direction[1], last, None, start, 0)
+
+    def parse_while_loop(self) -> DoWhile:
+        start = self.match(DO)[2]  # do
+        body = self.parse_compound_statement()
+        self.match(WHILE)  # while
+        condition = self.parse_expression()
+        # Конец - по последнему токену условия: при хэш-консинге узел условия общий
+        return DoWhile(body, condition, start, self.token_end(self.tokens[self.current_token - 1]))
+
+    def parse_input(self) -> Input:
+        start = self.match(INPUT)[2]  # input
+        identifier = self.match(IDENTIFIER)
+        end = self.token_end(self.match(SEMICOLON))  # ;
+        return Input(identifier[1], start, end)
+
+    def parse_output(self) -> Output:
+        start = self.match(OUTPUT)[2]  # output
+        value = self.parse_expression()
+        end = self.token_end(self.match(SEMICOLON))  # ;
+        return Output(value, start, end)
+
+    def open_block(self) -> Block:
+        """
+        Открывающая скобка составного оператора; операторы и конец дописываются позже
+        """
+        return Block([], self.match(LBRACE)[2], 0)  # {
+
+    def parse_compound_statement(self) -> Block:
+        block = self.open_block()
+        while self.current_token < len(self.tokens) and self.tokens[self.current_token][0] != RBRACE:
+            statement = self.parse_item(self.parse_statement)
+            if statement is not None:
+                block.body.append(statement)
+        block.end = self.close_block()
+        return block
+
+    def parse_program_stack(self) -> Program:
+        """
+        Разбор программы без рекурсии: вложенность блоков хранится в явном стеке
+        состояний, поэтому глубина ограничена только памятью. Грамматика,
+        дерево и сообщения об ошибках те же, что у рекурсивного спуска.
+        Элемент стека - (состояние, узел, оператор, которому принадлежит блок)
+        """
+        program = Program([], self.match(LBRACE)[2], 0)  # {
+        stack: List[Tuple[int, Node, Optional[Node]]] = [(_STATE_PROGRAM, program, None)]
+        while stack:
+            state, node, owner = stack[-1]
+            if state == _STATE_AFTER_THEN:
+                stack.pop()
+                if self.peek_code() == ELSE:
+                    self.match(ELSE)  # else
+                    node.else_branch = self.open_block()
+                    stack.append((_STATE_BLOCK, node.else_branch, node))
+                continue
+            if state == _STATE_AFTER_DO:
+                stack.pop()
+                self.match(WHILE)  # while
+                node.condition = self.parse_expression()
+                node.end = self.token_end(self.tokens[self.current_token - 1])
+                continue
+            # Тело программы или блока: операторы до }
+            code = self.peek_code()
+            if code is None or code == RBRACE:
+                node.end = self.token_end(self.match(RBRACE))  # }
+                if owner is not None:
+                    owner.end = node.end
+                stack.pop()
+            elif code == LET and state == _STATE_PROGRAM:
+                node.body.append(self.parse_declaration())
+            elif code == IF:
+                statement = self.parse_conditional_head()
+                statement.then_branch = self.open_block()
+                node.body.append(statement)
+                stack.append((_STATE_AFTER_THEN, statement, None))
+                stack.append((_STATE_BLOCK, statement.then_branch, statement))
+            elif code == FOR:
+                statement = self.parse_fixed_loop_head()
+                statement.body = self.open_block()
+                node.body.append(statement)
+                stack.append((_STATE_BLOCK, statement.body, statement))
+            elif code == DO:
+                statement = DoWhile(None, None, self.match(DO)[2], 0)  # do
+                statement.body = self.open_block()
+                node.body.append(statement)
+                stack.append((_STATE_AFTER_DO, statement, None))
+                stack.append((_STATE_BLOCK, statement.body, statement))
+            elif code == LBRACE:
+                block = self.open_block()
+                node.body.append(block)
+                stack.append((_STATE_BLOCK, block, None))
+            else:
+                node.body.append(self.parse_statement())  # Операторы без вложенных блоков
+        return program
+
+    def parse_program_table(self) -> Any:
+        """
+        Разбор таблично управляемым LL(1)-автоматом по грамматике self.grammar.
+        Нетерминал на вершине стека раскрывается по строке таблицы для текущего
+        токена, маркер продукции собирает значение из значений ее правой части.
+        Рекурсии нет; для MODEL_GRAMMAR дерево то же, что у рекурсивного спуска
+        """
+        rows, expansions, shapes, lengths, _ = self.grammar.compile()
+        actions = [getattr(self, action) if action else None for _, _, action in self.grammar.productions]
+        tokens = self.tokens
+        stack: List[Any] = [rows[self.grammar.start]]
+        values: List[Any] = []
+        pop, push, extend = stack.pop, values.append, stack.extend
+        position = 0
+        while stack:
+            symbol = pop()
+            if symbol.__class__ is int:
+                if symbol >= 0:
+                    # Терминал
+                    if position >= len(tokens) or tokens[position][0] != symbol:
+                        self.current_token = position
+                        self.commit_error(stack, lengths)
+                        self.match(symbol)
+                    push(tokens[position])
+                    position += 1
+                else:
+                    # Маркер продукции: правая часть разобрана (пустые собираются при раскрытии)
+                    production = ~symbol
+                    size = lengths[production]
+                    arguments = values[-size:]
+                    del values[-size:]
+                    push(actions[production](*arguments))
+                continue
+            code = tokens[position][0] if position < len(tokens) else None
+            production = symbol.get(code, symbol.default)
+            if production is None:
+                self.current_token = position
+                raise self.predict_error(symbol, tokens[position] if position < len(tokens) else None)
+            shape = shapes[production]
+            if shape == _EXPAND_SHIFT:
+                push(tokens[position])
+                position += 1
+                extend(expansions[production])
+            elif shape == _EXPAND_TOKEN:
+                push(actions[production](tokens[position]))
+                position += 1
+            elif shape == _EXPAND:
+                extend(expansions[production])
+            else:
+                push(actions[production]())  # ε-продукция собирается сразу
+        self.current_token = position
+        return values[0]
+
+    def parse_program_parallel(self) -> Program:
+        """
+        Параллельный разбор: предварительный проход по скобкам (split_statements)
+        делит программу на участки из целых операторов верхнего уровня, участки
+        разбираются в пуле процессов, операторы и таблицы символов участков
+        склеиваются в порядке текста. Дерево и таблица те же, что у рекурсивного
+        спуска; при синтаксической ошибке программа разбирается последовательно,
+        чтобы сообщение было тем же
+        """
+        tokens = self.tokens
+        count = len(tokens)
+        workers = self.workers or os.cpu_count() or 1
+        bounds = []
+        if count > 2 and not isinstance(tokens, TokenRing) and tokens[0][0] == LBRACE:
+            codes = tokens.kinds if isinstance(tokens, TokenBuffer) else map(itemgetter(0), tokens)
+            bounds = split_statements(codes, count, workers, PARALLEL_MIN_TOKENS)
+        if len(bounds) <= 2:
+            return self.parse_program()
+        source = self.lines.source if self.lines is not None and isinstance(self.lines.source, str) else None
+        segments = [self.statement_segment(first, last, source) for first, last in zip(bounds, bounds[1:])]
+        # Деревья без циклов освобождаются подсчетом ссылок, а сборщик мусора на
+        # миллионах новых узлов тратит на распаковку больше, чем сама распаковка
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            with ProcessPoolExecutor(min(workers, len(segments)), initializer=gc.disable) as pool:
+                results = list(pool.map(_parse_segment, *zip(*segments)))
+        except RecursionError:  # Слишком глубокое дерево не передается между процессами
+            results = [None]
+        finally:
+            if collecting:
+                gc.enable()
+        if None in results:
+            self.symbol_table = {}
+            return self.parse_program()
+
+        program = Program([], tokens[0][2], 0)
+        symbol_table = self.symbol_table
+        for body, table in results:
+            program.body.extend(body)
+            for name, entry in table.items():
+                # Объявление в участке заменяет запись целиком, присваивание меняет значение
+                if "declared" in entry or name not in symbol_table:
+                    symbol_table[name] = entry
+                else:
+                    symbol_table[name]["value"] = entry["value"]
+        self.current_token = count - 1
+        program.end = self.close_block()
+        return program
+
+    def statement_segment(self, first: int, last: int, source: Optional[str]) -> Tuple[Sequence, Optional[str], int]:
+        """
+        Аргументы _parse_segment для токенов first..last-1: токены со смещениями
+        от начала участка, текст участка (если известен) и смещение участка
+        """
+        tokens = self.tokens
+        base = tokens[first][2]
+        end = tokens[last][2]
+        if isinstance(tokens, TokenBuffer):
+            text = tokens.source[base:end]
+            part = TokenBuffer(text if isinstance(text, (str, bytes)) else bytes(text))
+            part.kinds = tokens.kinds[first:last]
+            part.starts = array("q", map(base.__rsub__, tokens.starts[first:last]))
+            part.ends = array("q", map(base.__rsub__, tokens.ends[first:last]))
+            return part, part.source if source is not None else None, base
+        if source is None:
+            return tokens[first:last], None, 0
+        return [(code, value, offset - base) for code, value, offset in tokens[first:last]], source[base:end], base
+
+    def commit_error(self, stack: List[Any], lengths: List[int]):
+        """
+        Несовпадение терминала до того, как выбор продукции стал окончательным
+        (Grammar.commit): ошибка выбора на первом токене продукции
+        """
+        grammar = self.grammar
+        # Ближайший маркер на стеке - разбираемая продукция; выше него ее несовпавшие символы
+        for depth in range(len(stack) - 1, -1, -1):
+            symbol = stack[depth]
+            if symbol.__class__ is int and symbol < 0:
+                break
+        else:
+            return
+        production = ~symbol
+        lhs = grammar.productions[production][0]
+        matched = lengths[production] - (len(stack) - depth)
+        if matched < grammar.commit.get(lhs, 1) and lhs in grammar.errors:
+            self.current_token -= matched
+            token = self.tokens[self.current_token]
+            raise self.error(grammar.errors[lhs].format(found=describe_token(token)), token)
+
+    def predict_error(self, row: _TableRow, token: Optional[Token]) -> SyntaxError:
+        """
+        Ошибка выбора продукции: в строке таблицы нет текущего токена
+        """
+        template = self.grammar.errors.get(row.name)
+        if template is not None:
+            return self.error(template.format(found=describe_token(token)), token)
+        expected = sorted("конец файла" if code is None else repr(TOKEN_LEXEMES[code])
+                          if code in TOKEN_LEXEMES else TOKEN_NAMES[code] for code in row)
+        expected = expected[0] if len(expected) == 1 else f"один из {', '.join(expected)}"
+        return self.error(f"Ожидался {expected}, найдено {describe_token(token)}", token)
+
+    # Действия продукций MODEL_GRAMMAR: строят те же узлы, что и рекурсивный спуск
+
+    def build_program(self, lbrace: Token, items: List[Node], rbrace: Token) -> Program:
+        items.reverse()
+        return Program(items, lbrace[2], self.token_end(rbrace))
+
+    def build_block(self, lbrace: Token, statements: List[Node], rbrace: Token) -> Block:
+        statements.reverse()
+        return Block(statements, lbrace[2], self.token_end(rbrace))
+
+    def build_sequence(self, item: Any, rest: List[Any]) -> List[Any]:
+        # Правая рекурсия: список собирается с конца и разворачивается владельцем
+        rest.append(item)
+        return rest
+
+    def build_empty(self) -> List[Any]:
+        return []
+
+    def build_none(self) -> None:
+        return None
+
+    def build_declaration(self, let: Token, identifier: Token, assign: Token, value: Node, semicolon: Token) -> Let:
+        self.symbol_table[identifier[1]] = {"type": "variable", "value": symbol_value(value), "declared": True}
+        return Let(identifier[1], value, let[2], self.token_end(semicolon))
+
+    def build_assignment(self, identifier: Token, assign: Token, value: Node, semicolon: Token) -> Assign:
+        if identifier[1] in self.symbol_table:
+            self.symbol_table[identifier[1]]["value"] = symbol_value(value)
+        else:
+            self.symbol_table[identifier[1]] = {"type": "variable", "value": symbol_value(value)}
+        return Assign(identifier[1], value, identifier[2], self.token_end(semicolon))
+
+    def build_conditional(self, if_token: Token, condition: Node, then: Token, then_branch: Block,
+                          else_branch: Optional[Block]) -> If:
+        return If(condition, then_branch, else_branch, if_token[2], (else_branch or then_branch).end)
+
+    def build_else(self, else_token: Token, block: Block) -> Block:
+        return block
+
+    def build_fixed_loop(self, for_token: Token, identifier: Token, assign: Token, first: Node, direction: Token,
+                         last: Node, body: Block) -> For:
+        return For(identifier[1], first, direction[1], last, body, for_token[2], body.end)
+
+    def build_while_loop(self, do: Token, body: Block, while_token: Token, condition: Node) -> DoWhile:
+        return DoWhile(body, condition, do[2], condition.end)
+
+    def build_input(self, input_token: Token, identifier: Token, semicolon: Token) -> Input:
+        return Input(identifier[1], input_token[2], self.token_end(semicolon))
+
+    def build_output(self, output_token: Token, value: Node, semicolon: Token) -> Output:
+        return Output(value, output_token[2], self.token_end(semicolon))
+
+    def build_expression(self, first: Node, tail: List[Tuple[Token, Node]]) -> Node:
+        """
+        Свертка операндов по приоритетам BINARY_PRECEDENCE, операции левоассоциативны.
+        Хвост собран с конца, поэтому обходится в обратном порядке
+        """
+        if not tail:
+            return first
+        operands = [first]
+        operators: List[Token] = []
+
+        def reduce():
+            operator = operators.pop()
+            right = operands.pop()
+            left = operands.pop()
+            operands.append(Binary(operator[1], left, right, left.start, right.end))
+
+        for operator, operand in reversed(tail):
+            precedence = BINARY_PRECEDENCE[operator[0]]
+            while operators and BINARY_PRECEDENCE[operators[-1][0]] >= precedence:
+                reduce()
+            operators.append(operator)
+            operands.append(operand)
+        while operators:
+            reduce()
+        return operands[0]
+
+    def build_tail(self, operator: Token, operand: Node, tail: List[Tuple[Token, Node]]) -> List[Tuple[Token, Node]]:
+        tail.append((operator, operand))
+        return tail
+
+    def build_unary(self, operator: Token, operand: Node) -> Unary:
+        return Unary(operator[1], operand, operator[2], operand.end)
+
+    def build_name(self, token: Token) -> Name:
+        return Name(token[1], token[2], token[2] + len(token[1]))
+
+    def build_number(self, token: Token) -> Number:
+        return Number(token[1], token[2], self.token_end(token))
+
+    def build_parenthesized(self, lparen: Token, expression: Node, rparen: Token) -> Node:
+        # Границы выражения в скобках включают сами скобки
+        expression.start = lparen[2]
+        expression.end = rparen[2] + 1
+        return expression
+
+    def parse_assignment(self) -> Assign:
+        identifier = self.match(IDENTIFIER)
+        self.match(ASSIGN)
         value = self.parse_expression()
-        self.match("DELIMITER")  # ;
+        end = self.token_end(self.match(SEMICOLON))  # ;
         if identifier[1] in self.symbol_table:
-            self.symbol_table[identifier[1]]["value"] = value
+            self.symbol_table[identifier[1]]["value"] = symbol_value(value)
+        else:
+            self.symbol_table[identifier[1]] = {"type": "variable", "value": symbol_value(value)}
+        return Assign(identifier[1], value, identifier[2], end)
+
+    def parse_expression(self) -> Node:
+        """
+        Разбирает выражения: числа, идентификаторы, скобки, унарную not и бинарные
+        операции REL_OP, ADD_OP, MUL_OP. Разбор по приоритетам в цикле с явными
+        стеками операндов и операций, без рекурсии. При хэш-консинге узлы
+        проходят через intern_expression
+        """
+        tokens = self.tokens  # Длина не кэшируется: у TokenRing она растет по мере чтения
+        intern = self.intern_expression if self.expressions is not None else None
+        operands: List[Node] = []
+        operators: List[Tuple[int, Optional[Token]]] = []  # (приоритет, токен); открывающая скобка - приоритет 0
+        depth = 0  # Открытые скобки выражения
+
+        def reduce(precedence: int):
+            # Сворачивает операции со стека, пока их приоритет не ниже precedence
+            while operators and operators[-1][0] >= precedence:
+                level, operator = operators.pop()
+                if level == UNARY_PRECEDENCE:
+                    operand = operands.pop()
+                    node = Unary(operator[1], operand, operator[2], operand.end)
+                else:
+                    right = operands.pop()
+                    left = operands.pop()
+                    node = Binary(operator[1], left, right, left.start, right.end)
+                operands.append(intern(node) if intern is not None else node)
+
+        while True:
+            # Ожидается операнд, перед ним - унарные операции и открывающие скобки
+            token = tokens[self.current_token] if self.current_token < len(tokens) else None
+            code = token[0] if token is not None else None
+            if code == UNARY_OP:
+                operators.append((UNARY_PRECEDENCE, token))
+                self.current_token += 1
+                continue
+            if code == LPAREN:
+                operators.append((0, token))
+                depth += 1
+                self.current_token += 1
+                continue
+            if code == IDENTIFIER:
+                node = Name(token[1], token[2], token[2] + len(token[1]))
+            elif code == NUMBER:
+                node = Number(token[1], token[2], self.token_end(token))
+            else:
+                raise self.error(f"Ожидался IDENTIFIER или NUMBER, найдено {describe_token(token)}", token)
+            operands.append(intern(node) if intern is not None else node)
+            self.current_token += 1
+
+            # После операнда - закрывающие скобки, затем бинарная операция или конец выражения
+            while depth and self.current_token < len(tokens) and tokens[self.current_token][0] == RPAREN:
+                reduce(1)
+                opening = operators.pop()[1]
+                if intern is None:
+                    # Границы выражения в скобках включают сами скобки; общий узел
+                    # хэш-консинга сохраняет границы первого вхождения без скобок
+                    operands[-1].start = opening[2]
+                    operands[-1].end = tokens[self.current_token][2] + 1
+                depth -= 1
+                self.current_token += 1
+            token = tokens[self.current_token] if self.current_token < len(tokens) else None
+            precedence = BINARY_PRECEDENCE.get(token[0]) if token is not None else None
+            if precedence is None:
+                break
+            reduce(precedence)
+            operators.append((precedence, token))
+            self.current_token += 1
+
+        if depth:
+            raise self.error(f"Ожидался ')', найдено {describe_token(token)}", token)
+        reduce(1)
+        return operands[0]
+
+    def intern_expression(self, node: Node) -> Node:
+        """
+        Хэш-консинг: вместо узла выражения возвращает живой структурно равный
+        узел, если он уже построен этим разбором. Потомки к этому моменту уже
+        общие, поэтому в ключе их id. Границы общего узла - первого вхождения
+        """
+        self.expression_nodes += 1
+        kind = type(node)
+        if kind is Name:
+            key = (Name, node.name)
+        elif kind is Number:
+            key = (Number, type(node.value), node.value)  # 1 и 1.0 - разные узлы
+        elif kind is Binary:
+            key = (Binary, node.operator, id(node.left), id(node.right))
         else:
-            self.symbol_table[identifier[1]] = {"type": "variable", "value": value}
+            key = (Unary, node.operator, id(node.operand))
+        shared = self.expressions.get(key)
+        if shared is not None:
+            return shared
+        self.expressions[key] = node
+        self.unique_expressions += 1
+        return node
+
+    def parse_expression_row(self) -> tuple:
+        """
+        parse_expression для разбора в арену: вместо узлов - кортежи (код узла,
+        индекс первого токена, литерал, начало, конец, потомки)
+        """
+        tokens = self.tokens
+        operands: List[tuple] = []
+        operators: List[Tuple[int, Optional[Token], int]] = []  # (приоритет, токен, его индекс)
+        depth = 0
+
+        def reduce(precedence: int):
+            while operators and operators[-1][0] >= precedence:
+                level, operator, index = operators.pop()
+                if level == UNARY_PRECEDENCE:
+                    operand = operands.pop()
+                    operands.append((_KIND_UNARY, index, operator[1], operator[2], operand[4], (operand,)))
+                else:
+                    right = operands.pop()
+                    left = operands.pop()
+                    operands.append((_KIND_BINARY, left[1], operator[1], left[3], right[4], (left, right)))
+
+        while True:
+            index = self.current_token
+            token = tokens[index] if index < len(tokens) else None
+            code = token[0] if token is not None else None
+            if code == UNARY_OP:
+                operators.append((UNARY_PRECEDENCE, token, index))
+                self.current_token += 1
+                continue
+            if code == LPAREN:
+                operators.append((0, token, index))
+                depth += 1
+                self.current_token += 1
+                continue
+            if code == IDENTIFIER:
+                operands.append((_KIND_NAME, index, token[1], token[2], token[2] + len(token[1]), ()))
+            elif code == NUMBER:
+                operands.append((_KIND_NUMBER, index, token[1], token[2], self.token_end(token), ()))
+            else:
+                raise self.error(f"Ожидался IDENTIFIER или NUMBER, найдено {describe_token(token)}", token)
+            self.current_token += 1
+
+            while depth and self.current_token < len(tokens) and tokens[self.current_token][0] == RPAREN:
+                reduce(1)
+                _, opening, position = operators.pop()
+                kind, _, literal, _, _, children = operands[-1]
+                operands[-1] = (kind, position, literal, opening[2], tokens[self.current_token][2] + 1, children)
+                depth -= 1
+                self.current_token += 1
+            token = tokens[self.current_token] if self.current_token < len(tokens) else None
+            precedence = BINARY_PRECEDENCE.get(token[0]) if token is not None else None
+            if precedence is None:
+                break
+            reduce(precedence)
+            operators.append((precedence, token, self.current_token))
+            self.current_token += 1
+
+        if depth:
+            raise self.error(f"Ожидался ')', найдено {describe_token(token)}", token)
+        reduce(1)
+        return operands[0]
+
+    def expression_node(self, row: tuple) -> Node:
+        """
+        Узел выражения по кортежу parse_expression_row, без рекурсии: потомки
+        строятся раньше родителя. При хэш-консинге узлы проходят через intern_expression
+        """
+        intern = self.intern_expression if self.expressions is not None else None
+        built: List[Node] = []
+        stack = [(row, False)]
+        while stack:
+            item, ready = stack.pop()
+            kind, _, literal, start, end, children = item
+            if children and not ready:
+                stack.append((item, True))
+                stack.extend((child, False) for child in reversed(children))
+                continue
+            if kind == _KIND_NAME:
+                node = Name(literal, start, end)
+            elif kind == _KIND_NUMBER:
+                node = Number(literal, start, end)
+            elif kind == _KIND_UNARY:
+                node = Unary(literal, built.pop(), start, end)
+            else:
+                right = built.pop()
+                node = Binary(literal, built.pop(), right, start, end)
+            built.append(intern(node) if intern is not None else node)
+        return built[0]
+
+    def statistics(self) -> Dict[str, Any]:
+        """
+        Статистика хэш-консинга: построено узлов выражений, из них новых и доля
+        узлов, замененных общими (dedup_ratio)
+        """
+        built = self.expression_nodes
+        return {"expression_nodes": built, "unique_expressions": self.unique_expressions,
+                "dedup_ratio": 1 - self.unique_expressions / built if built else 0.0}
+
+
+# Сколько блоков может хранить отложенные сдвиги, прежде чем они применяются ко всему дереву
+SYNTAX_DOCUMENT_MAX_MARKS = 4096
+# Сколько отметок может хранить один блок, прежде чем его сдвиги применяются
+SYNTAX_DOCUMENT_BLOCK_MARKS = 1024
+
+
+class SyntaxDocument:
+    """
+    Синтаксическое дерево документа, которое обновляется после правок.
+    Правка заново разбирает только наименьший блок { ... }, внутри которого она
+    лежит (не задевая скобок); если блок после разбора кончается не там, где
+    прежде, берется объемлющий, в крайнем случае - вся программа. Остальные
+    узлы переиспользуются как есть. Сдвиг смещений у следующих за правкой
+    операторов откладывается: блок хранит отметки (с какого оператора, сдвиг)
+    и применяет их, когда разбор спускается в оператор или запрашивается tree
+    """
+
+    def __init__(self, text: str, lexer: Optional[LexicalAnalyzer] = None):
+        self.document = TokenDocument(text, lexer)
+        self._marks: Dict[int, Tuple[Node, List[List[int]]]] = {}  # id блока -> (блок, [[с какого, сдвиг]])
+        self._symbol_table: Optional[Dict[str, Any]] = None
+        self._parse_all()
+
+    @property
+    def text(self) -> str:
+        return self.document.text
+
+    def _parse_all(self):
+        result = SyntaxAnalyzer(self.document.tokens, LineIndex(self.text)).parse()
+        self._tree = result.get("tree")
+        self.error = result.get("error")
+        self._marks.clear()
+        self._symbol_table = result.get("symbol_table")
+
+    @property
+    def tree(self) -> Optional[Program]:
+        """
+        Дерево с примененными отложенными сдвигами; None, если в программе ошибка
+        """
+        if self._marks:
+            self._flush()
+        return self._tree
 
-    def parse_expression(self) -> Any:
+    @property
+    def symbol_table(self) -> Dict[str, Any]:
         """
-        Разбирает выражения, включая числа, идентификаторы и бинарные операции
+        Таблица символов по дереву: объявления и присваивания в порядке текста
         """
-        token = self.tokens[self.current_token]
-        if token[0] in ("IDENTIFIER", "NUMBER"):
-            left = self.match(token[0])  # Либо IDENTIFIER, либо NUMBER
+        if self._symbol_table is None:
+            table: Dict[str, Any] = {}
+            for node in iter_nodes(self._tree) if self._tree is not None else ():
+                if isinstance(node, Let):
+                    table[node.name] = {"type": "variable", "value": symbol_value(node.value), "declared": True}
+                elif isinstance(node, Assign):
+                    if node.name in table:
+                        table[node.name]["value"] = symbol_value(node.value)
+                    else:
+                        table[node.name] = {"type": "variable", "value": symbol_value(node.value)}
+            self._symbol_table = table
+        return self._symbol_table
+
+    def result(self) -> Dict[str, Any]:
+        """
+        Результат в том же виде, что у SyntaxAnalyzer.parse
+        """
+        if self._tree is None:
+            return {"success": False, "error": self.error}
+        return {"success": True, "symbol_table": self.symbol_table, "tree": self.tree}
+
+    # Отложенные сдвиги
+
+    def _mark(self, block: Node, first: int, delta: int):
+        # Сдвиг delta для операторов блока с номера first
+        if not delta or first >= len(block.body):
+            return
+        entry = self._marks.get(id(block))
+        if entry is None:
+            entry = self._marks[id(block)] = (block, [])
+        marks = entry[1]
+        index = bisect.bisect_left(marks, [first])
+        if index < len(marks) and marks[index][0] == first:
+            marks[index][1] += delta
+            if not marks[index][1]:
+                del marks[index]
         else:
-            raise SyntaxError(f"Ожидался IDENTIFIER или NUMBER, найдено {token}")
+            marks.insert(index, [first, delta])
+            if len(marks) > SYNTAX_DOCUMENT_BLOCK_MARKS:
+                self._apply(*self._marks.pop(id(block)))
+
+    def _shift_of(self, block: Node, index: int) -> int:
+        entry = self._marks.get(id(block))
+        if entry is None:
+            return 0
+        return sum(delta for first, delta in entry[1] if first <= index)
+
+    def _locate(self, block: Node, offset: int) -> int:
+        """
+        Номер последнего оператора блока, начало которого с отложенным сдвигом
+        не дальше offset; -1 - такого нет. Между отметками сдвиг постоянен:
+        находится отрезок, затем оператор в нем двоичным поиском
+        """
+        body = block.body
+        entry = self._marks.get(id(block))
+        low, high, shift = 0, len(body), 0
+        for first, delta in entry[1] if entry is not None else ():
+            if body[first].start + shift + delta > offset:
+                high = first
+                break
+            low, shift = first, shift + delta
+        return bisect.bisect_right(body, offset - shift, low, high, key=attrgetter("start")) - 1
+
+    def _shift(self, node: Node, delta: int):
+        """
+        Сдвигает узел и поддерево; тела вложенных блоков получают отметку вместо обхода
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node.start += delta
+            node.end += delta
+            if isinstance(node, (Block, Program)):
+                self._mark(node, 0, delta)
+            else:
+                stack.extend(node_children(node))
+
+    def _settle(self, block: Node, index: int) -> Node:
+        """
+        Применяет отложенный сдвиг к одному оператору блока и возвращает его
+        """
+        delta = self._shift_of(block, index)
+        if delta:
+            self._shift(block.body[index], delta)
+            self._mark(block, index, -delta)
+            self._mark(block, index + 1, delta)
+        return block.body[index]
+
+    def _flush(self):
+        """
+        Применяет все отложенные сдвиги ко всему дереву
+        """
+        marks, self._marks = self._marks, {}
+        for block, pending in marks.values():
+            self._apply(block, pending)
+
+    @staticmethod
+    def _apply(block: Node, pending: List[List[int]]):
+        """
+        Применяет отметки блока к его операторам. Сдвиги складываются, поэтому
+        блоки обрабатываются независимо, а обходятся только сдвигаемые поддеревья
+        """
+        body = block.body
+        delta = 0
+        for position, (first, value) in enumerate(pending):
+            delta += value
+            if not delta:
+                continue
+            nodes = body[first:pending[position + 1][0] if position + 1 < len(pending) else len(body)]
+            while nodes:
+                node = nodes.pop()
+                node.start += delta
+                node.end += delta
+                nodes.extend(node_children(node))
+
+    # Правка
 
-        if self.current_token < len(self.tokens) and self.tokens[self.current_token][0] == "REL_OP":
-            operator = self.match("REL_OP")
-            right = self.parse_expression()  # Рекурсивно разбираем правую часть выражения
-            return {"left": left[1], "operator": operator[1], "right": right}
+    def _enclosing(self, low: int, high: int) -> List[Tuple[Node, int, Node, Optional[str]]]:
+        """
+        Путь к наименьшему блоку, строго содержащему участок [low, high]: уровни
+        (блок, номер оператора, оператор, поле оператора с вложенным блоком или None,
+        если оператор сам блок)
+        """
+        path = []
+        block = self._tree
+        while True:
+            index = self._locate(block, low)
+            if index < 0:
+                return path
+            statement = self._settle(block, index)
+            if not (statement.start <= low and high <= statement.end):
+                return path
+            if isinstance(statement, Block):
+                inner, field = statement, None
+            else:
+                inner = field = None
+                for name in statement.fields:
+                    child = getattr(statement, name)
+                    if isinstance(child, Block) and child.start < low and high < child.end:
+                        inner, field = child, name
+                        break
+            if inner is None or not (inner.start < low and high < inner.end):
+                return path
+            path.append((block, index, statement, field))
+            block = inner
+
+    def edit(self, offset: int, removed: int, inserted: str) -> Optional[Node]:
+        """
+        Применяет правку и обновляет дерево. Возвращает блок (или программу),
+        операторы которого разобраны заново; None, если в программе синтаксическая ошибка
+        """
+        delta = len(inserted) - removed
+        low, high = offset, offset + removed
+        tree = self._tree
+        inside = tree is not None and tree.start < low and high < tree.end
+        path = self._enclosing(low, high) if inside else []
+        self.document.edit(offset, removed, inserted)
+        self._symbol_table = None
+        if inside:
+            blocks = [tree] + [statement if field is None else getattr(statement, field)
+                               for _, _, statement, field in path]
+            for depth in range(len(blocks) - 1, -1, -1):
+                if self._reparse(blocks[depth], low, high, delta, depth == 0):
+                    self._shift_enclosing(path[:depth], delta)
+                    return blocks[depth]
+                # Правка вышла за границы блока: разбираем оператор, в котором он лежит
+                statement = path[depth - 1][2] if depth else None
+                if statement is not None:
+                    low, high = statement.start, statement.end
+        self._parse_all()
+        return self._tree
+
+    def _reparse(self, block: Node, low: int, high: int, delta: int, program: bool) -> bool:
+        """
+        Заново разбирает операторы блока, задетые участком [low, high] (в прежних
+        смещениях), до первого прежнего оператора после правки, с которого
+        разбор совпадает с прежним. Блок и остальные операторы остаются прежними
+        объектами. False - разбор не удался или вышел за закрывающую скобку блока
+        """
+        body = block.body
+        index = self._locate(block, low)
+        # Оператор, вплотную примыкающий к правке слева, тоже может измениться
+        while index > 0 and self._settle(block, index - 1).end >= low:
+            index -= 1
+        first = max(index, 0)
+        start = self._settle(block, first).start if first < len(body) else block.end - 1
+        if index < 0:
+            start = block.start + 1
+        parser = SyntaxAnalyzer.from_stream(self.document.iter_tokens(start))
+        statements: List[Node] = []
+        following = first  # Кандидат на совпадение: прежний оператор после правки
+        try:
+            while True:
+                code = parser.peek_code()
+                if code is None:
+                    return False
+                position = parser.tokens[parser.current_token][2]
+                if code == RBRACE:
+                    if parser.token_end(parser.tokens[parser.current_token]) != block.end + delta:
+                        return False
+                    following = len(body)
+                    break
+                while following < len(body):
+                    old_start = self._settle(block, following).start
+                    if old_start > high and old_start + delta >= position:
+                        break
+                    following += 1
+                if following < len(body) and old_start + delta == position:
+                    break
+                if program and code == LET:
+                    statements.append(parser.parse_declaration())
+                else:
+                    statements.append(parser.parse_statement())
+        except SyntaxError:
+            return False
+        # Отметки: новые операторы уже в новых смещениях, прежние после них сдвигаются еще на delta
+        entry = self._marks.get(id(block))
+        marks = [mark for mark in entry[1] if mark[0] < first] if entry is not None else []
+        shift = self._shift_of(block, following) if following < len(body) else 0
+        if entry is not None:
+            moved = [[position - following + first + len(statements), value]
+                     for position, value in entry[1] if position > following]
+            del self._marks[id(block)]
+        else:
+            moved = []
+        body[first:following] = statements
+        for position, value in marks:
+            self._mark(block, position, value)
+        self._mark(block, first, -sum(value for _, value in marks))
+        self._mark(block, first + len(statements), shift + delta)
+        for position, value in moved:
+            self._mark(block, position, value)
+        block.end += delta
+        return True
 
-        return left[1]
+    def _shift_enclosing(self, path: List[Tuple[Node, int, Node, Optional[str]]], delta: int):
+        """
+        Сдвигает концы объемлющих узлов и все, что следует за правкой
+        """
+        for block, index, statement, field in path:
+            block.end += delta
+            self._mark(block, index + 1, delta)
+            if field is not None:
+                statement.end += delta
+                for name in statement.fields[statement.fields.index(field) + 1:]:
+                    child = getattr(statement, name)
+                    if isinstance(child, Node):
+                        self._shift(child, delta)
+        if len(self._marks) > SYNTAX_DOCUMENT_MAX_MARKS:
+            self._flush()
 
 
 class SemanticAnalyzer:
-    def __init__(self):
+    def __init__(self, lines: Optional[LineIndex] = None):
         self.symbol_table = {}
         self.errors = []
         self.declared_variables = set()  # Множество для отслеживания объявленных переменных
         self.undeclared_usage = set()  # Множество для отслеживания использования переменных до их объявления
+        self.first_usage: Dict[str, int] = {}  # Смещение первого использования необъявленной переменной
+        self.lines = lines  # Индекс строк для сообщений об ошибках
 
-    def analyze(self, lexical_errors: List[str], parse_result: Dict[str, Any], tokens: List[Tuple[str, Any]]) -> Dict[str, Any]:
+    def analyze(self, lexical_errors: List[str], parse_result: Dict[str, Any], tokens: List[Token]) -> Dict[str, Any]:
         """
         Семантический анализ программы
         """
@@ -202,7 +4296,10 @@ class SemanticAnalyzer:
 
         # 2. Проверка синтаксического анализа - только если он успешен
         if not parse_result["success"]:
-            self.errors.append(f"Синтаксическая ошибка: {parse_result['error']}")
+            for error in parse_result.get("errors", [parse_result["error"]]):
+                self.errors.append(f"Синтаксическая ошибка: {error}")
+            # При восстановлении после ошибок разбор дает частичную таблицу символов
+            self.symbol_table = parse_result.get("symbol_table", self.symbol_table)
             return {"success": False, "errors": self.errors, "symbol_table": self.symbol_table}
 
         self.symbol_table = parse_result["symbol_table"]
@@ -219,30 +4316,35 @@ class SemanticAnalyzer:
             "symbol_table": self.symbol_table
         }
 
-    def check_variables(self, tokens: List[Tuple[str, Any]]):
+    def check_variables(self, tokens: List[Token]):
         """
         Проверка на использование переменных до их объявления.
         """
         # Сначала пройдем по всем токенам и добавим все переменные, объявленные с помощью 'let'
         for i, token in enumerate(tokens):
-            if token[0] == "KEYWORD" and token[1] == "let":
+            if token[0] == LET:
                 # Идентификатор, который объявляется после 'let'
-                if i + 1 < len(tokens) and tokens[i + 1][0] == "IDENTIFIER":
+                if i + 1 < len(tokens) and tokens[i + 1][0] == IDENTIFIER:
                     identifier = tokens[i + 1][1]
                     self.declared_variables.add(identifier)  # Добавляем переменную в множество объявленных
 
         # Теперь проверим все использование переменных в программе
         for token in tokens:
-            if token[0] == "IDENTIFIER":
+            if token[0] == IDENTIFIER:
                 var_name = token[1]
 
                 # Проверяем, была ли переменная объявлена
                 if var_name not in self.declared_variables:
                     self.undeclared_usage.add(var_name)  # Отмечаем переменную как использованную до объявления
+                    self.first_usage.setdefault(var_name, token[2])
 
         # Ошибки использования переменных до объявления
         for var_name in self.undeclared_usage:
-            self.errors.append(f"Переменная {var_name} используется до объявления.")
+            if self.lines is not None:
+                where = self.lines.describe(self.first_usage[var_name])
+                self.errors.append(f"Переменная {var_name} используется до объявления ({where}).")
+            else:
+                self.errors.append(f"Переменная {var_name} используется до объявления.")
 
     def check_types(self):
         """
@@ -264,13 +4366,14 @@ def analyze_program(program: str) -> Dict[str, Any]:
     # Лексический анализ
     lexer = LexicalAnalyzer()
     tokens, lexical_errors = lexer.tokenize(program)
+    lines = LineIndex(program)  # Строится только при выводе позиции ошибки
 
     # Синтаксический анализ
-    parser = SyntaxAnalyzer(tokens)
+    parser = SyntaxAnalyzer(tokens, lines, recover=True)  # Все синтаксические ошибки за один проход
     parse_result = parser.parse()
 
     # Семантический анализ
-    semantic_analyzer = SemanticAnalyzer()
+    semantic_analyzer = SemanticAnalyzer(lines)
     semantic_result = semantic_analyzer.analyze(lexical_errors, parse_result, tokens)
 
     # Возвращаем результаты всех этапов анализа
@@ -300,7 +4403,7 @@ if __name__ == "__main__":
     print("Анализ программы завершен:")
 
     print("\nТокены:")
-    print(tabulate(result["tokens"], headers=["Тип", "Значение"]))
+    print(tabulate(token_view(result["tokens"]), headers=["Тип", "Значение"]))
 
     if result["lexical_errors"]:
         print("\nЛексические ошибки:")
@@ -311,7 +4414,8 @@ if __name__ == "__main__":
         print("\nСинтаксический анализ завершен успешно.")
     else:
         print("\nСинтаксический анализ завершился с ошибкой.")
-        print(f"Ошибка: {result['parse_result']['error']}")
+        for error in result["parse_result"].get("errors", [result["parse_result"]["error"]]):
+            print(f"Ошибка: {error}")
 
     print("\nСемантический анализ:")
     print(f"Успешно: {result['semantic_result']['success']}")
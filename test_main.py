@@ -0,0 +1,310 @@
+"""
+Проверки анализатора: python -m pytest -q
+"""
+import os
+import random
+
+import pytest
+
+import main
+from bench import tree_signature
+from main import (LexicalAnalyzer, LineIndex, SyntaxAnalyzer, TokenDocument, load_lexer_tables, save_lexer_tables,
+                  token_view)
+
+
+def test_register_rule_delimiter_new_lexemes():
+    """
+    Замена правила DELIMITER выделяет коды новым разделителям
+    """
+    lexer = LexicalAnalyzer().register_rule("DELIMITER", r'[{}();,\[\]]')
+    tokens, errors = lexer.tokenize("a[1]")
+    assert not errors
+    assert token_view(tokens) == [("IDENTIFIER", "a"), ("DELIMITER", "["), ("NUMBER", 1), ("DELIMITER", "]")]
+
+
+@pytest.mark.parametrize("engine", ["regex", "dfa"])
+def test_register_rule_keyword_new_lexeme(engine):
+    """
+    Правило KEYWORD с новым словом: слово получает код ключевого слова
+    """
+    lexer = LexicalAnalyzer(engine).register_rule("KEYWORD", r'\buntil\b', before="IDENTIFIER")
+    tokens, _ = lexer.tokenize("x until untilx")
+    assert token_view(tokens) == [("IDENTIFIER", "x"), ("KEYWORD", "until"), ("IDENTIFIER", "untilx")]
+
+
+def test_register_rule_lexeme_kind_needs_finite_set():
+    """
+    Правило вида с кодами по лексемам, совпадающее с бесконечным набором строк, отклоняется
+    """
+    lexer = LexicalAnalyzer()
+    with pytest.raises(ValueError):
+        lexer.register_rule("KEYWORD", r'\b[a-z]+_kw\b', before="IDENTIFIER")
+    assert token_view(lexer.tokenize("a_kw")[0]) == [("IDENTIFIER", "a_kw")]
+
+
+@pytest.mark.parametrize("regex", [r'^if', r'end$'])
+def test_register_rule_rejects_anchors(regex):
+    """
+    Якоря ^ и $ отклоняются: ДКА прочитал бы их как обычные символы
+    """
+    with pytest.raises(ValueError):
+        LexicalAnalyzer().register_rule("ANCHORED", regex, before="IDENTIFIER")
+
+
+def test_register_rule_rejects_prefix_alternation():
+    """
+    Ветвь, совпадающая с началом более поздней, отклоняется: re и ДКА выбрали бы разное
+    """
+    with pytest.raises(ValueError):
+        LexicalAnalyzer().register_rule("WORDS", r'[a-z]+|[a-z]+_x', before="IDENTIFIER")
+
+
+# Правила диалектов, в том числе с ветвями-строками, которые нужно переставить
+DIALECT_RULES = [
+    ("POW_OP", r'\*\*', "MUL_OP"),
+    ("NE_OP", r'<>', "REL_OP"),
+    ("ARROW", r'-|->', "ADD_OP"),
+    ("KEYWORD", r'\b(?:do|done|if|else|while|return)\b', "IDENTIFIER"),
+]
+
+
+def test_engine_parity_for_dialect_rules():
+    """
+    Токены regex и dfa совпадают для зарегистрированных правил диалекта
+    """
+    lexers = []
+    for engine in ("regex", "dfa"):
+        lexer = LexicalAnalyzer(engine)
+        for name, regex, before in DIALECT_RULES:
+            lexer.register_rule(name, regex, before=before)
+        lexers.append(lexer)
+    for program in ["x ** 2 <> y", "a->b - c-->d", "do done donex if (x <= 1) return x;", "int a = 3; // ->"]:
+        regex_tokens, dfa_tokens = (lexer.tokenize(program) for lexer in lexers)
+        assert token_view(regex_tokens[0]) == token_view(dfa_tokens[0])
+        assert regex_tokens[1] == dfa_tokens[1]
+    assert ("ARROW", "->") in token_view(lexers[0].tokenize("a->b")[0])
+
+
+@pytest.mark.parametrize("program", ["{ x + 1; }", "{ let y = 1; y }", "{ if x then { z 2; } }"])
+def test_table_mode_error_matches_recursive(program):
+    """
+    Идентификатор без = дает в табличном режиме то же сообщение, что и в рекурсивном
+    """
+    tokens, _ = LexicalAnalyzer().tokenize(program)
+    results = [SyntaxAnalyzer(tokens, LineIndex(program), mode=mode).parse() for mode in ("recursive", "table")]
+    assert not results[0]["success"] and results[0]["error"].startswith("Неизвестный оператор")
+    assert results[1]["error"] == results[0]["error"]
+
+
+def test_stream_arena_matches_list_arena():
+    """
+    Разбор в арену над потоком токенов: оператор длиннее окна TokenRing не мешает
+    найти индексы токенов, арена та же, что над списком
+    """
+    program = "{ let x = 1; if x then { " + " ".join(f"x = x + {i};" for i in range(200)) + " } output x; }"
+    tokens, _ = LexicalAnalyzer().tokenize(program)
+    arenas = [SyntaxAnalyzer(tokens).parse_arena()["arena"],
+              SyntaxAnalyzer.from_stream(iter(tokens), size=16).parse_arena()["arena"]]
+    for name in ("kinds", "first_child", "next_sibling", "token", "literal", "literals"):
+        assert list(getattr(arenas[0], name)) == list(getattr(arenas[1], name))
+
+
+@pytest.mark.parametrize("program", [
+    "{ let x = 1; x = (x + 2) * not y; if x < 1 then { output x; } else { input y; } "
+    "do { x = x - 1; } while x > 0 for i = 1 to 10 { output (i); } }",
+    "{ let x = 1; x = ; if x then { y = 2 + ; output x; } output x * 2; let",
+    "let x = 1;",
+])
+def test_arena_matches_object_tree(program):
+    """
+    Разбор сразу в арену дает те же узлы, что перенос дерева объектов через
+    add_tree, и результат той же формы, что у parse, в том числе с восстановлением
+    """
+    tokens, _ = LexicalAnalyzer().tokenize(program)
+    for recover in (False, True):
+        parser = SyntaxAnalyzer(tokens, recover=recover)
+        expected = parser.parse()
+        result = SyntaxAnalyzer(tokens, recover=recover).parse_arena()
+        assert set(result) - {"arena"} == set(expected) - {"tree"}
+        assert result.get("errors") == expected.get("errors") and result.get("error") == expected.get("error")
+        assert repr(result.get("symbol_table")) == repr(expected.get("symbol_table"))
+        if expected.get("tree") is None:
+            continue
+        arena = main.AstArena()
+        arena.add(main.NODE_KINDS[main.Program], parser.token_index(expected["tree"].start))
+        previous = -1
+        for statement in expected["tree"].body:
+            previous = arena.add_tree(statement, parser.token_index, 0, previous)
+        for name in ("kinds", "first_child", "next_sibling", "token"):
+            assert list(getattr(arena, name)) == list(getattr(result["arena"], name))
+        assert list(map(arena.value, range(len(arena)))) == list(map(result["arena"].value, range(len(arena))))
+
+
+def test_token_document_random_edits_match_full_lexing(monkeypatch):
+    """
+    Случайные правки документа с комментариями и ошибками по всему тексту дают
+    те же токены и ошибки, что и анализ текста заново. Маленькие блоки, куски
+    и окно заставляют правки задевать их границы
+    """
+    monkeypatch.setattr(main, "TOKEN_BLOCK_SIZE", 4)
+    monkeypatch.setattr(main, "TEXT_PIECE_SIZE", 16)
+    monkeypatch.setattr(main, "TEXT_WINDOW_SIZE", 2)
+    lexer = LexicalAnalyzer()
+    rng = random.Random(0)
+    line = "x = x + 1; /* c */ let $y = 2.5;\n"
+    snippets = ["x", " ", "1", ";", "/*", "*/", "\n", "$", "{ y = 2; }", "/* c */", ""]
+    document = TokenDocument(line * 200, lexer)
+    text = document.text
+    for step in range(600):
+        offset = rng.randrange(len(text) + 1)
+        removed = rng.randint(0, min(4, len(text) - offset))
+        inserted = rng.choice(snippets)
+        document.edit(offset, removed, inserted)
+        text = text[:offset] + inserted + text[offset + removed:]
+        if step % 20 == 0:
+            assert document.substring(offset - 10, offset + 10) == text[max(offset - 10, 0):offset + 10]
+            assert repr((document.tokens, document.errors)) == repr(lexer.tokenize(text))
+    assert document.text == text
+
+
+def test_lexer_tables_round_trip(tmp_path, monkeypatch):
+    """
+    Сохраненные таблицы ДКА загружаются в пустой кэш процесса и дают те же токены;
+    файл с чужим отпечатком не загружается
+    """
+    specification = LexicalAnalyzer().token_specification
+    path = str(tmp_path / "tables.marshal")
+    fingerprint = save_lexer_tables(path, specification)
+    monkeypatch.setattr(main, "_dfa_scanners", {})
+    assert load_lexer_tables(path, "0" * 64) is None
+    assert load_lexer_tables(path, fingerprint) == fingerprint
+    program = "{ let x = 1; /* c */ output x; }"
+    assert LexicalAnalyzer("dfa").tokenize(program) == LexicalAnalyzer().tokenize(program)
+
+
+def test_syntax_document_random_edits_match_full_parse(monkeypatch):
+    """
+    Случайные правки SyntaxDocument дают то же дерево, таблицу символов и ошибку,
+    что и разбор текста заново. Малые пределы отметок сдвигов заставляют
+    применять отложенные сдвиги посреди правок
+    """
+    monkeypatch.setattr(main, "SYNTAX_DOCUMENT_MAX_MARKS", 4)
+    monkeypatch.setattr(main, "SYNTAX_DOCUMENT_BLOCK_MARKS", 2)
+    rng = random.Random(0)
+    statements = ["x = x + 1;", "output (x);", "input y;", "if x < 1 then { x = 2; } else { output x; }",
+                  "do { x = x - 1; } while x > 0", "{ y = 2; }", "for i = 1 while 3 { output i; }"]
+    inserts = [" output x;", " { x = 2; }", " x = 1 + 2;", " if y < 2 then { input y; }", " /* c */"]
+    damage = ["}", "{", "/*", "(", ";", "x", ""]
+    lexer = LexicalAnalyzer()
+    for trial in range(60):
+        text = "{ let x = 1;\n" + "\n".join(rng.choice(statements) for _ in range(rng.randint(0, 12))) + "\n}"
+        document = main.SyntaxDocument(text)
+        for step in range(15):
+            if rng.random() < 0.9:
+                # Правки на границах операторов оставляют программу верной, остальные ее портят
+                offset = rng.choice([index + 1 for index, char in enumerate(document.text) if char in ";{"])
+                removed, inserted = 0, rng.choice(inserts)
+            else:
+                offset = rng.randint(0, len(document.text))
+                removed, inserted = rng.randint(0, min(4, len(document.text) - offset)), rng.choice(damage)
+            document.edit(offset, removed, inserted)
+            if step % 3:
+                continue
+            expected = SyntaxAnalyzer(lexer.tokenize(document.text)[0], LineIndex(document.text)).parse()
+            result = document.result()
+            assert result["success"] == expected["success"], document.text
+            if not expected["success"]:
+                assert result["error"] == expected["error"]
+                continue
+            assert tree_signature(result["tree"]) == tree_signature(expected["tree"]), document.text
+            assert repr(result["symbol_table"]) == repr(expected["symbol_table"])
+
+
+def test_token_cache_hit_and_damaged_files(tmp_path):
+    """
+    Повторный анализ того же текста - попадание в кэш с теми же токенами.
+    Усеченный файл или файл с чужой сигнатурой не читается, текст
+    анализируется заново, и файл перезаписывается
+    """
+    cache = main.TokenCache(str(tmp_path))
+    program = "{ let x = 1; /* c */ let $y = 2.5; output x; }"
+    tokens, errors = cache.tokenize(program)
+    cached, cached_errors = cache.tokenize(program)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert list(cached) == list(tokens) and cached_errors == errors and errors
+    key = cache.key(program)
+    data = open(cache.path(key), "rb").read()
+    for damaged in (data[:len(data) // 2], data[:main._CACHE_HEADER.size - 1], b"", b"XXXX" + data[4:]):
+        # Новый файл на месте старого: прочитанный ранее буфер держит mmap старого
+        with open(cache.path(key) + ".damaged", "wb") as f:
+            f.write(damaged)
+        os.replace(cache.path(key) + ".damaged", cache.path(key))
+        assert cache.load(key, program) is None
+        cached, _ = cache.tokenize(program)
+        assert list(cached) == list(tokens)
+        assert cache.load(key, program) is not None
+
+
+def test_token_cache_evicts_least_recently_used(tmp_path):
+    """
+    Сверх max_bytes вытесняется файл, который дольше всех не читался
+    """
+    cache = main.TokenCache(str(tmp_path))
+    programs = ["{ a = 1; }", "{ b = 2; }", "{ c = 3; }"]
+    for age, program in enumerate(programs[:2]):
+        cache.tokenize(program)
+        os.utime(cache.path(cache.key(program)), (1000 - age, 1000 - age))  # Первый - новее второго
+    cache.max_bytes = 2 * os.path.getsize(cache.path(cache.key(programs[0])))
+    cache.tokenize(programs[2])
+    assert [os.path.exists(cache.path(cache.key(program))) for program in programs] == [True, False, True]
+
+
+def test_recovery_collects_errors_and_keeps_valid_statements():
+    """
+    Режим восстановления: все ошибки за один проход, верные операторы остаются
+    в дереве, число ошибок ограничено max_errors
+    """
+    program = "{ let x = 1; let y 2; output x; if x then { x = ; output y; } input ; x = x + 1; }"
+    tokens, _ = LexicalAnalyzer().tokenize(program)
+    result = SyntaxAnalyzer(tokens, LineIndex(program), recover=True).parse()
+    assert not result["success"] and len(result["errors"]) == 3
+    assert result["error"] == SyntaxAnalyzer(tokens, LineIndex(program)).parse()["error"]
+    assert [type(statement).__name__ for statement in result["tree"].body] == ["Let", "Output", "If", "Assign"]
+    assert [type(statement).__name__ for statement in result["tree"].body[2].then_branch.body] == ["Output"]
+    limited = SyntaxAnalyzer(tokens, recover=True, max_errors=2).parse()
+    assert len(limited["errors"]) == 3 and limited["errors"][-1].startswith("Больше 2")
+
+
+def test_token_ring_window():
+    """
+    TokenRing: разбор потока совпадает с разбором списка, вытесненные токены
+    недоступны, слишком малое окно отклоняется
+    """
+    program = "{ let x = 1; " + " ".join(f"x = x + {i};" for i in range(100)) + " output x; }"
+    tokens, _ = LexicalAnalyzer().tokenize(program)
+    expected = SyntaxAnalyzer(tokens).parse()
+    result = SyntaxAnalyzer.from_stream(iter(tokens), size=8).parse()
+    assert tree_signature(result["tree"]) == tree_signature(expected["tree"])
+    ring = main.TokenRing(iter(tokens), size=8)
+    assert ring[20] == tokens[20]
+    with pytest.raises(IndexError):
+        ring[5]
+    with pytest.raises(ValueError):
+        main.TokenRing(iter(tokens), size=4)
+
+
+def test_hash_consing_shares_equal_expressions():
+    """
+    Хэш-консинг: то же дерево, что без него, равные выражения - один объект
+    """
+    program = "{ let a = 1; x = a * (a + 1); y = a * (a + 1); output a * (a + 1); }"
+    tokens, _ = LexicalAnalyzer().tokenize(program)
+    plain = SyntaxAnalyzer(tokens).parse()["tree"]
+    parser = SyntaxAnalyzer(tokens, hash_cons=True)
+    shared = parser.parse()["tree"]
+    # Общий узел хранит границы первого вхождения, поэтому сравниваются типы и значения
+    assert [(kind, values) for kind, _, _, values in tree_signature(shared)] == \
+        [(kind, values) for kind, _, _, values in tree_signature(plain)]
+    values = [statement.value for statement in shared.body[1:]]
+    assert values[0] is values[1] is values[2] and values[0] is not plain.body[1].value
+    assert parser.statistics()["dedup_ratio"] > 0.5